@@ -1,3 +1,4 @@
+import multiprocessing
 import os.path
 import re
 import logging
@@ -12,6 +13,7 @@ from flask_migrate import Migrate
 from sqlalchemy import MetaData
 
 from guabookseat.settings import MyFlaskConfig
+from guabookseat.sqlite_tuning import install_sqlite_pragmas
 
 app = Flask(__name__)
 # set app config
@@ -36,21 +38,26 @@ naming_convention = {
     "pk": "pk_%(table_name)s"
 }
 db = SQLAlchemy(app=app, metadata=MetaData(naming_convention=naming_convention))
+# data.db和任务库的连接使用WAL模式
+for engine in (db.get_engine(app), app.config['SCHEDULER_JOBSTORES']['default'].engine):
+    if engine.dialect.name == 'sqlite':
+        install_sqlite_pragmas(engine, app.config['SQLITE_JOURNAL_MODE'], app.config['SQLITE_SYNCHRONOUS'])
 # set login_manager
 login_manager = LoginManager(app)
 # set flask-mail
 mail = Mail(app)
 # set apscheduler
 scheduler = APScheduler(scheduler=BackgroundScheduler(), app=app)
-scheduler.start()
+# 先暂停执行任务，等所有模块导入完成后再恢复，避免调度器线程与主线程同时导入任务模块
+scheduler.start(paused=True)
 # set migrate
 migrate = Migrate(app=app, db=db, render_as_batch=True)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    from guabookseat.models import User
-    user = User.query.get(int(user_id))
+    from guabookseat.user_config_cache import user_config_cache
+    user = user_config_cache.get_user(user_id)
     return user
 
 
@@ -63,11 +70,26 @@ login_manager.login_view = 'index'
 @app.context_processor
 def inject_user():
     if current_user.is_authenticated:
-        # 获取当前UserConfig（可能为None）
-        from guabookseat.models import UserConfig
-        current_config = UserConfig.query.filter_by(id=current_user.id).first()
-        return dict(user=current_user, config=current_config)
-    return dict(user={}, config={})
+        # 获取当前按优先级排列的全部UserConfig，config为主订座信息（可能为None）
+        from guabookseat.user_config_cache import user_config_cache
+        current_configs = user_config_cache.get_user_configs(current_user.id)
+        return dict(user=current_user, config=current_configs[0] if current_configs else None,
+                    configs=current_configs)
+    return dict(user={}, config={}, configs=[])
 
 
-from guabookseat import views, errors, commands
+from guabookseat import views, errors, commands, benchmarks
+from guabookseat.booking_history import init_booking_history
+from guabookseat.job_lease import init_scheduler_role
+from guabookseat.mail_queue import init_mail_queue
+from guabookseat.metrics import init_metrics
+from guabookseat.system_jobs import init_system_jobs
+
+init_metrics()
+init_booking_history()
+# 进程池执行器的工作进程只执行订座任务，不注册系统任务，调度器保持暂停，发件线程在发送第一封邮件时才启动
+if multiprocessing.parent_process() is None:
+    init_system_jobs()
+    init_mail_queue()
+    # 按进程角色恢复调度器：all直接执行任务，booker带租约执行任务，web保持暂停只读写任务库
+    init_scheduler_role()
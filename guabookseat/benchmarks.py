@@ -0,0 +1,581 @@
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import click
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from apscheduler.executors.pool import ThreadPoolExecutor as ThreadPoolJobExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+from guabookseat import app, db, scheduler
+from guabookseat.mock_server import MockSeatPlatform, serve_mock_platform
+from guabookseat.models import User, UserConfig, UserCookie
+from guabookseat.process_pool import RoomShardedExecutor
+from guabookseat.scheduled_jobs import auto_booking, async_auto_booking, run_auto_booking
+from guabookseat.seatbooker.async_seat_booker import booking_loop
+from guabookseat.seatbooker.availability_history import AvailabilityHistory
+from guabookseat.seatbooker.seat_allocator import SeatIndex, allocate_seats, choose_seat, is_seat_available
+from guabookseat.seatbooker.seat_booker import BaseSeatBooker, SeatBookerStatus, response_listeners
+from guabookseat.seatbooker.session_registry import session_registry
+from guabookseat.sqlite_tuning import install_sqlite_pragmas, is_sqlite_busy, retry_on_busy, \
+    sqlite_engine_options
+from guabookseat.user_config_cache import user_config_cache
+
+
+def legacy_choose_seat(seat_data, seat_id):
+    # 原search_seat中的线性扫描选座，作为对照
+    target_seat, target_seat_title = "", ""
+    min_abs = 1e10  # 初始值inf
+    for seat in seat_data["POIs"]:
+        cur_seat_title = int(seat['title'])
+        if seat['state'] == 0 or seat['state'] == 2:
+            cur_abs = abs(cur_seat_title - seat_id)
+            if cur_abs == 0:
+                return seat['id'], seat['title']
+            if cur_abs < min_abs:
+                if min_abs - cur_abs > 10 or cur_seat_title % 2:
+                    min_abs = cur_abs
+                    target_seat, target_seat_title = seat['id'], seat['title']
+    return target_seat, target_seat_title
+
+
+def fake_seat_data(seat_num, free_ratio, rng):
+    # 生成一份与searchSeats结构相同的座位快照
+    pois = [{'id': str(100000 + title), 'title': str(title),
+             'state': rng.choice((0, 2)) if rng.random() < free_ratio else 1} for title in range(1, seat_num + 1)]
+    return {'POIs': pois, 'bestPairSeats': {'seats': []}}
+
+
+@app.cli.command()
+@click.option('--seats', default=5000, help='Number of seats in the fake room.')
+@click.option('--users', default=200, help='Number of users querying the same snapshot.')
+@click.option('--free-ratio', default=0.3, help='Ratio of available seats.')
+@click.option('--repeat', default=5, help='Number of snapshots.')
+def bench_seat_index(seats, users, free_ratio, repeat):
+    """Compare the indexed nearest-seat lookup with the linear POIs scan."""
+    rng = random.Random(0)
+    linear_cost, index_cost, build_cost, same = 0.0, 0.0, 0.0, 0
+    for _ in range(repeat):
+        seat_data = fake_seat_data(seats, free_ratio, rng)
+        targets = [rng.randint(1, seats) for _ in range(users)]
+        start = time.perf_counter()
+        linear_result = [legacy_choose_seat(seat_data, target) for target in targets]
+        linear_cost += time.perf_counter() - start
+        start = time.perf_counter()
+        seat_index = SeatIndex(seat_data)
+        build_cost += time.perf_counter() - start
+        start = time.perf_counter()
+        index_result = [seat_index.nearest(target) for target in targets]
+        index_cost += time.perf_counter() - start
+        same += sum(1 for a, b in zip(linear_result, index_result) if a == b)
+    queries = users * repeat
+    click.echo(f"seats={seats} users={users} free_ratio={free_ratio} snapshots={repeat}")
+    click.echo(f"linear scan : {linear_cost * 1e6 / queries:10.1f} us/query")
+    click.echo(f"seat index  : {index_cost * 1e6 / queries:10.1f} us/query "
+               f"(+ {build_cost * 1e3 / repeat:.2f} ms/snapshot to build)")
+    click.echo(f"speedup     : {linear_cost / max(index_cost + build_cost, 1e-9):10.1f}x (including build)")
+    click.echo(f"same choice : {same}/{queries}")
+
+
+def reference_nearest(seat_data, seat_id, taken=()):
+    # 就近选座规则的直接实现，用于校验SeatIndex.nearest：目标座位可选则选中；否则选最近的座位（距离相同时选座位号小的），
+    # 最近的座位不是奇数时改选最近的奇数座位，除非最近的座位比它近10个以上；taken中的座位跳过
+    free = sorted((int(seat['title']), seat['id'], seat['title']) for seat in seat_data["POIs"]
+                  if is_seat_available(seat) and seat['id'] not in taken)
+    if not free:
+        return "", ""
+    distance = lambda seat: (abs(seat[0] - seat_id), seat[0])
+    nearest = min(free, key=distance)
+    if nearest[0] == seat_id or nearest[0] % 2:
+        return nearest[1:]
+    odd = [seat for seat in free if seat[0] % 2]
+    if odd and abs(min(odd, key=distance)[0] - seat_id) - abs(nearest[0] - seat_id) <= 10:
+        return min(odd, key=distance)[1:]
+    return nearest[1:]
+
+
+def room_with_free_seats(titles, seat_num=40):
+    # 只有titles中的座位可选的房间，座位id为'id座位号'
+    pois = [{'id': f'id{title}', 'title': str(title), 'state': 0 if title in titles else 1}
+            for title in range(1, seat_num + 1)]
+    return {'POIs': pois, 'bestPairSeats': {'seats': []}}
+
+
+@app.cli.command()
+@click.option('--rounds', default=200, help='Number of random rooms compared with the reference rule.')
+def check_seat_index(rounds):
+    """Check that nearest-seat choices and wave allocation follow the stated seat rule."""
+    failures = []
+
+    def expect(name, actual, expected):
+        if actual != expected:
+            failures.append(f"{name}: got {actual}, expected {expected}")
+
+    # 目标座位可选则直接选中
+    expect('target free', SeatIndex(room_with_free_seats({11, 12})).nearest(12), ('id12', '12'))
+    # 最近的座位距离相同时选座位号小的（这里也是奇数）
+    expect('tie', SeatIndex(room_with_free_seats({9, 11})).nearest(10), ('id9', '9'))
+    # 最近的偶数座位只近9个，改选奇数座位
+    expect('odd within 10', SeatIndex(room_with_free_seats({14, 23})).nearest(12), ('id23', '23'))
+    # 最近的偶数座位近11个，仍选偶数座位
+    expect('odd too far', SeatIndex(room_with_free_seats({14, 25})).nearest(12), ('id14', '14'))
+    # 没有奇数座位时选最近的座位
+    expect('no odd seat', SeatIndex(room_with_free_seats({4, 12})).nearest(11), ('id12', '12'))
+    # 已分配的座位跳过
+    expect('skip taken', SeatIndex(room_with_free_seats({11, 13})).nearest(11, {'id11'}), ('id13', '13'))
+    expect('no seat', SeatIndex(room_with_free_seats(set())).nearest(11), ("", ""))
+    # 波次分配：目标座位相同的用户只有排在前面的拿到目标座位，其余按同一规则就近分配，互不冲突
+    seat_data = room_with_free_seats({11, 13, 20})
+    expect('allocate same target', allocate_seats(seat_data, [11, 11, 20]),
+           [('id11', '11'), ('id13', '13'), ('id20', '20')])
+    # 恰好可选的目标座位优先于其他用户的就近选座
+    expect('allocate exact first', allocate_seats(seat_data, [12, 13]), [('id11', '11'), ('id13', '13')])
+    expect('allocate taken', allocate_seats(seat_data, [11], taken={'id11'}), [('id13', '13')])
+    expect('choose_seat no preference', choose_seat(seat_data, 0, {'id11'}), ('id13', '13'))
+
+    # 随机房间：各种空座比例下与规则的直接实现逐一比较
+    rng = random.Random(0)
+    for i in range(rounds):
+        seat_data = fake_seat_data(rng.randint(1, 300), rng.choice((0.01, 0.05, 0.1, 0.3, 0.8)), rng)
+        seat_index = SeatIndex(seat_data)
+        available = [seat['id'] for seat in seat_data["POIs"] if is_seat_available(seat)]
+        taken = set(rng.sample(available, rng.randint(0, len(available))))
+        for seat_id in rng.sample(range(1, len(seat_data["POIs"]) + 1), min(10, len(seat_data["POIs"]))):
+            expect(f'random room {i} target {seat_id}', seat_index.nearest(seat_id, taken),
+                   reference_nearest(seat_data, seat_id, taken))
+    for failure in failures[:20]:
+        click.echo(failure)
+    if failures:
+        raise click.ClickException(f"{len(failures)} seat choices break the rule")
+    click.echo("All seat choices follow the rule.")
+
+
+def percentile(values, q):
+    # values已排序，q取0~100
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+# 记录压测过程中每个接口的耗时和每个用户订座成功的时刻
+class BookingRecorder:
+    def __init__(self, usernames):
+        self.usernames = set(usernames)
+        self.lock = threading.Lock()
+        self.latencies = {}  # 接口名 -> [耗时]
+        self.errors = {}  # 接口名 -> 失败次数
+        self.booked_at = {}  # 学号 -> 订座成功的时刻
+
+    def __call__(self, username, name, elapsed, status, response_data):
+        if username not in self.usernames:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if status != SeatBookerStatus.SUCCESS:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if name == 'book_seat' and response_data and response_data.get("CODE") == "ok":
+                self.booked_at.setdefault(username, now)
+
+
+def bench_confs(prefix, users, rooms, seats, rng):
+    return [{
+        'username': f'{prefix}{i:05d}', 'password': 'bench', 'content_id': str(31 + i % rooms), 'start_time': 9,
+        'duration': 5, 'seat_id': rng.randint(0, seats), 'category_id': 591, 'start_time_delta': 1,
+        'duration_delta': 1,
+    } for i in range(users)]
+
+
+def run_booking_round(engine, workers, confs):
+    # 所有用户同时到点，返回(每个用户开始的时刻, 每个用户全部完成的时刻)
+    started_at, done_at = {}, {}
+
+    def thread_job(conf):
+        started_at[conf['username']] = time.perf_counter()
+        try:
+            auto_booking(conf, None)
+        finally:
+            done_at[conf['username']] = time.perf_counter()
+
+    async def async_job(conf):
+        started_at[conf['username']] = time.perf_counter()
+        try:
+            await async_auto_booking(conf, None)
+        finally:
+            done_at[conf['username']] = time.perf_counter()
+
+    if engine == 'async':
+        wait([booking_loop.submit(async_job(conf)) for conf in confs])
+    else:
+        # 与调度器threadpool执行器相同：最多workers个任务同时运行，其余排队
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            wait([executor.submit(thread_job, conf) for conf in confs])
+    return started_at, done_at
+
+
+def cleanup_bench_users(usernames):
+    # 删除压测创建的签到任务、会话和cookie
+    # 压测用户不在数据库中，其签到任务的参数是完整订座信息；真实用户的签到任务参数是用户id，跳过
+    for job in scheduler.get_jobs():
+        if job.id.startswith('checkin_booking_') and job.args and isinstance(job.args[0], dict) and \
+                job.args[0]['username'] in usernames:
+            job.remove()
+    for username in usernames:
+        session_registry.forget(username)
+    UserCookie.query.filter(UserCookie.username.in_(list(usernames))).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def print_booking_report(title, recorder, started_at, done_at, wall, users):
+    booked = [recorder.booked_at[username] - started_at[username] for username in recorder.booked_at]
+    finished = [done_at[username] - started_at[username] for username in recorder.booked_at if username in done_at]
+    click.echo(f"{title}: booked {len(booked)}/{users} in {wall:.2f}s, "
+               f"throughput {len(booked) / max(wall, 1e-9):.1f} bookings/s")
+    click.echo(f"  {'phase':<22}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = [(name, sorted(values), recorder.errors.get(name, 0)) for name, values in recorder.latencies.items()]
+    rows += [('time_to_booked', sorted(booked), 0), ('time_to_checkin_job', sorted(finished), 0)]
+    for name, values, errors in rows:
+        click.echo(f"  {name:<22}{len(values):>7}{errors:>8}{percentile(values, 50) * 1e3:>10.1f}"
+                   f"{percentile(values, 95) * 1e3:>10.1f}{percentile(values, 99) * 1e3:>10.1f}")
+
+
+@app.cli.command()
+@click.option('--users', default=100, help='Number of simulated users.')
+@click.option('--engine', 'engines', multiple=True, type=click.Choice(['thread', 'async', 'speculative']),
+              help='Booking engine to compare, may be repeated. Defaults to thread and async. '
+                   'speculative is the async engine with speculative booking enabled.')
+@click.option('--workers', 'workers_list', multiple=True, type=int,
+              help='Threadpool max_workers for the thread engine, may be repeated. Defaults to the configured value.')
+@click.option('--rooms', default=2, help='Number of rooms the users spread over.')
+@click.option('--seats', default=300, help='Number of seats in every room.')
+@click.option('--latency', default=0.05, help='Mean mock API latency in seconds.')
+@click.option('--jitter', default=0.02, help='Mock API latency jitter in seconds.')
+@click.option('--error-rate', default=0.0, help='Ratio of HTTP 500 responses from the mock API.')
+@click.option('--budget', default=60, help='Retry budget of every booking in seconds.')
+@click.option('--seed', default=0, help='Random seed.')
+def bench_booking(users, engines, workers_list, rooms, seats, latency, jitter, error_rate, budget, seed):
+    """Drive simulated users through auto_booking against the mock platform."""
+    engines = engines or ('thread', 'async')
+    workers_list = workers_list or (app.config['SCHEDULER_EXECUTORS']['default']['max_workers'],)
+    rng = random.Random(seed)
+    platform = MockSeatPlatform(seat_num=seats, latency=latency, latency_jitter=jitter, error_rate=error_rate,
+                                seed=seed)
+    server, base_url = serve_mock_platform(platform)
+    saved = BaseSeatBooker.url_home, app.config['BOOKER_ENGINE'], app.config['RETRY_BUDGET'], \
+        app.config['BOOKER_SPECULATIVE']
+    BaseSeatBooker.url_home = base_url
+    app.config['BOOKER_ENGINE'], app.config['RETRY_BUDGET'] = 'thread', budget
+    click.echo(f"users={users} rooms={rooms} seats={seats} latency={latency}s±{jitter}s error_rate={error_rate}")
+    try:
+        for engine in engines:
+            for workers in (workers_list if engine == 'thread' else (None,)):
+                app.config['BOOKER_SPECULATIVE'] = engine == 'speculative'
+                confs = bench_confs('bench', users, rooms, seats, rng)
+                usernames = {conf['username'] for conf in confs}
+                cleanup_bench_users(usernames)
+                # 第一轮需要登录，第二轮复用cookie
+                for round_name in ('cold login', 'cookie reuse'):
+                    platform.reset()
+                    recorder = BookingRecorder(usernames)
+                    response_listeners.append(recorder)
+                    start = time.perf_counter()
+                    try:
+                        started_at, done_at = run_booking_round('thread' if engine == 'thread' else 'async',
+                                                                workers, confs)
+                    finally:
+                        response_listeners.remove(recorder)
+                    wall = time.perf_counter() - start
+                    name = f"engine={engine}" + (f" workers={workers}" if workers else "") + f" [{round_name}]"
+                    print_booking_report(name, recorder, started_at, done_at, wall, users)
+                cleanup_bench_users(usernames)
+    finally:
+        BaseSeatBooker.url_home = saved[0]
+        app.config['BOOKER_ENGINE'], app.config['RETRY_BUDGET'] = saved[1], saved[2]
+        app.config['BOOKER_SPECULATIVE'] = saved[3]
+        server.shutdown()
+
+
+def run_executor_round(bench_scheduler, confs):
+    # 在同一时刻提交所有用户的auto_booking任务，返回(每个任务从计划时刻到完成的耗时, 总耗时)
+    done_at = {}
+    all_done = threading.Event()
+
+    def on_done(event):
+        done_at[event.job_id] = time.time()
+        if len(done_at) == len(confs):
+            all_done.set()
+
+    bench_scheduler.add_listener(on_done, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+    run_date = datetime.datetime.now() + datetime.timedelta(seconds=1)
+    try:
+        for conf in confs:
+            bench_scheduler.add_job(auto_booking, 'date', run_date=run_date, args=[conf, None], id=conf['username'])
+        all_done.wait()
+    finally:
+        bench_scheduler.remove_listener(on_done)
+    elapsed = sorted(done - run_date.timestamp() for done in done_at.values())
+    return elapsed, elapsed[-1]
+
+
+@app.cli.command()
+@click.option('--users', default=100, help='Number of simulated users.')
+@click.option('--rooms', default=4, help='Number of rooms the users spread over.')
+@click.option('--seats', default=2000, help='Number of seats in every room, larger rooms cost more CPU per search.')
+@click.option('--latency', default=0.05, help='Mean mock API latency in seconds.')
+@click.option('--jitter', default=0.02, help='Mock API latency jitter in seconds.')
+@click.option('--workers', default=None, type=int, help='Threadpool max_workers. Defaults to the configured value.')
+@click.option('--shards', default=None, type=int, help='Number of process pools. Defaults to the configured value.')
+@click.option('--shard-workers', default=None, type=int,
+              help='Worker processes in every process pool. Defaults to the configured value.')
+@click.option('--seed', default=0, help='Random seed.')
+def bench_executor(users, rooms, seats, latency, jitter, workers, shards, shard_workers, seed):
+    """Compare the threadpool executor with the room-sharded process pools."""
+    workers = workers or app.config['SCHEDULER_EXECUTORS']['default']['max_workers']
+    shards = shards or app.config['SCHEDULER_PROCESS_SHARDS']
+    shard_workers = shard_workers or app.config['SCHEDULER_PROCESS_WORKERS']
+    rng = random.Random(seed)
+    platform = MockSeatPlatform(seat_num=seats, latency=latency, latency_jitter=jitter, seed=seed)
+    server, base_url = serve_mock_platform(platform)
+    saved = BaseSeatBooker.url_home, app.config['BOOKER_ENGINE']
+    BaseSeatBooker.url_home = base_url
+    app.config['BOOKER_ENGINE'] = 'thread'
+    click.echo(f"users={users} rooms={rooms} seats={seats} latency={latency}s±{jitter}s")
+    try:
+        for name, make_executor in (
+                (f"threadpool workers={workers}", lambda: ThreadPoolJobExecutor(workers)),
+                (f"process shards={shards}x{shard_workers}",
+                 lambda: RoomShardedExecutor(workers, shards, shard_workers))):
+            confs = bench_confs('bench', users, rooms, seats, rng)
+            usernames = {conf['username'] for conf in confs}
+            cleanup_bench_users(usernames)
+            # 独立的调度器和内存任务库，不影响正式任务
+            bench_scheduler = BackgroundScheduler(jobstores={'default': MemoryJobStore()},
+                                                  executors={'default': make_executor()},
+                                                  job_defaults={'misfire_grace_time': 3600})
+            bench_scheduler.start()
+            try:
+                # 第一轮需要登录（进程池还要启动工作进程），第二轮复用cookie和工作进程
+                for round_name in ('cold', 'warm'):
+                    platform.reset()
+                    elapsed, wall = run_executor_round(bench_scheduler, confs)
+                    booked = sum(1 for booking in platform.bookings.values() if booking['status'] == "0")
+                    click.echo(f"{name} [{round_name}]: booked {booked}/{users} in {wall:.2f}s, "
+                               f"throughput {booked / max(wall, 1e-9):.1f} bookings/s, "
+                               f"job p50 {percentile(elapsed, 50) * 1e3:.0f} ms, "
+                               f"p95 {percentile(elapsed, 95) * 1e3:.0f} ms")
+            finally:
+                bench_scheduler.shutdown()
+            cleanup_bench_users(usernames)
+    finally:
+        BaseSeatBooker.url_home, app.config['BOOKER_ENGINE'] = saved
+        server.shutdown()
+
+
+@app.cli.command()
+@click.option('--requests', 'request_num', default=500, help='Number of index page requests per round.')
+@click.option('--threads', default=4, help='Number of concurrent clients.')
+def bench_pages(request_num, threads):
+    """Measure index pages per second with and without the web user cache."""
+    username = 'bench_pages'
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        user = User(username=username, mail_address='bench@example.com')
+        user.set_password(username)
+        db.session.add(user)
+        db.session.commit()
+    if UserConfig.query.filter_by(id=user.id).first() is None:
+        userconfig = UserConfig()
+        userconfig.set_config({'student_id': 'bench_pages', 'student_pwd': 'bench', 'content_id': 31,
+                               'start_time': 9, 'duration': 5, 'start_time_delta_limit': 0,
+                               'duration_delta_limit': 0, 'target_seat': 0}, user.id)
+        db.session.add(userconfig)
+        db.session.commit()
+    job_id = 'daily_auto_booking_' + str(user.id)
+    scheduler.add_job(id=job_id, func=run_auto_booking, trigger='cron', hour=6, minute=30, args=[user.id],
+                      replace_existing=True)
+    user_id = user.id
+    db.session.remove()
+    clients = []
+    for _ in range(threads):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': username})
+        clients.append(client)
+    saved_ttl = user_config_cache.web_ttl
+    try:
+        for name, web_ttl in (('no cache', 0), ('cached', saved_ttl or 30)):
+            user_config_cache.web_ttl = web_ttl
+            user_config_cache.invalidate(user_id)
+            latencies = []
+            lock = threading.Lock()
+
+            def client_loop(client, count):
+                for _ in range(count):
+                    start = time.perf_counter()
+                    response = client.get('/')
+                    elapsed = time.perf_counter() - start
+                    assert response.status_code == 200
+                    with lock:
+                        latencies.append(elapsed)
+                db.session.remove()
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for future in [executor.submit(client_loop, client, request_num // threads) for client in clients]:
+                    future.result()
+            wall = time.perf_counter() - start
+            latencies.sort()
+            click.echo(f"{name}: {len(latencies) / wall:.1f} pages/s, p50 {percentile(latencies, 50) * 1e3:.2f} ms, "
+                       f"p95 {percentile(latencies, 95) * 1e3:.2f} ms")
+    finally:
+        user_config_cache.web_ttl = saved_ttl
+        scheduler.remove_job(job_id)
+
+
+def storm_engine(url, tuned, busy_timeout):
+    # tuned为False时与调优前一致：回滚日志模式，每次新建连接
+    if not tuned:
+        return create_engine(url, poolclass=NullPool, connect_args={'check_same_thread': False,
+                                                                    'timeout': busy_timeout})
+    engine = create_engine(url, **sqlite_engine_options(url, app.config['DATABASE_POOL_SIZE'],
+                                                        app.config['DATABASE_MAX_OVERFLOW'], busy_timeout))
+    install_sqlite_pragmas(engine, app.config['SQLITE_JOURNAL_MODE'], app.config['SQLITE_SYNCHRONOUS'])
+    return engine
+
+
+@app.cli.command()
+@click.option('--writers', default=16, help='Number of threads saving cookies concurrently.')
+@click.option('--readers', default=4, help='Number of threads reading cookies concurrently.')
+@click.option('--writes', default=100, help='Number of commits per writer thread.')
+@click.option('--busy-timeout', default=1.0, help='Seconds a connection waits for the write lock.')
+def bench_db_storm(writers, readers, writes, busy_timeout):
+    """Compare concurrent SQLite commits before and after WAL, pooling and busy retries."""
+    table = UserCookie.__table__
+    c = table.c
+    for name, tuned in (('rollback journal, no pool', False), ('WAL + pool + retry', True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = storm_engine('sqlite:///' + os.path.join(tmp, 'storm.db'), tuned, busy_timeout)
+            table.create(engine)
+            lock = threading.Lock()
+            stats = {'commits': 0, 'reads': 0, 'locked': 0}
+            latencies = []
+            writing = threading.Event()
+            writing.set()
+
+            def save_cookie(username, i):
+                with engine.begin() as conn:
+                    result = conn.execute(table.update().where(c.username == username).values(
+                        cookie=f'{{"i": {i}}}', expire_time=int(time.time())))
+                    if result.rowcount == 0:
+                        conn.execute(table.insert().values(username=username, cookie='{}',
+                                                           expire_time=int(time.time())))
+
+            save = retry_on_busy(save_cookie) if tuned else save_cookie
+
+            def writer(w):
+                for i in range(writes):
+                    start = time.perf_counter()
+                    try:
+                        save(f'storm{w:03d}', i)
+                    except OperationalError as e:
+                        if not is_sqlite_busy(e):
+                            raise
+                        with lock:
+                            stats['locked'] += 1
+                        continue
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        stats['commits'] += 1
+                        latencies.append(elapsed)
+
+            def reader():
+                while writing.is_set():
+                    try:
+                        with engine.connect() as conn:
+                            conn.execute(table.select()).fetchall()
+                    except OperationalError as e:
+                        if not is_sqlite_busy(e):
+                            raise
+                        with lock:
+                            stats['locked'] += 1
+                        continue
+                    with lock:
+                        stats['reads'] += 1
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=writers + readers) as executor:
+                reader_futures = [executor.submit(reader) for _ in range(readers)]
+                for future in [executor.submit(writer, w) for w in range(writers)]:
+                    future.result()
+                writing.clear()
+                for future in reader_futures:
+                    future.result()
+            wall = time.perf_counter() - start
+            engine.dispose()
+            latencies.sort()
+            click.echo(f"{name}: {stats['commits'] / wall:.1f} commits/s, {stats['reads'] / wall:.1f} reads/s, "
+                       f"{stats['locked']} database is locked errors, "
+                       f"commit p50 {percentile(latencies, 50) * 1e3:.2f} ms, "
+                       f"p95 {percentile(latencies, 95) * 1e3:.2f} ms")
+
+
+def contended_seat_data(seat_num, rng):
+    # 座位号越小越抢手：座位title空闲的概率为title / seat_num
+    pois = [{'id': str(100000 + title), 'title': str(title),
+             'state': 0 if rng.random() < title / seat_num else 1} for title in range(1, seat_num + 1)]
+    return {'POIs': pois, 'bestPairSeats': {'seats': []}}
+
+
+@app.cli.command()
+@click.option('--seats', default=300, help='Number of seats in the fake room.')
+@click.option('--snapshots', default=20000, help='Number of searchSeats results to record.')
+@click.option('--distinct', default=200, help='Number of distinct snapshots the results are drawn from.')
+@click.option('--seed', default=0, help='Random seed.')
+def bench_availability_history(seats, snapshots, distinct, seed):
+    """Measure the cost of recording searchSeats results and how well the history predicts free seats."""
+    rng = random.Random(seed)
+    pool = [{'data': contended_seat_data(seats, rng)} for _ in range(distinct)]
+    begin_time = int(time.mktime(time.localtime()[:3] + (8, 0, 0, 0, 0, -1)))
+    with tempfile.TemporaryDirectory() as tmp:
+        # 对照：在订座线程中直接编码并追加写入
+        inline = AvailabilityHistory(os.path.join(tmp, 'inline'))
+        start = time.perf_counter()
+        for i in range(snapshots):
+            encoded = inline._encode_snapshot(time.time(), 1, begin_time, 3600 * 4, pool[i % distinct]['data'])
+            inline._append(inline._path(1, time.time(), '.snap'), encoded[0])
+        inline_cost = (time.perf_counter() - start) / snapshots
+
+        history = AvailabilityHistory(os.path.join(tmp, 'batched'), flush_interval=3600, min_samples=1)
+        start = time.perf_counter()
+        for i in range(snapshots):
+            history.record_snapshot(1, begin_time, 3600 * 4, pool[i % distinct])
+        record_cost = (time.perf_counter() - start) / snapshots
+        start = time.perf_counter()
+        history.flush()
+        flush_wall = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(history.directory) for name in names)
+
+        start = time.perf_counter()
+        history.load(1)
+        load_wall = time.perf_counter() - start
+        start = time.perf_counter()
+        for item in pool:
+            history.best_seat(1, begin_time, item['data'])
+        best_seat_cost = (time.perf_counter() - start) / distinct
+        errors = [abs(history.seat_free_probability(1, title, begin_time) - title / seats)
+                  for title in range(1, seats + 1)]
+        top = history.ranked_seats(1, begin_time)[:10]
+    click.echo(f"record in booking thread: inline write {inline_cost * 1e6:.1f} us, "
+               f"batched {record_cost * 1e6:.2f} us per search result")
+    click.echo(f"flush {snapshots} results in {flush_wall:.2f} s, {size / snapshots:.1f} bytes per result; "
+               f"load in {load_wall:.2f} s")
+    click.echo(f"best_seat {best_seat_cost * 1e6:.1f} us per call; free probability mean abs error "
+               f"{sum(errors) / len(errors):.3f}; top seats {top}")
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from guabookseat import app, db
+from guabookseat.models import BookingHistory
+from guabookseat.seatbooker.seat_booker import SeatBooker, SeatBookerStatus, response_listeners
+from guabookseat.sqlite_tuning import retry_on_busy
+
+
+# 预约记录缓存：订座、签到、取消等任务每次获取预约记录（myBookingList）时顺便写入BookingHistory表，
+# 查看预约记录页面直接读取缓存，缓存过期或用户要求刷新时在后台线程中重新获取（stale-while-revalidate）
+class BookingHistoryCache:
+    def __init__(self, max_age=300, refresh_workers=4):
+        self.max_age = max_age
+        self.refresh_workers = refresh_workers
+        self.table = BookingHistory.__table__
+        self._lock = threading.Lock()
+        self._refreshing = set()  # 正在后台刷新的学号
+        self._refresh_executor = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='booking-history-writer')
+
+    def observe_response(self, username, endpoint, elapsed, status, response_data):
+        # response_listeners回调：不在订座线程中访问数据库，交给写入线程
+        if endpoint != 'get_my_booking_list' or status != SeatBookerStatus.SUCCESS:
+            return
+        try:
+            records = response_data["content"]["defaultItems"]
+        except (KeyError, TypeError):
+            return
+        self._writer.submit(self._save, username, records, time.time())
+
+    def _save(self, username, records, updated_at):
+        try:
+            self._upsert(username, records, updated_at)
+        except IntegrityError:
+            pass
+        except SQLAlchemyError as e:
+            app.logger.warning(f"UID:{username} save booking history failed:{str(e)}")
+
+    @retry_on_busy
+    def _upsert(self, username, records, updated_at):
+        c = self.table.c
+        values = dict(records=json.dumps(records), updated_at=updated_at)
+        with db.engine.begin() as conn:
+            # 只用更新的结果覆盖，多个进程同时写入时保留最新的一份
+            result = conn.execute(self.table.update().where(
+                c.username == username, c.updated_at < updated_at).values(**values))
+            if result.rowcount == 0:
+                conn.execute(self.table.insert().values(username=username, **values))
+
+    def flush(self):
+        # 等待已提交的写入完成
+        self._writer.submit(lambda: None).result()
+
+    def get(self, username):
+        # 返回(预约记录, 更新时间戳)，没有缓存时返回(None, None)
+        try:
+            with db.engine.connect() as conn:
+                row = conn.execute(self.table.select().where(self.table.c.username == username)).first()
+        except SQLAlchemyError as e:
+            app.logger.warning(f"UID:{username} read booking history failed:{str(e)}")
+            return None, None
+        if row is None:
+            return None, None
+        return json.loads(row.records), row.updated_at
+
+    def is_stale(self, updated_at):
+        return updated_at is None or time.time() - updated_at > self.max_age
+
+    def is_refreshing(self, username):
+        with self._lock:
+            return username in self._refreshing
+
+    def refresh(self, conf):
+        # 在后台线程中重新获取预约记录，同一账号同时只刷新一次
+        username = conf['username']
+        with self._lock:
+            if username in self._refreshing:
+                return False
+            self._refreshing.add(username)
+            if self._refresh_executor is None:
+                self._refresh_executor = ThreadPoolExecutor(max_workers=self.refresh_workers,
+                                                            thread_name_prefix='booking-history-refresh')
+        self._refresh_executor.submit(self._refresh, conf)
+        return True
+
+    def _refresh(self, conf):
+        username = conf['username']
+        try:
+            # 获取成功时由observe_response写入缓存
+            SeatBooker(conf, app.logger).get_my_booking_list()
+            self.flush()
+        except Exception as e:
+            app.logger.warning(f"UID:{username} refresh booking history failed:{str(e)}")
+        finally:
+            db.session.remove()
+            with self._lock:
+                self._refreshing.discard(username)
+
+
+booking_history = BookingHistoryCache(max_age=app.config['BOOKER_HISTORY_MAX_AGE'],
+                                      refresh_workers=app.config['BOOKER_HISTORY_REFRESH_WORKERS'])
+
+
+def init_booking_history():
+    if booking_history.observe_response not in response_listeners:
+        response_listeners.append(booking_history.observe_response)
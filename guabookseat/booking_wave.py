@@ -0,0 +1,232 @@
+import asyncio
+import time
+
+from guabookseat import app, scheduler
+from guabookseat.clock import clock_skew, sync_clock, wait_until
+from guabookseat.job_lease import job_leases
+from guabookseat.scheduled_jobs import async_booking_rounds, async_finish_booking, claim_for_wave, \
+    create_async_fallback_bookers
+from guabookseat.seatbooker.async_seat_booker import AsyncSeatBooker, booking_loop
+from guabookseat.seatbooker.search_cache import search_seat_cache
+from guabookseat.seatbooker.seat_allocator import allocate_seats
+from guabookseat.seatbooker.seat_booker import SeatBookerStatus
+from guabookseat.seatbooker.seat_map import seat_map
+from guabookseat.user_config_cache import user_config_cache
+
+# 最近一次预约波次的报告：{学号: 发令时刻到订座成功的延迟（秒），失败为None}
+last_wave_report = {}
+
+
+def get_due_booking_jobs(target_ts):
+    # 找出下次运行时间恰好为target_ts的每日自动预约任务
+    due_jobs = []
+    for job in scheduler.get_jobs():
+        if not job.id.startswith('daily_auto_booking_') or job.next_run_time is None:
+            continue
+        if int(job.next_run_time.timestamp()) != target_ts:
+            continue
+        conf, receiver = user_config_cache.get_for_job(job)
+        if conf:
+            due_jobs.append((conf, receiver, job))
+    return due_jobs
+
+
+def claim_wave_member(job, student_id, target_ts):
+    # booker进程用租约领取该用户本次的每日任务，领取失败说明已由其他booker处理；单进程时只在本进程内记录
+    if job_leases.active:
+        return job_leases.claim(job.id, job.next_run_time.timestamp(), job.func_ref, job.args)
+    claim_for_wave(student_id, target_ts)
+    return True
+
+
+def finish_wave_members(jobs):
+    if not job_leases.active:
+        return
+    for job in jobs:
+        try:
+            job_leases.finish(job.id, [job.next_run_time.timestamp()])
+        except Exception as e:
+            app.logger.error(f"JOB:{job.id} finish lease failed:{str(e)}")
+
+
+def release_wave_coordinator():
+    # 每分钟提前wave_lead_time秒运行，把下一分钟到点的所有用户合并成一个预约波次
+    now = time.time()
+    target_ts = (int(now) // 60 + 1) * 60
+    if target_ts - now < 2:
+        app.logger.warning(f"RELEASE WAVE for {time.strftime('%H:%M', time.localtime(target_ts))} started too late!")
+        return
+    due_jobs = get_due_booking_jobs(target_ts)
+    if not due_jobs:
+        return
+    report = booking_loop.run(run_release_wave(due_jobs, target_ts))
+    last_wave_report.clear()
+    last_wave_report.update(report)
+
+
+async def warm_up(seat_booker):
+    # 用开销很小的myBookingList请求保持长连接，同时校验cookie是否仍然有效
+    try:
+        status, _ = await seat_booker.get_my_booking_list()
+    except Exception:
+        status = SeatBookerStatus.UNKNOWN_ERROR
+    if status == SeatBookerStatus.SUCCESS:
+        return status
+    return await seat_booker.refresh_login(max_failed_time=2)
+
+
+async def prepare_booker(conf):
+    seat_booker = await AsyncSeatBooker.create(conf, app.logger)
+    if await warm_up(seat_booker) != SeatBookerStatus.SUCCESS:
+        await seat_booker.close()
+        raise RuntimeError("预热失败")
+    return seat_booker
+
+
+def launch_time(target_ts):
+    # 放号时刻以服务器时钟为准，换算为本机时间，返回(本机放号时刻, 本机发令时刻)
+    release_ts = clock_skew.local_time_of(target_ts) if app.config['BOOKER_CLOCK_SYNC'] else target_ts
+    return release_ts, release_ts + app.config['BOOKER_LAUNCH_OFFSET_MS'] / 1000
+
+
+async def keep_warm(seat_bookers, target_ts, interval=15):
+    # 等待发令时刻，期间每interval秒预热一次，最后一次预热在发令前2秒之前完成，返回本机放号时刻
+    while True:
+        remaining = target_ts - time.time()
+        if remaining <= interval + 2:
+            break
+        await asyncio.sleep(interval)
+        await asyncio.gather(*[warm_up(seat_booker) for seat_booker in seat_bookers])
+    # 在服务器整秒边界附近探测几次，用响应头Date校准时钟差，再按高精度定时等到发令时刻
+    if app.config['BOOKER_CLOCK_SYNC'] and seat_bookers:
+        await sync_clock(clock_skew, seat_bookers[0].get_my_booking_list)
+    release_ts, launch_ts = launch_time(target_ts)
+    skew, error = clock_skew.skew()
+    app.logger.info(f"RELEASE WAVE {time.strftime('%H:%M', time.localtime(target_ts))} "
+                    f"clock skew {skew * 1000:+.0f}ms" + (f"±{error * 1000:.0f}ms" if error is not None else "") +
+                    f", launch offset {app.config['BOOKER_LAUNCH_OFFSET_MS']}ms")
+    await wait_until(launch_ts, app.config['BOOKER_SPIN_MARGIN_MS'] / 1000)
+    app.logger.debug(f"RELEASE WAVE launched {(time.time() - launch_ts) * 1000:.2f}ms late")
+    return release_ts
+
+
+async def fire(seat_booker, conf, receiver, target_ts, response_data=None, seat=None, booked_at=None):
+    # booked_at不为None表示发令时已直接订到本地座位表中的目标座位
+    # 否则先用统一分配的座位直接订座，失败后再走常规的search_seat和book_seat流程
+    if booked_at is None and response_data is not None and seat is not None:
+        try:
+            if seat_booker.handle_search_seat_response(response_data, seat) == SeatBookerStatus.SUCCESS and \
+                    await seat_booker.book_seat() == SeatBookerStatus.SUCCESS:
+                booked_at = time.time()
+                app.logger.info(f"UID:{seat_booker.username} BOOK_SEAT #{seat_booker.target_seat_title} SUCCESS!")
+        except Exception as e:
+            app.logger.critical(f"UID:{seat_booker.username} raise an Exception in wave booking:\n{e}!")
+    if booked_at is None:
+        # 已拿到统一搜索结果时，目标座位可选就已分配给该用户，无需再单独试订目标座位
+        # 主订座信息没有订到时，之后每轮同时搜索备选订座信息
+        fallbacks = await create_async_fallback_bookers(conf)
+        try:
+            already_booked, exception_msg, booked_at = await async_booking_rounds(
+                seat_booker, known_seat=response_data is None, fallbacks=fallbacks)
+        finally:
+            await asyncio.gather(*[fallback.close() for fallback in fallbacks])
+    else:
+        already_booked, exception_msg = False, None
+    try:
+        await async_finish_booking(seat_booker, conf, receiver, already_booked, exception_msg)
+    except Exception as e:
+        app.logger.critical(f"UID:{seat_booker.username} raise an Exception in finishing booking:\n{e}!")
+    return booked_at - target_ts if booked_at else None
+
+
+async def book_known_seat(seat_booker):
+    try:
+        if await seat_booker.book_known_seat() == SeatBookerStatus.SUCCESS:
+            return time.time()
+    except Exception as e:
+        app.logger.critical(f"UID:{seat_booker.username} raise an Exception in booking known seat:\n{e}!")
+    return None
+
+
+async def search_group(seat_booker):
+    try:
+        status, search_data = await seat_booker.fetch_search_seat()
+        if status == SeatBookerStatus.SUCCESS and "data" in search_data:
+            return search_data
+    except Exception as e:
+        app.logger.critical(f"UID:{seat_booker.username} raise an Exception in wave searching:\n{e}!")
+    return None
+
+
+async def fire_group(group, target_ts):
+    # 本地座位表中已知目标座位id的用户在发令时刻直接订座（同一目标座位只给排在前面的用户），同时统一搜索一次
+    direct, known_seats = {}, set()
+    for i, (seat_booker, _, _) in enumerate(group):
+        if seat_booker.seat_id != 0 and seat_booker.seat_id not in known_seats and \
+                seat_map.lookup(seat_booker.content_id, seat_booker.seat_id) is not None:
+            known_seats.add(seat_booker.seat_id)
+            direct[i] = book_known_seat(seat_booker)
+    results = await asyncio.gather(search_group(group[0][0]), *direct.values())
+    response_data, booked_at = results[0], dict(zip(direct, results[1:]))
+    # 其余用户用同一份搜索结果分配互不冲突的座位（避开已直接订走的座位）后同时订座
+    seats = [None] * len(group)
+    pending = [i for i in range(len(group)) if booked_at.get(i) is None]
+    if response_data is not None and pending:
+        taken = {group[i][0].target_seat for i in booked_at if booked_at[i] is not None}
+        allocation = allocate_seats(response_data["data"], [group[i][0].seat_id for i in pending], taken)
+        for i, seat in zip(pending, allocation):
+            seats[i] = seat
+    return await asyncio.gather(*[fire(seat_booker, conf, receiver, target_ts, response_data, seat,
+                                       booked_at.get(i))
+                                  for i, ((seat_booker, conf, receiver), seat) in enumerate(zip(group, seats))],
+                                return_exceptions=True)
+
+
+async def run_release_wave(due_jobs, target_ts):
+    target_timestr = time.strftime('%H:%M', time.localtime(target_ts))
+    # 1. 发令前完成所有登录和cookie刷新
+    results = await asyncio.gather(*[prepare_booker(conf) for conf, _, _ in due_jobs], return_exceptions=True)
+    wave, claimed_jobs = [], []
+    loop = asyncio.get_running_loop()
+    for (conf, receiver, job), result in zip(due_jobs, results):
+        if isinstance(result, BaseException):
+            # 准备失败的用户不加入波次，仍由其自身的定时任务处理
+            app.logger.warning(f"UID:{conf['username']} RELEASE WAVE PREPARE FAILED:{result}!")
+            continue
+        # 领取租约需要访问数据库，放到线程池中执行
+        if not await loop.run_in_executor(None, claim_wave_member, job, conf['username'], target_ts):
+            await result.close()
+            continue
+        claimed_jobs.append(job)
+        wave.append((result, conf, receiver))
+    app.logger.info(f"RELEASE WAVE {target_timestr} prepared {len(wave)}/{len(due_jobs)} users!")
+    if not wave:
+        return {}
+    # 2. 保持会话预热直到发令时刻（座位表首次加载需要读数据库，提前完成），3. 按房间和时间段分组，统一分配座位后所有用户同时book_seat
+    try:
+        groups = {}
+        for member in wave:
+            groups.setdefault(search_seat_cache.make_key(member[0].search_seat_data()), []).append(member)
+        if not seat_map.loaded:
+            await asyncio.get_running_loop().run_in_executor(None, seat_map.load)
+        release_ts = await keep_warm([seat_booker for seat_booker, _, _ in wave], target_ts)
+        group_results = await asyncio.gather(*[fire_group(group, release_ts) for group in groups.values()])
+    finally:
+        await asyncio.gather(*[seat_booker.close() for seat_booker, _, _ in wave])
+        await loop.run_in_executor(None, finish_wave_members, claimed_jobs)
+    # 4. 报告每个用户从发令时刻到订座成功的延迟
+    report = {}
+    for group, latencies in zip(groups.values(), group_results):
+        for (seat_booker, _, _), latency in zip(group, latencies):
+            report[seat_booker.username] = latency if isinstance(latency, float) else None
+    for seat_booker, _, _ in wave:
+        if report[seat_booker.username] is None:
+            app.logger.info(f"RELEASE WAVE {target_timestr} UID:{seat_booker.username} NOT BOOKED!")
+        else:
+            app.logger.info(f"RELEASE WAVE {target_timestr} UID:{seat_booker.username} "
+                            f"BOOKED in {report[seat_booker.username] * 1000:.0f}ms!")
+    booked = sorted(latency for latency in report.values() if latency is not None)
+    if booked:
+        app.logger.info(f"RELEASE WAVE {target_timestr} booked {len(booked)}/{len(report)} users, "
+                        f"fastest {booked[0] * 1000:.0f}ms, slowest {booked[-1] * 1000:.0f}ms!")
+    return report
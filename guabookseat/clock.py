@@ -0,0 +1,75 @@
+import asyncio
+import math
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+# 根据自习室平台响应头中的Date估计服务器时钟与本机时钟之差（服务器时间 - 本机时间）
+# Date只精确到秒：服务器在本机[发送时刻, 收到时刻]之间的某一时刻生成响应，且其真实时间在[Date, Date+1)之间，
+# 因此每个样本给出时钟差的一个区间，多个样本的区间取交集后越来越窄，取交集的中点作为估计值
+class ClockSkewEstimator:
+    def __init__(self, max_age=600):
+        self.max_age = max_age  # 超过max_age秒没有样本缩小区间时重新开始估计，以适应时钟漂移
+        self.lock = threading.Lock()
+        self.low = None
+        self.high = None
+        self.updated_at = 0.0
+        self.samples = 0
+
+    def observe(self, date_header, sent_at, received_at):
+        # sent_at、received_at为本机time.time()时间戳
+        if not date_header:
+            return
+        try:
+            server_ts = parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return
+        low, high = server_ts - received_at, server_ts + 1 - sent_at
+        with self.lock:
+            if self.low is None or received_at - self.updated_at > self.max_age or \
+                    low > self.high or high < self.low:
+                # 首个样本、样本过旧或与已有区间矛盾（本机时钟被调整）时重新开始
+                self.low, self.high, self.samples = low, high, 0
+            else:
+                self.low, self.high = max(self.low, low), min(self.high, high)
+            self.updated_at = received_at
+            self.samples += 1
+
+    def skew(self):
+        # 返回(时钟差估计值, 误差半径)，没有样本时返回(0.0, None)
+        with self.lock:
+            if self.low is None:
+                return 0.0, None
+            return (self.low + self.high) / 2, (self.high - self.low) / 2
+
+    def local_time_of(self, server_ts):
+        # 服务器时间server_ts对应的本机时间
+        return server_ts - self.skew()[0]
+
+
+async def wait_until(target_ts, spin_margin=0.02):
+    # 先用asyncio.sleep等到目标时刻前spin_margin秒，再让出事件循环的同时自旋等待，精度不受定时器粒度影响
+    remaining = target_ts - time.time()
+    if remaining > spin_margin:
+        await asyncio.sleep(remaining - spin_margin)
+    while time.time() < target_ts:
+        await asyncio.sleep(0)
+
+
+async def sync_clock(estimator, probe, probes=6, precision=0.005):
+    # 在估计的服务器整秒边界附近发送探测请求probe()（其响应的Date会被estimator记录），每次探测约把时钟差的区间缩小一半
+    rtt = 0.0
+    for _ in range(probes):
+        skew, error = estimator.skew()
+        if error is not None and error <= precision + rtt / 2:
+            break
+        boundary = math.floor(time.time() + skew) + 1
+        await asyncio.sleep(max(0.0, boundary - skew - rtt / 2 - time.time()))
+        sent_at = time.time()
+        await probe()
+        rtt = time.time() - sent_at
+    return estimator.skew()
+
+
+clock_skew = ClockSkewEstimator()
@@ -1,7 +1,12 @@
+import time
+
 import click
 
-from guabookseat import app, db
+from guabookseat import app, db, scheduler
+from guabookseat.job_lease import job_leases, start_booker
+from guabookseat.mock_server import MockSeatPlatform, create_mock_app
 from guabookseat.models import User, UserConfig
+from guabookseat.seatbooker.availability_history import availability_history
 
 
 @app.cli.command()
@@ -78,3 +83,60 @@ def create_admin(password):
         db.session.add(user)
     db.session.commit()
     click.echo('Done.')
+
+
+@app.cli.command()
+@click.option('--host', default='127.0.0.1', help='The interface to bind to.')
+@click.option('--port', default=18080, help='The port to bind to.')
+@click.option('--seats', default=300, help='Number of seats in every room.')
+@click.option('--latency', default=0.05, help='Mean response latency in seconds.')
+@click.option('--jitter', default=0.02, help='Latency jitter in seconds.')
+@click.option('--error-rate', default=0.0, help='Ratio of HTTP 500 responses.')
+@click.option('--json-error-rate', default=0.0, help='Ratio of non-JSON responses.')
+@click.option('--open-hour', default=7, help='Rooms open at this hour, earlier bookings are adjusted.')
+@click.option('--close-hour', default=22, help='Rooms close at this hour, later bookings are adjusted.')
+@click.option('--seed', default=None, type=int, help='Random seed.')
+def mock_server(host, port, seats, latency, jitter, error_rate, json_error_rate, open_hour, close_hour, seed):
+    """Run a local mock of the seat booking platform."""
+    platform = MockSeatPlatform(seat_num=seats, latency=latency, latency_jitter=jitter, error_rate=error_rate,
+                                json_error_rate=json_error_rate, open_hour=open_hour, close_hour=close_hour,
+                                seed=seed)
+    click.echo(f'Set booker.base_url to http://{host}:{port} to book against the mock platform.')
+    create_mock_app(platform).run(host=host, port=port, threaded=True)
+
+
+@app.cli.command()
+def run_booker():
+    """Claim and execute due jobs from the shared job store."""
+    db.create_all()
+    start_booker()
+    click.echo(f'Booker {job_leases.owner} is running, press CTRL+C to quit.')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.shutdown()
+
+
+@app.cli.command()
+@click.option('--room', required=True, type=int, help='content_id of the room.')
+@click.option('--hour', required=True, type=click.IntRange(0, 23), help='Hour the booking starts at.')
+@click.option('--seat', default=None, type=int, help='Show the probability of this seat only.')
+@click.option('--top', default=10, help='Number of seats to list.')
+def seat_history(room, hour, seat, top):
+    """Show how likely seats of a room are free at an hour, learned from recorded searches."""
+    if not availability_history.load(room):
+        click.echo('Loading the availability history timed out.')
+        return
+    begin_time = int(time.mktime(time.localtime()[:3] + (hour, 0, 0, 0, 0, -1)))
+    ratio = availability_history.window_free_ratio(room, begin_time)
+    if ratio is None:
+        click.echo(f'Not enough samples for room {room} at {hour}:00.')
+        return
+    click.echo(f'Room {room} at {hour}:00: {ratio:.1%} of seats free on average.')
+    titles = [seat] if seat is not None else availability_history.ranked_seats(room, begin_time)[:top]
+    for title in titles:
+        click.echo(f'Seat #{title}: free {availability_history.seat_free_probability(room, title, begin_time):.1%}, '
+                   f'booking success {availability_history.seat_booking_rate(room, title, begin_time):.1%}')
@@ -9,3 +9,4 @@ class Constants:
     valid_durations = [x for x in range(3, 16)]
     valid_start_time_delta_limits = [x for x in range(0, 5)]
     valid_duration_delta_limits = [x for x in range(0, 7)]
+    max_booking_profiles = 4  # 每个用户最多的订座信息条数（主订座信息和备选）
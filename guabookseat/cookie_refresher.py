@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from guabookseat import app, db, scheduler
+from guabookseat.seatbooker.seat_booker import SeatBooker, SeatBookerStatus
+from guabookseat.seatbooker.session_registry import session_registry
+from guabookseat.user_config_cache import user_config_cache
+
+# 最近一次cookie刷新的报告：{学号: "valid" / "refreshed" / "failed"}
+last_refresh_report = {}
+
+
+def get_daily_booking_confs():
+    # 每日自动预约任务的(参数配置, 下次运行时间戳)，同一账号只取最早的一个
+    confs = {}
+    for job in scheduler.get_jobs():
+        if not job.id.startswith('daily_auto_booking_') or job.next_run_time is None:
+            continue
+        conf, _ = user_config_cache.get_for_job(job)
+        if not conf:
+            continue
+        next_run_ts = job.next_run_time.timestamp()
+        if conf['username'] not in confs or next_run_ts < confs[conf['username']][1]:
+            confs[conf['username']] = (conf, next_run_ts)
+    return list(confs.values())
+
+
+def probe_cookie(conf):
+    # 用开销很小的myBookingList请求校验cookie是否仍然有效
+    try:
+        status, _ = SeatBooker(conf, app.logger).get_my_booking_list()
+    except Exception:
+        status = SeatBookerStatus.UNKNOWN_ERROR
+    return status == SeatBookerStatus.SUCCESS
+
+
+def refresh_cookie(conf, next_run_ts, probe_before):
+    # cookie在下次预约前会过期则重新登录；下次预约临近时再校验一次cookie，失效则重新登录
+    username = conf['username']
+    try:
+        entry = session_registry.get(username)
+        if entry is not None and entry.expire_time > next_run_ts + app.config['COOKIE_REFRESH_MARGIN']:
+            if next_run_ts - time.time() > probe_before or probe_cookie(conf):
+                return username, "valid"
+        SeatBooker(conf, app.logger, use_saved_cookie=False)
+        return username, "refreshed"
+    except Exception as e:
+        app.logger.warning(f"UID:{username} cookie refresh failed:{str(e)}")
+        return username, "failed"
+    finally:
+        db.session.remove()
+
+
+def cookie_refresher():
+    # 定期扫描所有每日自动预约任务，保证预约时刻不需要登录
+    confs = get_daily_booking_confs()
+    if not confs:
+        return
+    probe_before = app.config['COOKIE_REFRESH_INTERVAL'] * 60 * 2
+    # 限制并发，避免同时登录过多账号
+    with ThreadPoolExecutor(max_workers=app.config['COOKIE_REFRESH_CONCURRENCY'],
+                            thread_name_prefix='cookie-refresher') as executor:
+        report = dict(executor.map(lambda item: refresh_cookie(item[0], item[1], probe_before), confs))
+    # 立即写回数据库，不等待批量写回
+    session_registry.flush()
+    last_refresh_report.clear()
+    last_refresh_report.update(report)
+    refreshed = sum(1 for result in report.values() if result == "refreshed")
+    failed = sum(1 for result in report.values() if result == "failed")
+    if refreshed or failed:
+        app.logger.info(f"COOKIE REFRESHER checked:{len(report)} refreshed:{refreshed} failed:{failed}")
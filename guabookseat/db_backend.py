@@ -0,0 +1,25 @@
+from guabookseat.sqlite_tuning import sqlite_engine_options
+
+
+def database_url(url, default_path):
+    # 未配置数据库地址时使用本地SQLite文件
+    if not url:
+        return "sqlite:///" + default_path
+    # SQLAlchemy 1.4不再接受postgres://（部分托管平台提供的地址仍是这种写法）
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def engine_options(url, pool_size=10, max_overflow=30, pool_recycle=1800, pool_pre_ping=True, busy_timeout=15):
+    # 返回create_engine的参数：SQLite见sqlite_engine_options，
+    # Postgres/MySQL等服务器数据库按pool_size、max_overflow建立连接池，
+    # 连接超过pool_recycle秒后重建以免被服务器的空闲超时断开，pool_pre_ping在取出连接时检测连接是否可用
+    if url.startswith('sqlite'):
+        return sqlite_engine_options(url, pool_size, max_overflow, busy_timeout)
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': pool_pre_ping,
+    }
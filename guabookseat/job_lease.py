@@ -0,0 +1,212 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from apscheduler.events import JobExecutionEvent
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.base import STATE_PAUSED, STATE_RUNNING, STATE_STOPPED
+from apscheduler.util import ref_to_obj
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+from guabookseat import app, db, scheduler
+from guabookseat.models import JobLease
+from guabookseat.process_pool import RoomShardedExecutor
+from guabookseat.sqlite_tuning import retry_on_busy
+
+# 本进程未抢到租约、由其他booker执行的任务
+EVENT_JOB_LEASE_LOST = 2 ** 20
+
+
+# 任务租约：同一任务的同一次运行只有抢到租约的进程执行，持有者定期续约，失联后租约过期可被接管
+class JobLeaseStore:
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.active = False  # 本进程作为booker运行时才使用租约
+        self.table = JobLease.__table__
+
+    @retry_on_busy
+    def claim(self, job_id, run_ts, func_ref=None, args=None):
+        # 领取任务job_id在run_ts时刻的运行，成功返回True
+        now = time.time()
+        try:
+            args = json.dumps(list(args)) if args is not None else None
+        except (TypeError, ValueError):
+            args = None  # 参数无法序列化时不能被接管
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(self.table.insert().values(job_id=job_id, run_time=run_ts, owner=self.owner,
+                                                        leased_until=now + self.ttl, attempts=1,
+                                                        func_ref=func_ref, args=args))
+            return True
+        except IntegrityError:
+            pass
+        # 已被领取：持有者失联（租约过期且未完成）时接管
+        with db.engine.begin() as conn:
+            result = conn.execute(self.table.update().where(and_(
+                self.table.c.job_id == job_id, self.table.c.run_time == run_ts,
+                self.table.c.finished_at.is_(None), self.table.c.leased_until < now,
+            )).values(owner=self.owner, leased_until=now + self.ttl, attempts=self.table.c.attempts + 1))
+        return result.rowcount == 1
+
+    @retry_on_busy
+    def finish(self, job_id, run_ts_list=None):
+        # 标记本进程持有的租约已完成，run_ts_list为None时标记该任务的全部租约
+        conditions = [self.table.c.job_id == job_id, self.table.c.owner == self.owner,
+                      self.table.c.finished_at.is_(None)]
+        if run_ts_list is not None:
+            if not run_ts_list:
+                return
+            conditions.append(self.table.c.run_time.in_(list(run_ts_list)))
+        with db.engine.begin() as conn:
+            conn.execute(self.table.update().where(and_(*conditions)).values(finished_at=time.time()))
+
+    @retry_on_busy
+    def heartbeat(self):
+        # 续约本进程持有的所有未完成租约
+        with db.engine.begin() as conn:
+            conn.execute(self.table.update().where(and_(
+                self.table.c.owner == self.owner, self.table.c.finished_at.is_(None),
+            )).values(leased_until=time.time() + self.ttl))
+
+    def expired(self, since):
+        # 计划运行时间晚于since、持有者失联且未完成的租约
+        with db.engine.connect() as conn:
+            return conn.execute(self.table.select().where(and_(
+                self.table.c.finished_at.is_(None), self.table.c.leased_until < time.time(),
+                self.table.c.run_time > since, self.table.c.func_ref.isnot(None),
+            ))).fetchall()
+
+    @retry_on_busy
+    def purge(self, before):
+        # 删除早于before完成的租约
+        with db.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self.table.c.finished_at < before))
+
+
+job_leases = JobLeaseStore(ttl=app.config['SCHEDULER_LEASE_TTL'])
+
+
+# 带租约的执行器：多个booker进程的调度器都会提交同一个到期任务，只执行抢到租约的运行
+class LeasingExecutorMixin:
+    def _do_submit_job(self, job, run_times):
+        claimed = []
+        for run_time in run_times:
+            try:
+                if job_leases.claim(job.id, run_time.timestamp(), job.func_ref, job.args):
+                    claimed.append(run_time)
+            except Exception as e:
+                app.logger.error(f"JOB:{job.id} claim lease failed:{str(e)}")
+        lost = [run_time for run_time in run_times if run_time not in claimed]
+        if lost:
+            # 调度器提交后计数加1，这里先减1（submit_job持有可重入锁），与正常结束时一致
+            self._run_job_success(job.id, [JobExecutionEvent(EVENT_JOB_LEASE_LOST, job.id, job._jobstore_alias,
+                                                              run_time) for run_time in lost])
+            if not claimed:
+                return
+            self._instances[job.id] += 1
+        super()._do_submit_job(job, claimed)
+
+    def _run_job_success(self, job_id, events):
+        finished = [event.scheduled_run_time.timestamp() for event in events if event.code != EVENT_JOB_LEASE_LOST]
+        try:
+            job_leases.finish(job_id, finished)
+        except Exception as e:
+            app.logger.error(f"JOB:{job_id} finish lease failed:{str(e)}")
+        super()._run_job_success(job_id, events)
+
+    def _run_job_error(self, job_id, exc, traceback=None):
+        try:
+            job_leases.finish(job_id)
+        except Exception as e:
+            app.logger.error(f"JOB:{job_id} finish lease failed:{str(e)}")
+        super()._run_job_error(job_id, exc, traceback)
+
+
+class LeasingThreadPoolExecutor(LeasingExecutorMixin, ThreadPoolExecutor):
+    pass
+
+
+class LeasingRoomShardedExecutor(LeasingExecutorMixin, RoomShardedExecutor):
+    pass
+
+
+def run_recovered(lease):
+    # 执行从失联进程接管的任务
+    try:
+        ref_to_obj(lease.func_ref)(*json.loads(lease.args or "[]"))
+        app.logger.info(f"JOB:{lease.job_id} RECOVERED from {lease.owner}!")
+    except Exception as e:
+        app.logger.critical(f"JOB:{lease.job_id} raise an Exception in recovered run:\n{e}!")
+    finally:
+        job_leases.finish(lease.job_id, [lease.run_time])
+        db.session.remove()
+
+
+def booker_heartbeat():
+    # booker后台线程：定期唤醒调度器以发现其他进程写入的任务，续约，并接管失联进程仍在宽限时间内的任务
+    last_heartbeat = 0.0
+    while True:
+        time.sleep(app.config['SCHEDULER_WAKEUP_INTERVAL'])
+        scheduler.scheduler.wakeup()
+        now = time.time()
+        if now - last_heartbeat < app.config['SCHEDULER_HEARTBEAT_INTERVAL']:
+            continue
+        last_heartbeat = now
+        try:
+            job_leases.heartbeat()
+            grace_time = app.config['SCHEDULER_JOB_DEFAULTS']['misfire_grace_time']
+            for lease in job_leases.expired(now - grace_time):
+                if job_leases.claim(lease.job_id, lease.run_time):
+                    app.logger.warning(f"JOB:{lease.job_id} lease of {lease.owner} expired, take over!")
+                    scheduler.scheduler._lookup_executor('default')._pool.submit(run_recovered, lease)
+            job_leases.purge(now - 86400)
+        except Exception as e:
+            app.logger.error(f"booker heartbeat failed:{str(e)}")
+
+
+booker_thread = None
+booker_lock = threading.Lock()
+
+
+def start_booker():
+    # 本进程作为booker执行到期任务
+    global booker_thread
+    with booker_lock:
+        if booker_thread is not None:
+            return
+        state = scheduler.state
+        executor = scheduler.scheduler._lookup_executor('default')
+        if not isinstance(executor, LeasingExecutorMixin):
+            if state == STATE_RUNNING:
+                scheduler.pause()
+            scheduler.scheduler.remove_executor('default')
+            max_workers = app.config['SCHEDULER_EXECUTORS']['default']['max_workers']
+            if isinstance(executor, RoomShardedExecutor):
+                executor = LeasingRoomShardedExecutor(max_workers, executor.shards, executor.shard_workers)
+            else:
+                executor = LeasingThreadPoolExecutor(max_workers)
+            scheduler.scheduler.add_executor(executor, 'default')
+        if state == STATE_STOPPED:
+            # 调试模式下Flask-APScheduler不会启动调度器，booker需要自行启动
+            scheduler.scheduler.start(paused=True)
+        job_leases.active = True
+        booker_thread = threading.Thread(target=booker_heartbeat, name='booker-heartbeat', daemon=True)
+        booker_thread.start()
+        scheduler.resume()
+    app.logger.info(f"BOOKER {job_leases.owner} started!")
+
+
+def init_scheduler_role():
+    role = app.config['SCHEDULER_ROLE']
+    if role == 'booker':
+        start_booker()
+    elif role == 'web':
+        # 调度器保持暂停，只读写任务库，由booker进程执行任务
+        pass
+    elif scheduler.state == STATE_PAUSED:
+        scheduler.resume()
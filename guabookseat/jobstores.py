@@ -0,0 +1,27 @@
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+
+from guabookseat.sqlite_tuning import retry_on_busy
+
+
+# 多个进程共用同一个任务库：到期任务会被每个booker进程的调度器各自更新下次运行时间或删除，
+# 其他进程已删除的任务再更新或删除时忽略找不到任务的错误，否则调度器线程会因异常退出
+# 写入遇到database is locked时重试
+class SharedSQLAlchemyJobStore(SQLAlchemyJobStore):
+    @retry_on_busy
+    def add_job(self, job):
+        super().add_job(job)
+
+    @retry_on_busy
+    def update_job(self, job):
+        try:
+            super().update_job(job)
+        except JobLookupError:
+            pass
+
+    @retry_on_busy
+    def remove_job(self, job_id):
+        try:
+            super().remove_job(job_id)
+        except JobLookupError:
+            pass
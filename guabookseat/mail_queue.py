@@ -0,0 +1,220 @@
+import atexit
+import os
+import smtplib
+import socket
+import threading
+import time
+import uuid
+
+from flask_mail import Message
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from guabookseat import app, db, mail
+from guabookseat.models import MailOutbox
+from guabookseat.sqlite_tuning import retry_on_busy
+
+
+# 发件队列：send_mail只把邮件放入内存队列并立即返回，后台发送线程把邮件写入MailOutbox表，
+# 再分批领取到期的邮件，复用同一个SMTP连接发送，失败时按指数退避重试
+# 进程退出或崩溃后未发送的邮件由任意进程的发送线程领取后继续发送
+class MailQueue:
+    def __init__(self, batch_size=20, max_attempts=5, retry_delay=30, keepalive=60, poll_interval=10,
+                 claim_ttl=300):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.keepalive = keepalive  # SMTP连接空闲超过keepalive秒后关闭
+        self.poll_interval = poll_interval  # 没有新邮件时每poll_interval秒检查一次发件箱中需要重试的邮件
+        self.claim_ttl = claim_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.table = MailOutbox.__table__
+        self._pending = []  # 尚未写入发件箱的(标题, 正文, 收件人)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sender = None
+        self._connection = None  # Flask-Mail的Connection，保持打开
+        self._connection_used_at = 0.0
+        self._purged_at = 0.0
+
+    def put(self, title, body, receiver):
+        with self._lock:
+            self._pending.append((title, body, receiver))
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        if self._sender is not None:
+            return
+        with self._lock:
+            if self._sender is not None:
+                return
+            self._sender = threading.Thread(target=self._send_forever, name='mail-queue-sender', daemon=True)
+            self._sender.start()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def _send_forever(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.process()
+            except Exception as e:
+                app.logger.error(f"MailQueue process failed:{str(e)}")
+
+    def process(self):
+        # 写入新邮件，发送所有到期的邮件，返回发送成功的数量
+        self.persist_pending()
+        sent = 0
+        while True:
+            batch = self._claim()
+            if batch:
+                sent += self._send_batch(batch)
+            if len(batch) < self.batch_size:
+                break
+        if self._connection is not None and time.monotonic() - self._connection_used_at > self.keepalive:
+            self._close_connection()
+        self._purge()
+        return sent
+
+    def persist_pending(self):
+        with self._lock:
+            messages, self._pending = self._pending, []
+        if not messages:
+            return
+        try:
+            self._insert(messages)
+        except SQLAlchemyError as e:
+            # 发件箱表尚未创建（需执行flask initdb）时直接发送一次，不持久化也不重试
+            app.logger.error(f"MailQueue persist {len(messages)} mails failed, send directly:{str(e)}")
+            with app.app_context():
+                for title, body, receiver in messages:
+                    error = self._deliver(receiver, title, body)
+                    if error:
+                        app.logger.error(f"send_email to {receiver} failed:{error}")
+
+    @retry_on_busy
+    def _insert(self, messages):
+        now = time.time()
+        with db.engine.begin() as conn:
+            conn.execute(self.table.insert(), [
+                dict(receiver=receiver, title=title, body=body, created_at=now, attempts=0,
+                     next_attempt_at=now) for title, body, receiver in messages])
+
+    @retry_on_busy
+    def _claim(self):
+        # 领取最多batch_size封到期、未被其他进程领取的邮件
+        now = time.time()
+        claimed_until = now + self.claim_ttl
+        c = self.table.c
+        due = and_(c.sent_at.is_(None), c.failed_at.is_(None), c.next_attempt_at <= now,
+                   or_(c.claimed_until.is_(None), c.claimed_until < now))
+        with db.engine.begin() as conn:
+            ids = [row.mid for row in conn.execute(select(c.mid).where(due).order_by(c.mid).limit(self.batch_size))]
+            if not ids:
+                return []
+            conn.execute(self.table.update().where(and_(c.mid.in_(ids), due)).values(
+                claimed_by=self.owner, claimed_until=claimed_until))
+            return conn.execute(self.table.select().where(and_(
+                c.mid.in_(ids), c.claimed_by == self.owner, c.claimed_until == claimed_until,
+            )).order_by(c.mid)).fetchall()
+
+    def _send_batch(self, rows):
+        sent_ids, failures = [], []
+        with app.app_context():
+            for i, row in enumerate(rows):
+                error = self._deliver(row.receiver, row.title, row.body)
+                if error is None:
+                    sent_ids.append(row.mid)
+                    continue
+                failures.append((row, error))
+                if self._connection is None:
+                    # 连接不上邮件服务器，本批其余邮件不再尝试，一起退避
+                    failures.extend((rest, error) for rest in rows[i + 1:])
+                    break
+        self._record_results(sent_ids, failures)
+        return len(sent_ids)
+
+    @retry_on_busy
+    def _record_results(self, sent_ids, failures):
+        # 记录发送结果；邮件已经发出，写入遇到database is locked时只重试写入
+        now = time.time()
+        c = self.table.c
+        with db.engine.begin() as conn:
+            if sent_ids:
+                conn.execute(self.table.update().where(c.mid.in_(sent_ids)).values(
+                    sent_at=now, claimed_by=None, claimed_until=None))
+            for row, error in failures:
+                attempts = row.attempts + 1
+                give_up = attempts >= self.max_attempts
+                conn.execute(self.table.update().where(c.mid == row.mid).values(
+                    attempts=attempts, next_attempt_at=now + min(self.retry_delay * 2 ** (attempts - 1), 3600),
+                    failed_at=now if give_up else None, last_error=error[:256], claimed_by=None,
+                    claimed_until=None))
+                if give_up:
+                    app.logger.error(f"send_email to {row.receiver} failed {attempts} times, give up:{error}")
+                else:
+                    app.logger.warning(f"send_email to {row.receiver} failed, will retry:{error}")
+
+    def _deliver(self, receiver, title, body):
+        # 用保持打开的连接发送一封邮件，成功返回None，失败返回错误信息；需在app_context中调用
+        msg = Message(subject=title, recipients=[receiver], body=body, sender=app.config['MAIL_DEFAULT_SENDER'])
+        error = None
+        for _ in range(2):
+            try:
+                if self._connection is None:
+                    connection = mail.connect()
+                    connection.__enter__()
+                    self._connection = connection
+                self._connection.send(msg)
+                self._connection_used_at = time.monotonic()
+                return None
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                # 服务器拒绝了这封邮件，连接仍然可用
+                return str(e)
+            except OSError as e:
+                # 连接被服务器关闭或网络错误（smtplib的异常都是OSError），重新连接后再试一次
+                self._close_connection()
+                error = e
+        return str(error)
+
+    def _close_connection(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def _purge(self):
+        # 每小时删除一次7天前已发送或已放弃的邮件
+        now = time.time()
+        if now - self._purged_at < 3600:
+            return
+        self._purged_at = now
+        c = self.table.c
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(self.table.delete().where(or_(c.sent_at < now - 7 * 86400,
+                                                           c.failed_at < now - 7 * 86400)))
+        except SQLAlchemyError as e:
+            app.logger.warning(f"MailQueue purge failed:{str(e)}")
+
+
+mail_queue = MailQueue(batch_size=app.config['MAIL_QUEUE_BATCH_SIZE'],
+                       max_attempts=app.config['MAIL_QUEUE_MAX_ATTEMPTS'],
+                       retry_delay=app.config['MAIL_QUEUE_RETRY_DELAY'],
+                       keepalive=app.config['MAIL_QUEUE_KEEPALIVE'],
+                       poll_interval=app.config['MAIL_QUEUE_POLL_INTERVAL'])
+# 退出时把尚未写入的邮件写入发件箱，下次启动后继续发送
+atexit.register(mail_queue.persist_pending)
+
+
+def init_mail_queue():
+    # 启动发送线程，继续发送发件箱中上次未发送完的邮件
+    if app.config['MAIL_QUEUE_ENABLED']:
+        mail_queue.start()
+        mail_queue.wakeup()
@@ -0,0 +1,208 @@
+import asyncio
+import functools
+import threading
+import time
+
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, \
+    EVENT_JOB_MAX_INSTANCES
+
+from guabookseat import app, scheduler
+from guabookseat.job_lease import EVENT_JOB_LEASE_LOST
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = {}  # 标签值 -> 计数
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {}  # 标签值 -> [各桶计数, 总和, 总数]
+
+    def observe(self, value, *labelvalues):
+        with self.lock:
+            series = self.values.get(labelvalues)
+            if series is None:
+                series = self.values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labelvalues, (bucket_counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = format_labels(self.labelnames, labelvalues, [('le', bound)])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = format_labels(self.labelnames, labelvalues, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+
+# 取值时才计算的指标，func()返回当前值
+class Gauge:
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+request_seconds = Histogram('guabookseat_request_seconds', 'Latency of seat platform requests.', ('endpoint',))
+request_total = Counter('guabookseat_request_total', 'Seat platform requests by transport status.',
+                        ('endpoint', 'status'))
+loop_result_total = Counter('guabookseat_loop_result_total', 'Final SeatBookerStatus of every booking loop.',
+                            ('loop', 'status'))
+retry_total = Counter('guabookseat_retry_total', 'Failed attempts inside booking loops by SeatBookerStatus.',
+                      ('loop', 'status'))
+scheduler_lag_seconds = Histogram('guabookseat_scheduler_lag_seconds',
+                                  'Delay between the scheduled run time and the submission of a job.', ('job',),
+                                  LAG_BUCKETS)
+scheduler_events_total = Counter('guabookseat_scheduler_events_total', 'Scheduler job events.', ('job', 'event'))
+
+# 已提交但尚未结束的任务数（包括在线程池中排队的）
+jobs_in_flight = {'count': 0}
+jobs_in_flight_lock = threading.Lock()
+
+
+def job_kind(job_id):
+    # daily_auto_booking_3 -> daily_auto_booking，避免每个任务一个标签
+    prefix, _, suffix = job_id.rpartition('_')
+    return prefix if prefix and suffix.isdigit() else job_id
+
+
+def observe_response(username, endpoint, elapsed, status, response_data):
+    request_seconds.observe(elapsed, endpoint)
+    request_total.inc(endpoint, status.name)
+
+
+def on_scheduler_event(event):
+    kind = job_kind(event.job_id)
+    if event.code == EVENT_JOB_SUBMITTED:
+        now = time.time()
+        for run_time in event.scheduled_run_times:
+            scheduler_lag_seconds.observe(max(0.0, now - run_time.timestamp()), kind)
+        with jobs_in_flight_lock:
+            jobs_in_flight['count'] += 1
+        scheduler_events_total.inc(kind, 'submitted')
+    elif event.code in (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_LEASE_LOST):
+        with jobs_in_flight_lock:
+            jobs_in_flight['count'] = max(0, jobs_in_flight['count'] - 1)
+        scheduler_events_total.inc(kind, {EVENT_JOB_EXECUTED: 'executed', EVENT_JOB_ERROR: 'error',
+                                          EVENT_JOB_LEASE_LOST: 'lease_lost'}[event.code])
+    elif event.code == EVENT_JOB_MISSED:
+        scheduler_events_total.inc(kind, 'missed')
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        scheduler_events_total.inc(kind, 'max_instances')
+
+
+def threadpool_queue_size():
+    # 在线程池中排队等待空闲线程的任务数
+    executor = scheduler.scheduler._lookup_executor('default')
+    return executor._pool._work_queue.qsize()
+
+
+metrics = [
+    request_seconds,
+    request_total,
+    loop_result_total,
+    retry_total,
+    scheduler_lag_seconds,
+    scheduler_events_total,
+    Gauge('guabookseat_scheduler_jobs_in_flight', 'Jobs submitted to the executor and not finished yet.',
+          lambda: jobs_in_flight['count']),
+    Gauge('guabookseat_scheduler_threadpool_max_workers', 'Size of the scheduler threadpool.',
+          lambda: app.config['SCHEDULER_EXECUTORS']['default']['max_workers']),
+    Gauge('guabookseat_scheduler_threadpool_queued', 'Jobs waiting for a free scheduler thread.',
+          threadpool_queue_size),
+    Gauge('guabookseat_scheduler_threadpool_busy', 'Scheduler threads running a job.',
+          lambda: max(0, jobs_in_flight['count'] - threadpool_queue_size())),
+]
+
+
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def count_loop_result(loop_name, result):
+    # result为SeatBookerStatus，或第一个元素为SeatBookerStatus的元组
+    stat = result[0] if isinstance(result, tuple) else result
+    loop_result_total.inc(loop_name, stat.name)
+
+
+def instrument_loop(loop_name):
+    # 统计booking循环的最终结果，同时支持普通函数和协程函数
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                result = await func(*args, **kwargs)
+                count_loop_result(loop_name, result)
+                return result
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            count_loop_result(loop_name, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def init_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return
+    from guabookseat.seatbooker.seat_booker import response_listeners
+    if observe_response not in response_listeners:
+        response_listeners.append(observe_response)
+    scheduler.add_listener(on_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR |
+                           EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_LEASE_LOST)
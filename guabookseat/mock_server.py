@@ -0,0 +1,278 @@
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+
+from flask import Flask, request, jsonify
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+
+# 模拟的自习室平台：与SeatBooker解析的JSON结构一致，座位按时间段真实占用，可配置延迟、错误率和开放时间
+class MockSeatPlatform:
+    def __init__(self, rooms=None, seat_num=300, latency=0.05, latency_jitter=0.02, error_rate=0.0,
+                 json_error_rate=0.0, open_hour=7, close_hour=22, endpoint_latency=None, seed=None):
+        # rooms: {content_id: 座位数}，未列出的房间使用seat_num个座位
+        self.rooms = {str(content_id): num for content_id, num in (rooms or {}).items()}
+        self.seat_num = seat_num
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.json_error_rate = json_error_rate
+        self.open_hour = open_hour
+        self.close_hour = close_hour
+        self.endpoint_latency = endpoint_latency or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.users = {}  # login_name -> uid
+        self.sessions = {}  # cookie -> uid
+        self.bookings = {}  # booking_id -> 预约记录
+        self.next_booking_id = 100000
+        self.stats = {}  # 接口 -> 请求次数
+
+    def reset(self):
+        with self.lock:
+            self.bookings.clear()
+            self.stats.clear()
+
+    def room_seat_num(self, content_id):
+        return self.rooms.get(str(content_id), self.seat_num)
+
+    @staticmethod
+    def seat_id(content_id, title):
+        return str(int(content_id) * 100000 + title)
+
+    def delay(self, endpoint):
+        # 模拟网络和服务端处理延迟，返回是否模拟一次服务端错误
+        with self.lock:
+            self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+            latency = self.endpoint_latency.get(endpoint, self.latency)
+            latency = max(0.0, latency + self.random.uniform(-self.latency_jitter, self.latency_jitter))
+            roll = self.random.random()
+        if latency:
+            time.sleep(latency)
+        if roll < self.error_rate:
+            return 'status'
+        if roll < self.error_rate + self.json_error_rate:
+            return 'json'
+        return None
+
+    def adjust(self, begin_time, duration):
+        # 超出开放时间的部分按开放时间调整，返回(是否调整, 开始时间, 时长)
+        day = time.localtime(begin_time)
+        day_start = int(time.mktime((day.tm_year, day.tm_mon, day.tm_mday, 0, 0, 0, 0, 0, -1)))
+        open_time = day_start + 3600 * self.open_hour
+        close_time = day_start + 3600 * self.close_hour
+        valid_begin_time = max(begin_time, open_time)
+        valid_end_time = min(begin_time + duration, close_time)
+        if valid_begin_time == begin_time and valid_end_time == begin_time + duration:
+            return False, begin_time, duration
+        return True, valid_begin_time, max(valid_end_time - valid_begin_time, 0)
+
+    def is_overlapped(self, booking, begin_time, duration):
+        return booking['status'] in ("0", "1") and \
+            booking['time'] < begin_time + duration and begin_time < booking['time'] + booking['duration']
+
+    def occupied_seats(self, content_id, begin_time, duration):
+        # 需持有self.lock
+        return {booking['seat'] for booking in self.bookings.values()
+                if booking['content_id'] == str(content_id) and self.is_overlapped(booking, begin_time, duration)}
+
+    def login(self, login_name):
+        with self.lock:
+            uid = self.users.get(login_name)
+            if uid is None:
+                # uid由账号决定，重启模拟平台后保持不变
+                uid = 10000 + zlib.crc32(login_name.encode()) % 90000000
+                used_uids = set(self.users.values())
+                while uid in used_uids:
+                    uid += 1
+                self.users[login_name] = uid
+            cookie = uuid.uuid4().hex
+            self.sessions[cookie] = uid
+        return uid, cookie
+
+    def current_uid(self, cookie):
+        with self.lock:
+            return self.sessions.get(cookie)
+
+    def search_seats(self, content_id, begin_time, duration):
+        if_adjust, begin_time, duration = self.adjust(begin_time, duration)
+        children = [{}, {"ifAdjust": if_adjust, "adjustDate": begin_time, "adjustTime": duration}]
+        if duration <= 0:
+            return {"content": {"children": children}}
+        with self.lock:
+            occupied = self.occupied_seats(content_id, begin_time, duration)
+        pois = []
+        for title in range(1, self.room_seat_num(content_id) + 1):
+            seat_id = self.seat_id(content_id, title)
+            pois.append({"id": seat_id, "title": str(title), "state": 1 if seat_id in occupied else 0})
+        free_seats = [poi for poi in pois if poi["state"] == 0]
+        if not free_seats:
+            return {"content": {"children": children}}
+        # 系统推荐：中间位置附近的一个空座
+        best = free_seats[len(free_seats) // 2]
+        best["state"] = 2
+        return {"data": {"POIs": pois, "bestPairSeats": {"seats": [{"id": best["id"], "title": best["title"]}]}},
+                "content": {"children": children}}
+
+    def book_seats(self, uid, begin_time, duration, seat_id):
+        try:
+            content_id, title = divmod(int(seat_id), 100000)
+        except (TypeError, ValueError):
+            return {"CODE": "ParamError", "MESSAGE": "座位不存在", "DATA": {"msg": "座位不存在"}}
+        if not 1 <= title <= self.room_seat_num(content_id):
+            return {"CODE": "ParamError", "MESSAGE": "座位不存在", "DATA": {"msg": "座位不存在"}}
+        if_adjust, valid_begin_time, valid_duration = self.adjust(begin_time, duration)
+        if if_adjust:
+            return {"CODE": "ParamError", "MESSAGE": "不在开放时间内", "DATA": {"msg": "不在开放时间内"}}
+        with self.lock:
+            for booking in self.bookings.values():
+                if booking['uid'] == uid and self.is_overlapped(booking, begin_time, duration):
+                    return {"CODE": "ParamError", "MESSAGE": "该时间段已有预约", "DATA": {"msg": "该时间段已有预约"}}
+            if str(seat_id) in self.occupied_seats(content_id, begin_time, duration):
+                return {"CODE": "error", "MESSAGE": "座位已被预约", "DATA": {"msg": "座位已被预约"}}
+            booking_id = str(self.next_booking_id)
+            self.next_booking_id += 1
+            self.bookings[booking_id] = {
+                'id': booking_id, 'uid': uid, 'content_id': str(content_id), 'seat': str(seat_id),
+                'seat_num': str(title), 'time': begin_time, 'duration': duration, 'status': "0",
+            }
+        return {"CODE": "ok", "MESSAGE": "", "DATA": {"msg": "预约成功", "bookingId": booking_id}}
+
+    def my_booking_list(self, uid):
+        with self.lock:
+            records = [booking for booking in self.bookings.values() if booking['uid'] == uid]
+        records.sort(key=lambda booking: int(booking['id']), reverse=True)
+        return {"content": {"defaultItems": [{
+            "id": booking['id'], "status": booking['status'], "time": str(booking['time']),
+            "duration": str(booking['duration']), "seatNum": booking['seat_num'],
+            "roomName": f"自习室{booking['content_id']}",
+        } for booking in records[:10]]}}
+
+    def change_status(self, uid, booking_id, from_status, to_status):
+        # 需要登录用户本人的预约且处于from_status状态
+        with self.lock:
+            booking = self.bookings.get(str(booking_id))
+            if booking is None or booking['uid'] != uid or booking['status'] != from_status:
+                return False
+            booking['status'] = to_status
+            return True
+
+
+def create_mock_app(platform):
+    mock_app = Flask('mock_seat_platform')
+
+    def simulate(endpoint):
+        error = platform.delay(endpoint)
+        if error == 'status':
+            return "Internal Server Error", 500
+        if error == 'json':
+            return "<html>服务器繁忙</html>", 200
+        return None
+
+    def login_required():
+        uid = platform.current_uid(request.cookies.get('PHPSESSID'))
+        # 未登录时与真实平台一样返回登录页面
+        return uid, (None if uid is not None else ("<html>请先登录</html>", 200))
+
+    @mock_app.route('/api/1/login', methods=['POST'])
+    def login():
+        error = simulate('login')
+        if error:
+            return error
+        try:
+            login_data = json.loads(request.get_data())
+        except ValueError:
+            return jsonify({"code": 1, "msg": "参数错误"})
+        if not login_data.get("login_name") or not login_data.get("password"):
+            return jsonify({"code": 1, "msg": "账号或密码错误"})
+        uid, cookie = platform.login(login_data["login_name"])
+        response = jsonify({"mobile": "13800000000", "org_score_info": {"uid": uid}})
+        response.set_cookie('PHPSESSID', cookie)
+        return response
+
+    @mock_app.route('/Seat/Index/searchSeats', methods=['POST'])
+    def search_seats():
+        error = simulate('search_seat')
+        if error:
+            return error
+        uid, error = login_required()
+        if error:
+            return error
+        return jsonify(platform.search_seats(request.form["space_category[content_id]"],
+                                             int(request.form["beginTime"]), int(request.form["duration"])))
+
+    @mock_app.route('/Seat/Index/bookSeats', methods=['POST'])
+    def book_seats():
+        error = simulate('book_seat')
+        if error:
+            return error
+        uid, error = login_required()
+        if error:
+            return error
+        return jsonify(platform.book_seats(uid, int(request.form["beginTime"]), int(request.form["duration"]),
+                                           request.form["seats[0]"]))
+
+    @mock_app.route('/Seat/Index/myBookingList', methods=['GET'])
+    def my_booking_list():
+        error = simulate('get_my_booking_list')
+        if error:
+            return error
+        uid, error = login_required()
+        if error:
+            return error
+        return jsonify(platform.my_booking_list(uid))
+
+    @mock_app.route('/Seat/Index/cancelBooking', methods=['POST'])
+    def cancel_booking():
+        error = simulate('cancel_booking')
+        if error:
+            return error
+        uid, error = login_required()
+        if error:
+            return error
+        if platform.change_status(uid, request.form["bookingId"], "0", "4"):
+            return jsonify({"CODE": "ok", "DATA": {"msg": "取消成功"}})
+        return jsonify({"CODE": "ParamError", "MESSAGE": "预约不存在", "DATA": {"msg": "预约不存在"}})
+
+    @mock_app.route('/Seat/Index/checkIn', methods=['POST'])
+    def checkin_booking():
+        error = simulate('checkin_booking')
+        if error:
+            return error
+        uid, error = login_required()
+        if error:
+            return error
+        if platform.change_status(uid, request.form["bookingId"], "0", "1"):
+            return jsonify({"CODE": "ok", "DATA": {"result": "success", "msg": "签到成功"}})
+        return jsonify({"CODE": "ok", "DATA": {"result": "fail", "msg": "当前预约无法签到"}})
+
+    @mock_app.route('/Seat/Index/checkOut', methods=['POST'])
+    def checkout_booking():
+        error = simulate('checkout_booking')
+        if error:
+            return error
+        uid, error = login_required()
+        if error:
+            return error
+        if platform.change_status(uid, request.form["bookingId"], "1", "3"):
+            return jsonify({"CODE": "ok", "DATA": {"result": "success", "msg": "签退成功"}})
+        return jsonify({"CODE": "ok", "DATA": {"result": "fail", "msg": "当前预约无法签退"}})
+
+    return mock_app
+
+
+# 不输出每个请求的访问日志
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve_mock_platform(platform, host='127.0.0.1', port=0, quiet=True):
+    # 在后台线程中启动模拟平台，返回(server, base_url)，用server.shutdown()停止
+    server = make_server(host, port, create_mock_app(platform), threaded=True,
+                         request_handler=QuietRequestHandler if quiet else None)
+    threading.Thread(target=server.serve_forever, name='mock-seat-platform', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
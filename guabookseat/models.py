@@ -23,9 +23,11 @@ class User(db.Model, UserMixin):  # 表名将会是 user（自动生成，小写
         return check_password_hash(self.password_hash, password)
 
 
+# 订座信息：每个用户可以有多条，按priority从小到大排列，第一条为主订座信息，其余为备选（共用同一个学号）
 class UserConfig(db.Model):
     cid = db.Column(db.Integer, primary_key=True)
-    id = db.Column(db.Integer, ForeignKey('user.id'), unique=True)  # 外键
+    id = db.Column(db.Integer, ForeignKey('user.id'), index=True)  # 外键
+    priority = db.Column(db.Integer, default=0, server_default='0')  # 优先级，越小越优先
     student_id = db.Column(db.String(20))  # 学号
     student_pwd = db.Column(db.String(20))  # 密码
     content_id = db.Column(db.Integer)  # 房间号
@@ -48,6 +50,7 @@ class UserConfig(db.Model):
 
     def get_config(self):
         config_map = {
+            'user_id': self.id,
             'username': self.student_id,
             'password': self.student_pwd,
             'content_id': self.content_id,
@@ -57,9 +60,24 @@ class UserConfig(db.Model):
             'category_id': 591,
             'start_time_delta': self.start_time_delta_limit,
             'duration_delta': self.duration_delta_limit,
+            'priority': self.priority,
         }
         return config_map
 
+    @staticmethod
+    def profiles_config(userconfigs):
+        # 按优先级排好的多条订座信息 -> 主订座信息的参数配置，多于一条时profiles中为全部订座信息的参数配置
+        if not userconfigs:
+            return None
+        config_map = userconfigs[0].get_config()
+        if len(userconfigs) > 1:
+            config_map['profiles'] = [userconfig.get_config() for userconfig in userconfigs]
+        return config_map
+
+    @staticmethod
+    def query_profiles(user_id):
+        return UserConfig.query.filter_by(id=user_id).order_by(UserConfig.priority, UserConfig.cid)
+
 
 class UserCookie(db.Model):
     cid = db.Column(db.Integer, primary_key=True)
@@ -82,3 +100,48 @@ class UserCookie(db.Model):
 
     def get_uid(self):
         return self.uid
+
+
+class SeatMap(db.Model):
+    sid = db.Column(db.Integer, primary_key=True)
+    content_id = db.Column(db.Integer, index=True)  # 房间号
+    title = db.Column(db.Integer)  # 座位号
+    seat_id = db.Column(db.String(20))  # 平台中的座位id
+    updated_at = db.Column(db.Integer)  # 最近一次确认的时间戳
+    __table_args__ = (db.UniqueConstraint('content_id', 'title'),)
+
+
+# 时间戳字段使用双精度浮点数（MySQL中不指定精度的FLOAT为单精度，无法精确保存时间戳）
+class JobLease(db.Model):
+    lid = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(191))  # 任务id
+    run_time = db.Column(db.Float(precision=53))  # 本次计划运行时间戳
+    owner = db.Column(db.String(64))  # 持有租约的进程
+    leased_until = db.Column(db.Float(precision=53))  # 租约到期时间戳，持有者定期续约
+    finished_at = db.Column(db.Float(precision=53))  # 执行完成的时间戳，未完成为None
+    attempts = db.Column(db.Integer, default=1)  # 被领取的次数
+    func_ref = db.Column(db.String(256))  # 任务函数，用于接管失联进程的任务
+    args = db.Column(db.Text)  # 任务参数 json 字符串
+    __table_args__ = (db.UniqueConstraint('job_id', 'run_time'),)
+
+
+class MailOutbox(db.Model):
+    mid = db.Column(db.Integer, primary_key=True)
+    receiver = db.Column(db.String(128))  # 收件人
+    title = db.Column(db.String(256))  # 邮件标题
+    body = db.Column(db.Text)  # 邮件正文
+    created_at = db.Column(db.Float(precision=53))  # 加入发件箱的时间戳
+    attempts = db.Column(db.Integer, default=0)  # 已尝试发送的次数
+    next_attempt_at = db.Column(db.Float(precision=53), index=True)  # 下次可以发送的时间戳
+    claimed_by = db.Column(db.String(64))  # 正在发送该邮件的进程
+    claimed_until = db.Column(db.Float(precision=53))  # 领取到期时间戳，发送进程失联后可被其他进程领取
+    sent_at = db.Column(db.Float(precision=53))  # 发送成功的时间戳，未发送为None
+    failed_at = db.Column(db.Float(precision=53))  # 超过最大尝试次数放弃发送的时间戳
+    last_error = db.Column(db.String(256))  # 最近一次发送失败的原因
+
+
+class BookingHistory(db.Model):
+    hid = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(20), unique=True)  # 自习室账号
+    records = db.Column(db.Text)  # 最近10条预约记录 json 字符串
+    updated_at = db.Column(db.Float(precision=53))  # 获取预约记录的时间戳
@@ -0,0 +1,122 @@
+import concurrent.futures
+import multiprocessing
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from apscheduler.executors.base import run_job
+from apscheduler.executors.pool import ThreadPoolExecutor
+
+# 在进程池中执行的订座任务，第一个参数为用户id或订座信息
+BOOKING_FUNCS = (
+    'guabookseat.scheduled_jobs:run_auto_booking',
+    'guabookseat.scheduled_jobs:auto_booking',
+    'guabookseat.scheduled_jobs:run_seat_booker_func',
+    'guabookseat.scheduled_jobs:call_seat_booker_func',
+)
+AUTO_BOOKING_FUNCS = BOOKING_FUNCS[:2]
+
+
+def init_worker_process(base_url):
+    # 工作进程以spawn方式启动，重新导入guabookseat，拥有独立的数据库连接池、HTTP长连接会话和事件循环
+    # 导入时不会启动调度器、不会注册系统任务（见guabookseat/__init__.py）
+    from guabookseat import app
+    from guabookseat.seatbooker.seat_booker import BaseSeatBooker
+    # 与调度器进程使用同一个自习室平台地址（压测时指向模拟平台）
+    BaseSeatBooker.url_home = base_url
+    app.logger.info(f"BOOKING WORKER {multiprocessing.current_process().name} started!")
+
+
+def job_conf(job):
+    # 订座任务对应的订座信息，旧任务的参数中保存完整订座信息
+    from guabookseat.user_config_cache import user_config_cache
+    if not job.args:
+        return None
+    if isinstance(job.args[0], dict):
+        return job.args[0]
+    return user_config_cache.get(job.args[0])[0]
+
+
+# 订座任务按房间分配到多个进程池（分片）执行，其余任务（系统任务、预约波次等）仍在线程池中执行
+# 同一房间的任务优先交给同一分片，复用该分片进程中的searchSeats缓存、座位表和会话；该分片忙时交给最空闲的分片
+class RoomShardedExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers=10, shards=2, shard_workers=4, pool_kwargs=None):
+        super().__init__(max_workers, pool_kwargs)
+        self.shards = int(shards)
+        self.shard_workers = int(shard_workers)
+        self._shard_lock = threading.Lock()
+        self._process_pools = [None] * self.shards  # 首次使用时才启动工作进程
+        self._shard_load = [0] * self.shards  # 每个分片中已提交但尚未结束的任务数
+        self._room_shards = {}  # content_id -> 分片
+
+    def _process_pool(self, shard):
+        # 需持有self._shard_lock
+        pool = self._process_pools[shard]
+        if pool is None:
+            from guabookseat.seatbooker.seat_booker import BaseSeatBooker
+            pool = concurrent.futures.ProcessPoolExecutor(
+                self.shard_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker_process, initargs=(BaseSeatBooker.url_home,))
+            self._process_pools[shard] = pool
+        return pool
+
+    def _pick_shard(self, room):
+        # 需持有self._shard_lock
+        shard = self._room_shards.get(room)
+        if shard is None or self._shard_load[shard] >= self.shard_workers:
+            least = min(range(self.shards), key=lambda i: self._shard_load[i])
+            if shard is None or self._shard_load[least] < self._shard_load[shard]:
+                shard = least
+            self._room_shards.setdefault(room, shard)
+        return shard
+
+    def _do_submit_job(self, job, run_times):
+        if job.func_ref not in BOOKING_FUNCS:
+            return super()._do_submit_job(job, run_times)
+        from guabookseat.scheduled_jobs import is_wave_claimed
+        try:
+            conf = job_conf(job)
+        except Exception as e:
+            self._logger.error(f"JOB:{job.id} read booking config failed:{str(e)}")
+            conf = None
+        # 没有订座信息的任务直接在线程池中执行并记录错误；已由预约波次代为执行的任务留在本进程消费波次标记
+        if not conf or (job.func_ref in AUTO_BOOKING_FUNCS and is_wave_claimed(conf['username'])):
+            return super()._do_submit_job(job, run_times)
+
+        with self._shard_lock:
+            shard = self._pick_shard(str(conf['content_id']))
+            self._shard_load[shard] += 1
+            pool = self._process_pool(shard)
+
+        def callback(f):
+            with self._shard_lock:
+                self._shard_load[shard] -= 1
+            exc = f.exception()
+            if exc:
+                self._run_job_error(job.id, exc, getattr(exc, '__traceback__', None))
+            else:
+                self._run_job_success(job.id, f.result())
+            # 工作进程中新增的签到、取消等任务已写入任务库，唤醒调度器重新计算下次运行时间
+            self._scheduler.wakeup()
+
+        try:
+            try:
+                f = pool.submit(run_job, job, job._jobstore_alias, run_times, self._logger.name)
+            except BrokenProcessPool:
+                self._logger.warning(f"Process pool of shard {shard} is broken; replacing it with a fresh instance")
+                with self._shard_lock:
+                    self._process_pools[shard] = None
+                    pool = self._process_pool(shard)
+                f = pool.submit(run_job, job, job._jobstore_alias, run_times, self._logger.name)
+        except Exception:
+            with self._shard_lock:
+                self._shard_load[shard] -= 1
+            raise
+        f.add_done_callback(callback)
+
+    def shutdown(self, wait=True):
+        super().shutdown(wait)
+        with self._shard_lock:
+            pools, self._process_pools = self._process_pools, [None] * self.shards
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown(wait)
@@ -1,9 +1,16 @@
+import asyncio
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from flask_mail import Message
 
 from guabookseat import scheduler, mail, app
+from guabookseat.mail_queue import mail_queue
+from guabookseat.seatbooker.async_seat_booker import AsyncSeatBooker, booking_loop
+from guabookseat.seatbooker.retry_policy import make_deadline
 from guabookseat.seatbooker.seat_booker import SeatBooker, SeatBookerStatus
+from guabookseat.user_config_cache import user_config_cache
 
 
 def get_start_end_timestr(start_time, duration):
@@ -15,6 +22,10 @@ def get_start_end_timestr(start_time, duration):
 def send_mail(title, body, receiver):
     if not receiver or type(receiver) != str or receiver == "":
         return
+    # 放入发件队列后立即返回，由后台线程发送
+    if app.config['MAIL_QUEUE_ENABLED']:
+        mail_queue.put(title, body, receiver)
+        return
     msg = Message(subject=title, recipients=[receiver], body=body, sender=app.config['MAIL_DEFAULT_SENDER'])
     try:
         with app.app_context():
@@ -73,9 +84,8 @@ def call_seat_booker_func(conf, func_name, receiver=None, booking_id=None):
             target_end_time = target_begin_time + int(res["duration"])
             checkout_time = time.localtime(target_end_time)  # 自习结束时自动签退
             if not scheduler.get_job(id=job_id):
-                scheduler.add_job(id=job_id, func=call_seat_booker_func, trigger='date',
-                                  run_date=time.strftime("%Y-%m-%d %H:%M:%S", checkout_time),
-                                  args=[conf, 'checkout_booking', receiver, booking_id])
+                add_seat_booker_job(job_id, time.strftime("%Y-%m-%d %H:%M:%S", checkout_time), conf, receiver,
+                                    'checkout_booking', booking_id)
                 app.logger.info(f"UID:{conf['username']} CREATE AUTO_CHECKOUT_JOB SUCCESS!")
             '''
             # 发邮件（签到成功）
@@ -90,9 +100,8 @@ def call_seat_booker_func(conf, func_name, receiver=None, booking_id=None):
             job_id = 'cancel_booking_' + str(booking_id)
             cancel_time = time.localtime(target_begin_time + 60 * 25)  # 开始时间25分钟后如果还没签到就自动取消
             if not scheduler.get_job(id=job_id):
-                scheduler.add_job(id=job_id, func=call_seat_booker_func, trigger='date',
-                                  run_date=time.strftime("%Y-%m-%d %H:%M:%S", cancel_time),
-                                  args=[conf, 'cancel_booking', receiver, booking_id])
+                add_seat_booker_job(job_id, time.strftime("%Y-%m-%d %H:%M:%S", cancel_time), conf, receiver,
+                                    'cancel_booking', booking_id)
                 app.logger.info(f"UID:{conf['username']} CREATE AUTO_CANCEL_JOB SUCCESS!")
             # 发邮件（签到失败）
             title = "[guaBookSeat] 自动签到失败！"
@@ -136,9 +145,145 @@ def call_seat_booker_func(conf, func_name, receiver=None, booking_id=None):
             pass
 
 
+def run_seat_booker_func(user_id, func_name, booking_id=None):
+    # 签到、取消等定时任务只保存用户id，运行时读取最新的订座信息和邮箱
+    conf, receiver = user_config_cache.get(user_id)
+    if not conf:
+        app.logger.error(f"USER:{user_id} has no booking config, skip {func_name}!")
+        return None
+    return call_seat_booker_func(conf, func_name, receiver, booking_id)
+
+
+def add_seat_booker_job(job_id, run_date, conf, receiver, func_name, booking_id):
+    # 任务中只保存用户id和任务类型；没有对应用户的参数配置（如压测）时仍保存完整参数
+    if conf.get('user_id') is not None:
+        scheduler.add_job(id=job_id, func=run_seat_booker_func, trigger='date', run_date=run_date,
+                          args=[conf['user_id'], func_name, booking_id])
+    else:
+        scheduler.add_job(id=job_id, func=call_seat_booker_func, trigger='date', run_date=run_date,
+                          args=[conf, func_name, receiver, booking_id])
+
+
+# 已由预约波次统一执行的用户：{学号: 发令时刻时间戳}
+wave_claims = {}
+wave_claims_lock = threading.Lock()
+
+
+def claim_for_wave(student_id, target_ts):
+    with wave_claims_lock:
+        wave_claims[student_id] = target_ts
+
+
+def is_wave_claimed(student_id):
+    with wave_claims_lock:
+        return student_id in wave_claims
+
+
+def consume_wave_claim(student_id):
+    # 该用户本次的定时任务是否已由预约波次代为执行（一次性）
+    with wave_claims_lock:
+        target_ts = wave_claims.pop(student_id, None)
+    if target_ts is None:
+        return False
+    return target_ts - 5 <= time.time() < target_ts + app.config['SCHEDULER_JOB_DEFAULTS']['misfire_grace_time']
+
+
+def send_booking_failed_mail(receiver, exception_msg):
+    # 发邮件（失败）
+    title = "[guaBookSeat] 预约失败了，快看看啥情况..."
+    body = f"您使用[guaBookSeat]预约位置失败了，请立即用小程序或[guaBookSeat]进行手动预约，并检查[guaBookSeat]的设置！" \
+           f"\n错误提示：{exception_msg}" \
+           f"\n如有bug，请结合错误提示，并与我（发件邮箱）联系。"
+    send_mail(title, body, receiver)
+
+
+def handle_latest_record(conf, receiver, latest_record, exception_msg=None):
+    student_id = conf["username"]
+    if latest_record["status"] == "0":
+        # 创建定时签到任务
+        job_id = 'checkin_booking_' + str(latest_record["id"])
+        checkin_time_stamp = max(int(latest_record["time"]) - 60 * 10,
+                                 int(time.time()) + 60 * 1)  # 提前10分钟或下1分钟，取较晚的一个
+        checkin_time = time.localtime(checkin_time_stamp)  # 自动签到
+        add_seat_booker_job(job_id, time.strftime("%Y-%m-%d %H:%M:%S", checkin_time), conf, receiver,
+                            'checkin_booking', latest_record["id"])
+        app.logger.info(f"UID:{student_id} CREATE AUTO_CHECKIN_JOB SUCCESS!")
+        # 发邮件（成功）
+        mail_tuple = history_to_tuple(latest_record)
+        title = "[guaBookSeat] 抢到座位啦！"
+        body = f"已预约！[{mail_tuple[1]}] 到 [{mail_tuple[2]}] 在 [{mail_tuple[3]}] 的 " \
+               f"[{mail_tuple[4]}号] 座位自习，自习开始前10分钟会自动签到。" \
+               f"\n若预约开始25分钟后还没签到，则会自动取消预约以防止违约。"
+        send_mail(title, body, receiver)
+    else:
+        app.logger.error(f"UID:{student_id} BOOK FAILED!")
+        send_booking_failed_mail(receiver, exception_msg)
+
+
+def create_fallback_bookers(conf, seat_booker):
+    # 备选订座信息的SeatBooker，与主订座信息是同一个账号，使用会话注册表中已有的cookie，不会重复登录
+    fallbacks = []
+    for profile in conf.get('profiles', [])[1:]:
+        try:
+            fallback = SeatBooker(profile, app.logger)
+        except RuntimeError as e:
+            app.logger.critical(f"SeatBooker: {str(e)}")
+            continue
+        fallback.retry_deadline = seat_booker.retry_deadline
+        fallbacks.append(fallback)
+    return fallbacks
+
+
+def search_profiles(seat_bookers):
+    # 同时搜索所有订座信息（各自按时间窗口依次搜索直到有座），返回各自search_seat的结果
+    with ThreadPoolExecutor(max_workers=len(seat_bookers) - 1, thread_name_prefix='profile-search') as executor:
+        futures = [executor.submit(seat_booker.loop_search_seat, max_failed_time=5)
+                   for seat_booker in seat_bookers[1:]]
+        stats = [seat_bookers[0].loop_search_seat(max_failed_time=5)]
+        for seat_booker, future in zip(seat_bookers[1:], futures):
+            try:
+                stats.append(future.result())
+            except Exception as e:
+                app.logger.critical(f"UID:{seat_booker.username} raise an Exception in searching profile:\n{e}!")
+                stats.append(SeatBookerStatus.UNKNOWN_ERROR)
+    return stats
+
+
+def book_profiles(seat_bookers):
+    # 按优先级预订第一个有座的订座信息，订座失败时换下一个有座的订座信息
+    stats = search_profiles(seat_bookers)
+    stat = SeatBookerStatus.LOOP_FAILED
+    for i, (seat_booker, search_stat) in enumerate(zip(seat_bookers, stats)):
+        if search_stat != SeatBookerStatus.SUCCESS:
+            continue
+        stat = seat_booker.loop_book_seat(max_failed_time=10)
+        if stat == SeatBookerStatus.SUCCESS and i > 0:
+            app.logger.info(f"UID:{seat_booker.username} BOOKED FALLBACK PROFILE #{i} ROOM:{seat_booker.content_id}!")
+        if stat in (SeatBookerStatus.SUCCESS, SeatBookerStatus.ALREADY_BOOKED):
+            break
+    return stat
+
+
+def run_auto_booking(user_id, max_retry_time=12):
+    # 每日自动预约任务只保存用户id，运行时读取最新的订座信息和邮箱
+    conf, receiver = user_config_cache.get(user_id)
+    if not conf:
+        app.logger.error(f"USER:{user_id} has no booking config, skip auto booking!")
+        return
+    auto_booking(conf, receiver, max_retry_time)
+
+
 def auto_booking(conf, receiver=None, max_retry_time=12):
     if not conf:
         return
+    # 本次任务已经由预约波次统一执行
+    if consume_wave_claim(conf["username"]):
+        app.logger.info(f"UID:{conf['username']} ALREADY HANDLED BY RELEASE WAVE!")
+        return
+    # 异步引擎：交给共享事件循环执行，不占用调度器的工作线程
+    if app.config['BOOKER_ENGINE'] == 'async':
+        booking_loop.submit(async_auto_booking(conf, receiver, max_retry_time))
+        return
     student_id = conf["username"]
     exception_msg = None
     # 实例化
@@ -146,71 +291,176 @@ def auto_booking(conf, receiver=None, max_retry_time=12):
         seat_booker = SeatBooker(conf, app.logger)
     except RuntimeError as e:
         app.logger.critical(f"SeatBooker: {str(e)}")
-        exception_msg = "登录自习室失败，请检查订座信息中学号和自习室平台密码"
         # 发邮件（登陆失败）
-        title = "[guaBookSeat] 预约失败了，快看看啥情况..."
-        body = f"您使用[guaBookSeat]预约位置失败了，请立即用小程序或[guaBookSeat]进行手动预约，并检查[guaBookSeat]的设置！" \
-               f"\n错误提示：{exception_msg}" \
-               f"\n如有bug，请结合错误提示，并与我（发件邮箱）联系。"
-        send_mail(title, body, receiver)
+        send_booking_failed_mail(receiver, "登录自习室失败，请检查订座信息中学号和自习室平台密码")
         return
 
-    # 总共尝试max_retry_time次search_seat和book_seat的过程
+    # 按重试策略最多尝试max_retry_time轮search_seat和book_seat的过程，总时长受时间预算约束
     already_booked = False
-    retry_time = max_retry_time
-    while retry_time > 0:
+    seat_booker.retry_deadline = make_deadline()
+    # 本地座位表中已有目标座位id时先直接订座
+    stat = None
+    try:
+        stat = seat_booker.book_known_seat()
+    except Exception as e:
+        app.logger.critical(f"UID:{student_id} raise an Exception in booking known seat:\n{e}!")
+    if stat == SeatBookerStatus.ALREADY_BOOKED:
+        already_booked = True
+    retry = seat_booker.retry_policy.start(max_retry_time, seat_booker.retry_deadline, 'booking_round')
+    fallbacks = create_fallback_bookers(conf, seat_booker) \
+        if stat not in (SeatBookerStatus.SUCCESS, SeatBookerStatus.ALREADY_BOOKED) else []
+    while stat not in (SeatBookerStatus.SUCCESS, SeatBookerStatus.ALREADY_BOOKED):
+        stat = SeatBookerStatus.UNKNOWN_ERROR
         try:
-            # 开始search_seat
-            res_search_seat = seat_booker.loop_search_seat(max_failed_time=5)
-            # 若search_seat大失败，直接重新尝试一轮
-            if res_search_seat != SeatBookerStatus.SUCCESS:
-                continue
-            # 开始book_seat
-            res_book_seat = seat_booker.loop_book_seat(max_failed_time=10)
-            # 若已有预约则退出
-            if res_book_seat == SeatBookerStatus.ALREADY_BOOKED:
-                already_booked = True
-                break
-            # 若成功则可以跳出
-            if res_book_seat == SeatBookerStatus.SUCCESS:
-                break
+            if fallbacks:
+                # 有备选订座信息时同时搜索所有订座信息，预订排在最前面的有座的一个
+                stat = book_profiles([seat_booker] + fallbacks)
+            else:
+                # 开始search_seat，成功后开始book_seat
+                stat = seat_booker.loop_search_seat(max_failed_time=5)
+                if stat == SeatBookerStatus.SUCCESS:
+                    stat = seat_booker.loop_book_seat(max_failed_time=10)
         except Exception as e:
             app.logger.critical(f"UID:{student_id} raise an Exception in booking progress:\n{e}!")
             exception_msg = str(e)
-        finally:
-            retry_time -= 1  # 重试机会减少
-            time.sleep(3)
+        # 若已有预约则退出
+        if stat == SeatBookerStatus.ALREADY_BOOKED:
+            already_booked = True
+            break
+        # 若成功则可以跳出
+        if stat == SeatBookerStatus.SUCCESS:
+            break
+        # 重试机会用完或超出时间预算则退出
+        delay = retry.next_delay(stat)
+        if delay is None:
+            break
+        time.sleep(delay)
 
     # 最后获取用户预约信息并发邮件
     if not already_booked:
         status, latest_record = seat_booker.loop_get_latest_record(max_failed_time=5)
         if status != SeatBookerStatus.SUCCESS:
             return
-        if latest_record["status"] == "0":
-            # 创建定时签到任务
-            job_id = 'checkin_booking_' + str(latest_record["id"])
-            checkin_time_stamp = max(int(latest_record["time"]) - 60 * 10,
-                                     int(time.time()) + 60 * 1)  # 提前10分钟或下1分钟，取较晚的一个
-            checkin_time = time.localtime(checkin_time_stamp)  # 自动签到
-            scheduler.add_job(id=job_id, func=call_seat_booker_func, trigger='date',
-                              run_date=time.strftime("%Y-%m-%d %H:%M:%S", checkin_time),
-                              args=[conf, 'checkin_booking', receiver, latest_record["id"]])
-            app.logger.info(f"UID:{student_id} CREATE AUTO_CHECKIN_JOB SUCCESS!")
-            # 发邮件（成功）
-            mail_tuple = history_to_tuple(latest_record)
-            title = "[guaBookSeat] 抢到座位啦！"
-            body = f"已预约！[{mail_tuple[1]}] 到 [{mail_tuple[2]}] 在 [{mail_tuple[3]}] 的 " \
-                   f"[{mail_tuple[4]}号] 座位自习，自习开始前10分钟会自动签到。" \
-                   f"\n若预约开始25分钟后还没签到，则会自动取消预约以防止违约。"
-            send_mail(title, body, receiver)
-        else:
-            app.logger.error(f"UID:{student_id} BOOK FAILED!")
-            # 发邮件（失败）
-            title = "[guaBookSeat] 预约失败了，快看看啥情况..."
-            body = f"您使用[guaBookSeat]预约位置失败了，请立即用小程序或[guaBookSeat]进行手动预约，并检查[guaBookSeat]的设置！" \
-                   f"\n错误提示：{exception_msg}" \
-                   f"\n如有bug，请结合错误提示，并与我（发件邮箱）联系。"
-            send_mail(title, body, receiver)
+        handle_latest_record(conf, receiver, latest_record, exception_msg)
     else:
         # 已有预约
         pass
+
+
+async def create_async_fallback_bookers(conf):
+    # 备选订座信息的AsyncSeatBooker，与主订座信息是同一个账号，使用会话注册表中已有的cookie
+    fallbacks = []
+    for profile in conf.get('profiles', [])[1:]:
+        try:
+            fallbacks.append(await AsyncSeatBooker.create(profile, app.logger))
+        except RuntimeError as e:
+            app.logger.critical(f"AsyncSeatBooker: {str(e)}")
+    return fallbacks
+
+
+async def async_book_profiles(seat_bookers):
+    # 同时搜索所有订座信息，按优先级预订第一个有座的订座信息，订座失败时换下一个有座的订座信息
+    results = await asyncio.gather(*[seat_booker.loop_search_seat(max_failed_time=5)
+                                     for seat_booker in seat_bookers], return_exceptions=True)
+    stat = SeatBookerStatus.LOOP_FAILED
+    for i, (seat_booker, search_stat) in enumerate(zip(seat_bookers, results)):
+        if isinstance(search_stat, BaseException):
+            app.logger.critical(f"UID:{seat_booker.username} raise an Exception in searching profile:\n{search_stat}!")
+            continue
+        if search_stat != SeatBookerStatus.SUCCESS:
+            continue
+        stat = await seat_booker.loop_book_seat(max_failed_time=10)
+        if stat == SeatBookerStatus.SUCCESS and i > 0:
+            app.logger.info(f"UID:{seat_booker.username} BOOKED FALLBACK PROFILE #{i} ROOM:{seat_booker.content_id}!")
+        if stat in (SeatBookerStatus.SUCCESS, SeatBookerStatus.ALREADY_BOOKED):
+            break
+    return stat
+
+
+async def async_booking_rounds(seat_booker, max_retry_time=12, known_seat=True, fallbacks=()):
+    # 按重试策略最多尝试max_retry_time轮search_seat和book_seat的过程，返回(是否已有预约, 异常信息, 订座成功时刻)
+    # known_seat为True时先直接预订本地座位表中的目标座位；fallbacks为备选订座信息的AsyncSeatBooker
+    already_booked = False
+    exception_msg = None
+    booked_at = None
+    if seat_booker.retry_deadline is None:
+        seat_booker.retry_deadline = make_deadline()
+    # 本地座位表中已有目标座位id时先直接订座
+    stat = None
+    try:
+        if known_seat:
+            stat = await seat_booker.book_known_seat()
+    except Exception as e:
+        app.logger.critical(f"UID:{seat_booker.username} raise an Exception in booking known seat:\n{e}!")
+    if stat == SeatBookerStatus.ALREADY_BOOKED:
+        already_booked = True
+    elif stat == SeatBookerStatus.SUCCESS:
+        booked_at = time.time()
+    for fallback in fallbacks:
+        fallback.retry_deadline = seat_booker.retry_deadline
+    retry = seat_booker.retry_policy.start(max_retry_time, seat_booker.retry_deadline, 'booking_round')
+    while stat not in (SeatBookerStatus.SUCCESS, SeatBookerStatus.ALREADY_BOOKED):
+        stat = SeatBookerStatus.UNKNOWN_ERROR
+        try:
+            if fallbacks:
+                # 有备选订座信息时同时搜索所有订座信息，预订排在最前面的有座的一个
+                stat = await async_book_profiles([seat_booker, *fallbacks])
+            elif app.config['BOOKER_SPECULATIVE']:
+                # 同时对多个候选时间窗口和座位订座
+                stat = await seat_booker.speculative_book(app.config['BOOKER_SPECULATIVE_WINDOWS'],
+                                                          app.config['BOOKER_SPECULATIVE_SEATS'],
+                                                          app.config['BOOKER_SPECULATIVE_ATTEMPTS'])
+            else:
+                # 开始search_seat，成功后开始book_seat
+                stat = await seat_booker.loop_search_seat(max_failed_time=5)
+                if stat == SeatBookerStatus.SUCCESS:
+                    stat = await seat_booker.loop_book_seat(max_failed_time=10)
+        except Exception as e:
+            app.logger.critical(f"UID:{seat_booker.username} raise an Exception in booking progress:\n{e}!")
+            exception_msg = str(e)
+        # 若已有预约则退出
+        if stat == SeatBookerStatus.ALREADY_BOOKED:
+            already_booked = True
+            break
+        # 若成功则可以跳出
+        if stat == SeatBookerStatus.SUCCESS:
+            booked_at = time.time()
+            break
+        # 重试机会用完或超出时间预算则退出
+        delay = retry.next_delay(stat)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    return already_booked, exception_msg, booked_at
+
+
+async def async_finish_booking(seat_booker, conf, receiver, already_booked, exception_msg):
+    # 最后获取用户预约信息并发邮件（数据库、调度器和邮件均为阻塞操作，放到线程池中执行）
+    if already_booked:
+        return
+    status, latest_record = await seat_booker.loop_get_latest_record(max_failed_time=5)
+    if status != SeatBookerStatus.SUCCESS:
+        return
+    await asyncio.get_running_loop().run_in_executor(None, handle_latest_record, conf, receiver, latest_record,
+                                                     exception_msg)
+
+
+async def async_auto_booking(conf, receiver=None, max_retry_time=12):
+    # 实例化
+    try:
+        seat_booker = await AsyncSeatBooker.create(conf, app.logger)
+    except RuntimeError as e:
+        app.logger.critical(f"AsyncSeatBooker: {str(e)}")
+        # 发邮件（登陆失败）
+        await asyncio.get_running_loop().run_in_executor(None, send_booking_failed_mail, receiver,
+                                                         "登录自习室失败，请检查订座信息中学号和自习室平台密码")
+        return
+
+    fallbacks = []
+    try:
+        fallbacks = await create_async_fallback_bookers(conf)
+        already_booked, exception_msg, _ = await async_booking_rounds(seat_booker, max_retry_time,
+                                                                      fallbacks=fallbacks)
+        await async_finish_booking(seat_booker, conf, receiver, already_booked, exception_msg)
+    finally:
+        await asyncio.gather(seat_booker.close(), *[fallback.close() for fallback in fallbacks])
@@ -1 +1 @@
-from guabookseat.seatbooker import seat_booker
+from guabookseat.seatbooker import seat_booker, async_seat_booker
@@ -0,0 +1,398 @@
+import asyncio
+import json
+import threading
+import time
+
+import aiohttp
+from yarl import URL
+
+from guabookseat import app
+from guabookseat.clock import clock_skew
+from guabookseat.metrics import instrument_loop
+from guabookseat.seatbooker.search_cache import search_seat_cache
+from guabookseat.seatbooker.seat_booker import BaseSeatBooker, SeatBooker, SeatBookerStatus, response_listeners
+from guabookseat.seatbooker.seat_map import seat_map
+from guabookseat.seatbooker.session_registry import session_registry
+
+
+# 共享事件循环：在一个后台线程中运行，所有AsyncSeatBooker共用同一个长连接池
+class BookingEventLoop:
+    def __init__(self, max_connections=100, keepalive_timeout=60):
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.loop = None
+        self.connector = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self.loop.run_forever, name='booking-event-loop', daemon=True)
+            self._thread.start()
+            # 连接池需要在事件循环内创建
+            asyncio.run_coroutine_threadsafe(self._create_connector(), self.loop).result()
+
+    async def _create_connector(self):
+        self.connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+
+    def submit(self, coro):
+        # 提交协程到共享事件循环，立即返回concurrent.futures.Future
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_exception)
+        return future
+
+    def run(self, coro, timeout=None):
+        # 提交协程并阻塞等待结果
+        return self.submit(coro).result(timeout=timeout)
+
+    @staticmethod
+    def _log_exception(future):
+        if not future.cancelled() and future.exception() is not None:
+            app.logger.critical(f"BookingEventLoop task raise an Exception:\n{future.exception()}")
+
+
+booking_loop = BookingEventLoop(max_connections=app.config['BOOKER_MAX_CONNECTIONS'],
+                                keepalive_timeout=app.config['BOOKER_KEEPALIVE_TIMEOUT'])
+
+
+# AsyncSeatBooker类，在共享事件循环上使用aiohttp异步访问自习室平台
+class AsyncSeatBooker(BaseSeatBooker):
+    def __init__(self, conf, logger=None, connector=None) -> None:
+        super().__init__(conf, logger)
+        self.conf = conf
+        # 每个用户独立的cookie，共用连接池
+        self.proxy = None
+        self.speculative_started = False
+        self.session = aiohttp.ClientSession(connector=connector or booking_loop.connector, connector_owner=False,
+                                             headers=self.fake_header, cookie_jar=aiohttp.CookieJar(unsafe=True))
+
+    @classmethod
+    async def create(cls, conf, logger=None, connector=None):
+        # 必须在事件循环内实例化，并完成cookie设置
+        seat_booker = cls(conf, logger, connector)
+        try:
+            await seat_booker.prepare_cookie()
+        except BaseException:
+            await seat_booker.close()
+            raise
+        return seat_booker
+
+    async def prepare_cookie(self):
+        entry = session_registry.peek(self.username)
+        if entry is None:
+            # 内存未命中时读数据库会阻塞，放到线程池中执行
+            entry = await asyncio.get_running_loop().run_in_executor(None, session_registry.get, self.username)
+        if entry is not None and not entry.is_expired():
+            # 使用注册表中的cookie
+            self.session.cookie_jar.update_cookies(entry.cookie, URL(self.url_home))
+            self.uid = entry.uid
+            if session_registry.needs_refresh(entry):
+                # cookie临近过期，在后台线程中提前重新登录
+                conf, logger = self.conf, self.logger
+                session_registry.schedule_refresh(self.username, lambda: SeatBooker(conf, logger,
+                                                                                    use_saved_cookie=False))
+            return
+        # 登录并保存cookie
+        stat = await self.refresh_login()
+        if stat != SeatBookerStatus.SUCCESS:
+            raise RuntimeError("cookie过期且登陆失败" if entry is not None else "无cookie且登陆失败")
+
+    async def refresh_login(self, max_failed_time=5):
+        # 重新登录，成功后更新会话注册表（稍后批量写回数据库）
+        stat = await self.loop_login(max_failed_time=max_failed_time)
+        if stat != SeatBookerStatus.SUCCESS:
+            return stat
+        session_registry.put(self.username, self.get_cookie_dict(), self.uid)
+        return SeatBookerStatus.SUCCESS
+
+    def get_cookie_dict(self):
+        return {cookie.key: cookie.value for cookie in self.session.cookie_jar}
+
+    async def close(self):
+        await self.session.close()
+
+    async def get_remote_response(self, url='', method='get', data=None):
+        start = time.perf_counter()
+        status, response_data = await self._get_remote_response(url, method, data)
+        if response_listeners:
+            self.notify_response(url, time.perf_counter() - start, status, response_data)
+        return status, response_data
+
+    async def _get_remote_response(self, url='', method='get', data=None):
+        if method not in ("post", "get"):
+            self.logger.error(f"UID:{self.username} url:{url} method:{method} not in (post, get)")
+
+        # 尝试post/get
+        sent_at = time.time()
+        try:
+            if method == "post":
+                response = await self.session.post(url=url, data=data, proxy=self.proxy)
+            else:
+                response = await self.session.get(url=url, proxy=self.proxy, timeout=aiohttp.ClientTimeout(total=5))
+        except asyncio.TimeoutError:
+            return SeatBookerStatus.TIME_OUT, None
+        except aiohttp.ClientSSLError:
+            return SeatBookerStatus.PROXY_ERROR, None
+        except Exception as e:
+            self.logger.error(f"UID:{self.username} url:{url} {method} error:{str(e)}")
+            return SeatBookerStatus.UNKNOWN_ERROR, None
+        # 用响应头中的Date估计服务器时钟差
+        clock_skew.observe(response.headers.get('Date'), sent_at, time.time())
+        async with response:
+            # 检查status_code
+            if response.status != 200:
+                self.logger.warning(f"UID:{self.username} url:{url} status_code != 200!")
+                return SeatBookerStatus.STATUS_CODE_ERROR, None
+            # 尝试解码response为response_data
+            try:
+                response_data = await response.json(content_type=None)
+            except json.JSONDecodeError:
+                self.logger.error(f"UID:{self.username} url:{url} json.JSONDecodeError")
+                return SeatBookerStatus.JSON_DECODE_ERROR, None
+            except asyncio.TimeoutError:
+                return SeatBookerStatus.TIME_OUT, None
+            except Exception as e:
+                self.logger.error(f"UID:{self.username} url:{url} decode error:{str(e)}")
+                return SeatBookerStatus.UNKNOWN_ERROR, None
+
+        return SeatBookerStatus.SUCCESS, response_data
+
+    async def login(self):
+        # POST login
+        status, response_data = await self.get_remote_response(url=self.urls['login'], method="post",
+                                                               data=json.dumps(self.login_data()))
+        if status != SeatBookerStatus.SUCCESS:
+            return status
+        return self.handle_login_response(response_data)
+
+    async def fetch_search_seat(self, window=None):
+        # POST search_seat（相同房间和时间段的搜索结果在多个用户间共享）
+        data = self.search_seat_data(window)
+        return await search_seat_cache.async_get(
+            search_seat_cache.make_key(data),
+            lambda: self.fetch_and_record_search(data))
+
+    async def fetch_and_record_search(self, data):
+        return self.record_search(data, await self.get_remote_response(url=self.urls['search_seat'], method="post",
+                                                                       data=data))
+
+    async def search_seat(self):
+        status, response_data = await self.fetch_search_seat()
+        if status != SeatBookerStatus.SUCCESS:
+            return status
+        return self.handle_search_seat_response(response_data)
+
+    async def probe_time_windows(self, windows):
+        # 同时搜索多个时间窗口，按窗口顺序取第一个有座的结果
+        results = await asyncio.gather(*[self.fetch_search_seat(window) for window in windows])
+        stat = SeatBookerStatus.NO_SEAT
+        for i, (window, (status, response_data)) in enumerate(zip(windows, results)):
+            if status != SeatBookerStatus.SUCCESS:
+                # 请求失败的窗口及其后的窗口下次重新搜索
+                self.window_cursor -= len(windows) - i
+                return status
+            self.use_time_window(window)
+            stat = self.handle_search_seat_response(response_data)
+            if stat == SeatBookerStatus.SUCCESS:
+                return stat
+        return stat
+
+    async def book_seat(self):
+        # POST book_seat
+        status, response_data = await self.get_remote_response(url=self.urls['book_seat'], method="post",
+                                                               data=self.book_seat_data())
+        if status != SeatBookerStatus.SUCCESS:
+            return status
+        return self.handle_book_seat_response(response_data)
+
+    async def book_candidate(self, candidate):
+        # POST book_seat，返回(结果, 是否收到平台的答复)；没有收到答复时平台可能已经接受了预约
+        status, response_data = await self.get_remote_response(url=self.urls['book_seat'], method="post",
+                                                               data=self.book_seat_data(candidate))
+        if status != SeatBookerStatus.SUCCESS:
+            return status, False
+        return self.handle_book_seat_response(response_data, candidate), True
+
+    async def cancel_candidate(self, candidate, max_failed_time=3):
+        # 取消推测式订座中多余的预约，失败时按重试策略重试
+        retry = self.retry_policy.start(max_failed_time, name='cancel_candidate')
+        while True:
+            stat = SeatBookerStatus.UNKNOWN_ERROR
+            status, records = await self.get_my_booking_list()
+            if status == SeatBookerStatus.SUCCESS:
+                record = self.find_candidate_record(records, candidate)
+                if record is None:
+                    self.logger.warning(f"UID:{self.username} EXTRA BOOKING #{candidate[1][1]} NOT FOUND!")
+                    return SeatBookerStatus.NO_NEED
+                status, response_data = await self.get_remote_response(url=self.urls['cancel_booking'],
+                                                                       method="post",
+                                                                       data={'bookingId': str(record["id"])})
+                if status == SeatBookerStatus.SUCCESS and response_data["CODE"] == "ok":
+                    self.logger.info(f"UID:{self.username} CANCEL EXTRA BOOKING #{candidate[1][1]} SUCCESS!")
+                    return SeatBookerStatus.SUCCESS
+                stat = status
+            delay = retry.next_delay(stat)
+            if delay is None:
+                self.logger.error(f"UID:{self.username} CANCEL EXTRA BOOKING #{candidate[1][1]} FAILED!")
+                return SeatBookerStatus.LOOP_FAILED
+            await asyncio.sleep(delay)
+
+    @instrument_loop('speculative_book')
+    async def speculative_book(self, num_windows, seats_per_window, max_attempts):
+        # 推测式订座：同时搜索排在前面的num_windows个时间窗口，对排序后的前max_attempts个(时间窗口, 座位)候选同时book_seat，
+        # 等所有请求结束后保留排序最靠前的成功预约，取消其余成功的预约
+        # 平台不允许同一用户的预约时间重叠，时间重叠的候选中最多只有一个会成功（由平台决定是哪一个），
+        # 只有时间不重叠的候选才可能同时成功、需要取消
+        # 每轮依次取接下来的num_windows个时间窗口：第一轮从排在最前面的窗口（用户偏好的时间）开始，全部尝试过后从头开始
+        if not self.speculative_started or self.window_cursor >= len(self.time_windows):
+            self.window_cursor = 0
+        self.speculative_started = True
+        windows = self.next_time_windows(num_windows)
+        advanced = len(windows)
+        windows = windows or [(self.start_time_delta, self.duration_delta)]
+        results = await asyncio.gather(*[self.fetch_search_seat(window) for window in windows])
+        first_failed = next((i for i, (status, _) in enumerate(results) if status != SeatBookerStatus.SUCCESS), None)
+        if first_failed is not None and advanced:
+            # 搜索失败的窗口及其后的窗口下一轮重新搜索
+            self.window_cursor -= advanced - first_failed
+        responses = [response_data if status == SeatBookerStatus.SUCCESS else None
+                     for status, response_data in results]
+        candidates = self.booking_candidates(windows, responses, seats_per_window)[:max_attempts]
+        if not candidates:
+            # 所有窗口都请求失败时按失败原因重试，否则为无座
+            failed = [status for status, _ in results if status != SeatBookerStatus.SUCCESS]
+            return failed[0] if len(failed) == len(results) else SeatBookerStatus.NO_SEAT
+        results = await asyncio.gather(*[self.book_candidate(candidate) for candidate in candidates])
+        booked = [candidate for candidate, (stat, _) in zip(candidates, results) if stat == SeatBookerStatus.SUCCESS]
+        stats = [stat for stat, _ in results if stat != SeatBookerStatus.SUCCESS]
+        if not booked and any(stat == SeatBookerStatus.ALREADY_BOOKED or not answered for stat, answered in results):
+            # 已有预约多半是本轮另一个候选先被平台接受了，而它的答复丢失（超时、5xx等），到预约记录中确认
+            status, records = await self.get_my_booking_list()
+            if status != SeatBookerStatus.SUCCESS:
+                # 无法确认时按请求失败重试，下一轮仍会到预约记录中确认
+                return status
+            booked = [candidate for candidate in candidates if self.find_candidate_record(records, candidate)]
+            if not booked:
+                self.logger.info(f"UID:{self.username} NO SPECULATIVE BOOKING FOUND IN RECORDS!")
+        if not booked:
+            if SeatBookerStatus.ALREADY_BOOKED in stats:
+                return SeatBookerStatus.ALREADY_BOOKED
+            return stats[0]
+        self.use_candidate(booked[0])
+        self.logger.info(f"UID:{self.username} SPECULATIVE BOOK_SEAT #{self.target_seat_title} SUCCESS!")
+        if len(booked) > 1:
+            await asyncio.gather(*[self.cancel_candidate(candidate) for candidate in booked[1:]])
+        return SeatBookerStatus.SUCCESS
+
+    async def book_known_seat(self):
+        # 直接预订本地座位表中的目标座位，目标座位id未知时返回None
+        if not seat_map.loaded:
+            # 首次加载座位表需要读数据库，放到线程池中执行
+            await asyncio.get_running_loop().run_in_executor(None, seat_map.load)
+        if not self.use_known_seat():
+            return None
+        stat = await self.book_seat()
+        if stat == SeatBookerStatus.SUCCESS:
+            self.logger.info(f"UID:{self.username} BOOK KNOWN SEAT #{self.target_seat_title} SUCCESS!")
+        return stat
+
+    async def get_latest_record(self):
+        # GET get_my_booking_list
+        status, response_data = await self.get_remote_response(url=self.urls['get_my_booking_list'], method="get")
+        if status != SeatBookerStatus.SUCCESS:
+            return status, None
+        return SeatBookerStatus.SUCCESS, self.pick_latest_record(response_data["content"]["defaultItems"])
+
+    async def get_my_booking_list(self):
+        # GET get_my_booking_list
+        status, response_data = await self.get_remote_response(url=self.urls['get_my_booking_list'], method="get")
+        if status != SeatBookerStatus.SUCCESS:
+            return status, None
+        return SeatBookerStatus.SUCCESS, response_data["content"]["defaultItems"]
+
+    @instrument_loop('login')
+    async def loop_login(self, max_failed_time):
+        # 若login失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        retry = self.retry_policy.start(max_failed_time, self.retry_deadline, 'login')
+        stat = await self.login()
+        while stat != SeatBookerStatus.SUCCESS:
+            # 如果是LOGIN_FAILED，则退出登录流程
+            if stat == SeatBookerStatus.LOGIN_FAILED:
+                self.logger.error(f"UID:{self.username} LOGIN FAILED!")
+            # 失败max_failed_time次以上或超出时间预算则退出login流程
+            delay = retry.next_delay(stat)
+            if delay is None:
+                return SeatBookerStatus.LOOP_FAILED
+            await asyncio.sleep(delay)
+            # 如果是PROXY_ERROR，则修改代理
+            if stat == SeatBookerStatus.PROXY_ERROR:
+                self.proxy = 'http://127.0.0.1:7890'
+            stat = await self.login()
+        self.logger.info(f"UID:{self.username} LOGIN SUCCESS!")
+        return SeatBookerStatus.SUCCESS
+
+    @instrument_loop('search_seat')
+    async def loop_search_seat(self, max_failed_time, parallel_windows=None):
+        # 若search_seat失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        # 无座或时间不可接受时不计入失败，立即按顺序同时尝试接下来的parallel_windows个时间窗口
+        parallel_windows = parallel_windows or app.config['BOOKER_PARALLEL_WINDOWS']
+        retry = self.retry_policy.start(max_failed_time, self.retry_deadline, 'search_seat')
+        stat = await self.search_seat()
+        while stat != SeatBookerStatus.SUCCESS:
+            if stat in (SeatBookerStatus.NO_SEAT, SeatBookerStatus.NOT_AFFORDABLE):
+                self.logger.debug(f"UID:{self.username} SEARCH_SEAT {stat.name}!")
+                windows = self.next_time_windows(parallel_windows)
+                # 所有时间窗口都已尝试，退出search_seat流程，下一轮从头开始
+                if not windows:
+                    self.logger.error(f"UID:{self.username} SEARCH_SEAT NO TIME WINDOW LEFT!")
+                    self.reset_time_windows()
+                    return SeatBookerStatus.LOOP_FAILED
+                stat = await self.probe_time_windows(windows)
+                continue
+            # 失败max_failed_time次以上或超出时间预算则退出search_seat流程
+            delay = retry.next_delay(stat)
+            if delay is None:
+                self.logger.error(f"UID:{self.username} SEARCH_SEAT FAILED!")
+                return SeatBookerStatus.LOOP_FAILED
+            await asyncio.sleep(delay)
+            stat = await self.search_seat()
+        self.logger.info(f"UID:{self.username} valid_seat:#{self.target_seat_title} seat_id:{self.target_seat}!")
+        return SeatBookerStatus.SUCCESS
+
+    @instrument_loop('book_seat')
+    async def loop_book_seat(self, max_failed_time):
+        # 若book_seat失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        retry = self.retry_policy.start(max_failed_time, self.retry_deadline, 'book_seat')
+        stat = await self.book_seat()
+        while stat != SeatBookerStatus.SUCCESS:
+            # 若已有预约，直接结束程序
+            if stat == SeatBookerStatus.ALREADY_BOOKED:
+                self.logger.error(f"UID:{self.username} ALREADY_BOOKED!")
+                return SeatBookerStatus.ALREADY_BOOKED
+            # 失败max_failed_time次以上或超出时间预算则退出程序
+            delay = retry.next_delay(stat)
+            if delay is None:
+                self.logger.error(f"UID:{self.username} BOOK_SEAT FAILED!")
+                return SeatBookerStatus.LOOP_FAILED
+            await asyncio.sleep(delay)
+            stat = await self.book_seat()
+        self.logger.info(f"UID:{self.username} BOOK_SEAT SUCCESS!")
+        return SeatBookerStatus.SUCCESS
+
+    @instrument_loop('get_latest_record')
+    async def loop_get_latest_record(self, max_failed_time):
+        # 若get_latest_record失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        retry = self.retry_policy.start(max_failed_time, name='get_latest_record')
+        stat, latest_record = await self.get_latest_record()
+        while stat != SeatBookerStatus.SUCCESS:
+            # 失败max_failed_time次以上退出get_latest_record流程
+            delay = retry.next_delay(stat)
+            if delay is None:
+                return SeatBookerStatus.LOOP_FAILED, None
+            await asyncio.sleep(delay)
+            stat, latest_record = await self.get_latest_record()
+        return SeatBookerStatus.SUCCESS, latest_record
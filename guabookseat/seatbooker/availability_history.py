@@ -0,0 +1,355 @@
+import atexit
+import os
+import struct
+import threading
+import time
+from array import array
+
+from guabookseat import app
+from guabookseat.seatbooker.seat_allocator import get_seat_index, is_seat_available
+
+# 快照记录：观察时刻、开始时间、时长、最大座位号、座位数，其后是座位号1..最大座位号的空闲位图（第title-1位为1表示空闲）
+SNAPSHOT = struct.Struct('<dIIHH')
+# 订座结果记录：订座时刻、开始时间、时长、座位号、是否成功
+OUTCOME = struct.Struct('<dIIH?')
+
+
+# 一个房间在某个开始整点的统计
+class HourStats:
+    def __init__(self):
+        self.snapshots = 0
+        self.free_seats = 0  # 所有快照的空座数之和
+        self.seats = 0  # 所有快照的座位数之和
+        # 位图第j个字节 -> 各取值(0~255)出现的次数，每份快照只需每字节累加一次，查询时再换算成每个座位的空闲次数
+        self.byte_counts = []
+        self.outcomes = {}  # 座位号 -> [订座成功次数, 失败次数]
+        self._free = None  # 缓存：座位号 -> 空闲次数
+        self._ranked = None  # 缓存：按得分从高到低排序的座位号
+
+    def add_snapshot(self, bitmap, seat_count, free_count):
+        self.snapshots += 1
+        self.seats += seat_count
+        self.free_seats += free_count
+        while len(self.byte_counts) < len(bitmap):
+            self.byte_counts.append(array('I', bytes(4 * 256)))
+        for counts, value in zip(self.byte_counts, bitmap):
+            counts[value] += 1
+        self._free = self._ranked = None
+
+    def add_outcome(self, title, success):
+        counts = self.outcomes.setdefault(title, [0, 0])
+        counts[0 if success else 1] += 1
+        self._ranked = None
+
+    def free_counts(self):
+        if self._free is None:
+            free = array('I', bytes(4 * (len(self.byte_counts) * 8 + 1)))
+            for j, counts in enumerate(self.byte_counts):
+                for value in range(1, 256):
+                    count = counts[value]
+                    if not count:
+                        continue
+                    for bit in range(8):
+                        if value >> bit & 1:
+                            free[j * 8 + bit + 1] += count
+            self._free = free
+        return self._free
+
+    def free_probability(self, title):
+        # 拉普拉斯平滑：没有观测时为0.5
+        free = self.free_counts()
+        count = free[title] if 0 < title < len(free) else 0
+        return (count + 1) / (self.snapshots + 2)
+
+    def booking_rate(self, title):
+        success, failure = self.outcomes.get(title, (0, 0))
+        return (success + 1) / (success + failure + 2)
+
+    def score(self, title):
+        # 座位在这个时段空着、且订座时没有被别人抢先的概率
+        return self.free_probability(title) * self.booking_rate(title)
+
+    def ranked_titles(self):
+        if self._ranked is None:
+            titles = range(1, len(self.free_counts()))
+            self._ranked = sorted(titles, key=lambda title: (-self.score(title), title))
+        return self._ranked
+
+
+# 座位空闲历史：按房间和日期把searchSeats快照和订座结果追加写入紧凑的二进制文件，
+# 统计每个房间各开始整点每个座位的空闲概率和订座成功率，用于选座和选时间窗口
+# record_*只把引用放入内存队列，由后台写入线程每flush_interval秒批量编码、追加写入并更新统计
+# 多个进程追加同一个文件时，每批记录用一次O_APPEND的write写入
+class AvailabilityHistory:
+    def __init__(self, directory, days=28, flush_interval=5.0, min_samples=20, enabled=True):
+        self.directory = directory
+        self.days = days
+        self.flush_interval = flush_interval
+        self.min_samples = min_samples  # 某时段的快照数少于min_samples时不参与排序
+        self.enabled = enabled
+        self._pending = []  # ('snapshot'|'outcome', 记录时刻, ...)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer = None
+        self._stats_lock = threading.Lock()
+        self._rooms = {}  # content_id -> {开始整点: HourStats}，只包含已从文件加载的房间
+        self._loaded_days = {}  # content_id -> 加载时的日期，跨天后重新加载
+        self._load_requests = set()
+        self._purged_day = None
+
+    def record_snapshot(self, content_id, begin_time, duration, response_data):
+        if not self.enabled or not response_data or "data" not in response_data:
+            return
+        self._put(('snapshot', time.time(), int(content_id), int(begin_time), int(duration), response_data["data"]))
+
+    def record_outcome(self, content_id, begin_time, duration, seat_title, success):
+        if not self.enabled:
+            return
+        try:
+            title = int(seat_title)
+        except (TypeError, ValueError):
+            return
+        self._put(('outcome', time.time(), int(content_id), int(begin_time), int(duration), title, bool(success)))
+
+    def _put(self, record):
+        with self._lock:
+            self._pending.append(record)
+        self.start()
+
+    def start(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(target=self._write_forever, name='availability-history-writer',
+                                            daemon=True)
+            self._writer.start()
+
+    def _write_forever(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error(f"AvailabilityHistory flush failed:{str(e)}")
+
+    def flush(self):
+        # 写入队列中的记录，加载查询过的房间，返回写入的记录数
+        with self._lock:
+            records, self._pending = self._pending, []
+            load_requests, self._load_requests = self._load_requests, set()
+        blobs = {}  # 文件路径 -> [bytes, ...]
+        updates = []  # (content_id, 开始整点, 记录)
+        for record in records:
+            kind, observed_at, content_id, begin_time = record[:4]
+            path = self._path(content_id, observed_at, '.snap' if kind == 'snapshot' else '.book')
+            if kind == 'snapshot':
+                encoded = self._encode_snapshot(*record[1:])
+                if encoded is None:
+                    continue
+                data, seat_count, free_count = encoded
+                blobs.setdefault(path, []).append(data)
+                updates.append((content_id, begin_time, (data[SNAPSHOT.size:], seat_count, free_count)))
+            else:
+                blobs.setdefault(path, []).append(OUTCOME.pack(record[1], *record[3:]))
+                updates.append((content_id, begin_time, record[5:]))
+        for path, chunks in blobs.items():
+            self._append(path, b''.join(chunks))
+        today = time.strftime('%Y%m%d')
+        with self._stats_lock:
+            touched = set()
+            for content_id, begin_time, update in updates:
+                room = self._rooms.get(content_id)
+                if room is None:
+                    continue
+                stats = room.setdefault(self._hour(begin_time), HourStats())
+                if len(update) == 3:
+                    stats.add_snapshot(*update)
+                else:
+                    stats.add_outcome(*update)
+                touched.add(stats)
+            # 在写入线程中重新排序，订座线程查询时直接使用
+            for stats in touched:
+                stats.ranked_titles()
+            stale = [content_id for content_id, day in self._loaded_days.items() if day != today]
+        for content_id in load_requests.union(stale):
+            self._load_room(content_id)
+        self._purge(today)
+        return len(records)
+
+    def _path(self, content_id, timestamp, suffix):
+        day = time.strftime('%Y%m%d', time.localtime(timestamp))
+        return os.path.join(self.directory, str(content_id), day + suffix)
+
+    @staticmethod
+    def _hour(begin_time):
+        return time.localtime(begin_time).tm_hour
+
+    @staticmethod
+    def _encode_snapshot(observed_at, content_id, begin_time, duration, seat_data):
+        # 返回(记录, 座位数, 空座数)，快照中没有座位时返回None
+        titles, free_titles = [], []
+        for seat in seat_data.get("POIs", []):
+            try:
+                title = int(seat['title'])
+            except (TypeError, ValueError, KeyError):
+                continue
+            if not 0 < title <= 0xFFFF:
+                continue
+            titles.append(title)
+            if is_seat_available(seat):
+                free_titles.append(title)
+        if not titles:
+            return None
+        max_title = max(titles)
+        bitmap = bytearray((max_title + 7) // 8)
+        for title in free_titles:
+            bitmap[(title - 1) >> 3] |= 1 << ((title - 1) & 7)
+        header = SNAPSHOT.pack(observed_at, begin_time, duration, max_title, min(len(titles), 0xFFFF))
+        return header + bitmap, len(titles), len(free_titles)
+
+    @staticmethod
+    def _append(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _load_room(self, content_id):
+        # 从最近days天的文件重建房间的统计；在写入线程中执行，与追加写入不会同时进行
+        room = {}
+        directory = os.path.join(self.directory, str(content_id))
+        oldest = time.strftime('%Y%m%d', time.localtime(time.time() - self.days * 86400))
+        names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        for name in names:
+            day, suffix = os.path.splitext(name)
+            if day < oldest or suffix not in ('.snap', '.book'):
+                continue
+            with open(os.path.join(directory, name), 'rb') as f:
+                data = f.read()
+            if suffix == '.snap':
+                self._read_snapshots(data, room)
+            else:
+                self._read_outcomes(data, room)
+        for stats in room.values():
+            stats.ranked_titles()
+        with self._stats_lock:
+            self._rooms[content_id] = room
+            self._loaded_days[content_id] = time.strftime('%Y%m%d')
+
+    def _read_snapshots(self, data, room):
+        offset = 0
+        while offset + SNAPSHOT.size <= len(data):
+            _, begin_time, _, max_title, seat_count = SNAPSHOT.unpack_from(data, offset)
+            start = offset + SNAPSHOT.size
+            offset = start + (max_title + 7) // 8
+            if offset > len(data):
+                break  # 进程在写入时崩溃留下的不完整记录
+            bitmap = data[start:offset]
+            free_count = bin(int.from_bytes(bitmap, 'little')).count('1')
+            room.setdefault(self._hour(begin_time), HourStats()).add_snapshot(bitmap, seat_count, free_count)
+
+    def _read_outcomes(self, data, room):
+        for offset in range(0, len(data) - OUTCOME.size + 1, OUTCOME.size):
+            _, begin_time, _, title, success = OUTCOME.unpack_from(data, offset)
+            room.setdefault(self._hour(begin_time), HourStats()).add_outcome(title, success)
+
+    def _purge(self, today):
+        # 每天删除一次超过days天的文件
+        if self._purged_day == today or not os.path.isdir(self.directory):
+            return
+        self._purged_day = today
+        oldest = time.strftime('%Y%m%d', time.localtime(time.time() - self.days * 86400))
+        for room in os.listdir(self.directory):
+            directory = os.path.join(self.directory, room)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if os.path.splitext(name)[0] < oldest:
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError as e:
+                        app.logger.warning(f"AvailabilityHistory purge {name} failed:{str(e)}")
+
+    def _stats(self, content_id, begin_time):
+        # 房间尚未加载时交给写入线程加载并返回None，不在订座线程中读文件
+        if not self.enabled:
+            return None
+        content_id = int(content_id)
+        with self._stats_lock:
+            room = self._rooms.get(content_id)
+            if room is not None:
+                return room.get(self._hour(begin_time))
+        with self._lock:
+            self._load_requests.add(content_id)
+        self.start()
+        self._wakeup.set()
+        return None
+
+    def load(self, content_id, timeout=30):
+        # 等待写入线程加载房间的统计（命令行查询使用）
+        self._stats(content_id, 0)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._stats_lock:
+                if int(content_id) in self._rooms:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def seat_free_probability(self, content_id, seat_title, begin_time):
+        # 座位在begin_time所在整点开始的时段空闲的概率，样本不足或尚未加载时返回None
+        stats = self._stats(content_id, begin_time)
+        with self._stats_lock:
+            if stats is None or stats.snapshots < self.min_samples:
+                return None
+            return stats.free_probability(int(seat_title))
+
+    def seat_booking_rate(self, content_id, seat_title, begin_time):
+        # 在该时段订这个座位成功的比例（平滑后），尚未加载时返回None
+        stats = self._stats(content_id, begin_time)
+        with self._stats_lock:
+            if stats is None:
+                return None
+            return stats.booking_rate(int(seat_title))
+
+    def window_free_ratio(self, content_id, begin_time):
+        # begin_time所在整点开始的时段平均空座比例，样本不足或尚未加载时返回None
+        stats = self._stats(content_id, begin_time)
+        with self._stats_lock:
+            if stats is None or stats.snapshots < self.min_samples or not stats.seats:
+                return None
+            return stats.free_seats / stats.seats
+
+    def ranked_seats(self, content_id, begin_time):
+        # 按空闲概率乘订座成功率从高到低排序的座位号，样本不足或尚未加载时返回None
+        stats = self._stats(content_id, begin_time)
+        with self._stats_lock:
+            if stats is None or stats.snapshots < self.min_samples:
+                return None
+            return stats.ranked_titles()
+
+    def best_seat(self, content_id, begin_time, seat_data, taken=()):
+        # 在searchSeats结果中选历史上最容易订到的可选座位，返回(座位id, 座位号)，没有历史数据时返回None
+        ranked = self.ranked_seats(content_id, begin_time)
+        if not ranked:
+            return None
+        seat_index = get_seat_index(seat_data)
+        for title in ranked:
+            position = seat_index.find(title)
+            if position is not None and seat_index.seat_ids[position] not in taken:
+                return seat_index.seat(position)
+        return None
+
+
+availability_history = AvailabilityHistory(app.config['BOOKER_AVAILABILITY_DIR'],
+                                           days=app.config['BOOKER_AVAILABILITY_DAYS'],
+                                           flush_interval=app.config['BOOKER_AVAILABILITY_FLUSH_INTERVAL'],
+                                           min_samples=app.config['BOOKER_AVAILABILITY_MIN_SAMPLES'],
+                                           enabled=app.config['BOOKER_AVAILABILITY_HISTORY'])
+# 退出时写入队列中尚未写入的记录
+atexit.register(availability_history.flush)
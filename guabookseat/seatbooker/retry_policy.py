@@ -0,0 +1,80 @@
+import random
+import time
+
+from guabookseat import app
+from guabookseat.metrics import retry_total
+from guabookseat.seatbooker.status import SeatBookerStatus
+
+
+# 重试策略：带抖动的指数退避，可重试的网络错误先快速重试，终止状态立即放弃，并受总时间预算约束
+class RetryPolicy:
+    def __init__(self, base_delay=0.5, max_delay=7.0, multiplier=2.0, jitter=0.5, fast_retry_delay=0.2,
+                 fast_retries=2, fast_retry_statuses=None, terminal_statuses=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.fast_retry_delay = fast_retry_delay
+        self.fast_retries = fast_retries
+        self.fast_retry_statuses = fast_retry_statuses if fast_retry_statuses is not None else (
+            SeatBookerStatus.TIME_OUT,
+            SeatBookerStatus.STATUS_CODE_ERROR,
+            SeatBookerStatus.JSON_DECODE_ERROR,
+        )
+        self.terminal_statuses = terminal_statuses if terminal_statuses is not None else (
+            SeatBookerStatus.ALREADY_BOOKED,
+            SeatBookerStatus.LOGIN_FAILED,
+            SeatBookerStatus.NO_NEED,
+        )
+
+    def start(self, max_failed_time, deadline=None, name=None):
+        # 开始一个重试循环，deadline为time.monotonic()时间，超过后不再重试；name用于统计各循环的重试次数
+        return RetryState(self, max_failed_time, deadline, name)
+
+
+# 一个重试循环的状态
+class RetryState:
+    def __init__(self, policy, max_failed_time, deadline=None, name=None):
+        self.policy = policy
+        self.name = name
+        self.max_failed_time = max_failed_time
+        self.deadline = deadline
+        self.failed_time = 0
+        self.fast_failed_time = 0
+
+    def next_delay(self, stat):
+        # 返回下次重试前需要等待的秒数，返回None表示放弃
+        policy = self.policy
+        if self.name is not None:
+            retry_total.inc(self.name, stat.name)
+        if stat in policy.terminal_statuses:
+            return None
+        self.failed_time += 1
+        # 失败max_failed_time次以上放弃
+        if self.failed_time > self.max_failed_time:
+            return None
+        if stat in policy.fast_retry_statuses and self.fast_failed_time < policy.fast_retries:
+            # 偶发的网络错误快速重试
+            self.fast_failed_time += 1
+            delay = policy.fast_retry_delay
+        else:
+            delay = min(policy.max_delay, policy.base_delay * policy.multiplier ** (self.failed_time - 1))
+        delay *= 1 - policy.jitter * random.random()
+        # 等待后已超过总时间预算则放弃
+        if self.deadline is not None and time.monotonic() + delay > self.deadline:
+            return None
+        return delay
+
+
+def make_deadline(budget=None):
+    # 从现在开始的总时间预算（秒）对应的截止时间
+    budget = app.config['RETRY_BUDGET'] if budget is None else budget
+    return time.monotonic() + budget if budget else None
+
+
+default_retry_policy = RetryPolicy(base_delay=app.config['RETRY_BASE_DELAY'],
+                                   max_delay=app.config['RETRY_MAX_DELAY'],
+                                   multiplier=app.config['RETRY_MULTIPLIER'],
+                                   jitter=app.config['RETRY_JITTER'],
+                                   fast_retry_delay=app.config['RETRY_FAST_RETRY_DELAY'],
+                                   fast_retries=app.config['RETRY_FAST_RETRIES'])
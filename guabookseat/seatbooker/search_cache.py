@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+
+from guabookseat import app
+
+
+# 正在进行中的一次searchSeats请求，其他线程等待它的结果
+class _Flight:
+    def __init__(self, generation):
+        self.generation = generation
+        self.event = threading.Event()
+        self.result = None
+
+
+# searchSeats结果缓存：同一房间、开始时间和时长的搜索结果在ttl秒内共享，并合并并发的相同请求
+# fetch返回(status, response_data)，只有请求成功（response_data不为None）的结果会被缓存
+# 等待其他线程的相同请求超过wait_timeout秒（该请求可能卡住）时不再等待，自行请求
+class SearchSeatCache:
+    def __init__(self, ttl=1.0, wait_timeout=5.0):
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (过期时间, (status, response_data))
+        self._flights = {}  # key -> _Flight
+        self._async_flights = {}  # key -> (generation, asyncio.Future)
+        self._generations = {}  # content_id -> 失效次数
+
+    @staticmethod
+    def make_key(data):
+        return (data["space_category[content_id]"], data["space_category[category_id]"],
+                data["beginTime"], data["duration"])
+
+    def _lookup(self, key):
+        # 需持有self._lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry[1]
+
+    def _store(self, key, generation, result):
+        # 需持有self._lock；请求期间房间内有人订座成功则结果已过时，不缓存
+        if result is not None and result[1] is not None and self._generations.get(key[0], 0) == generation:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+
+    def get(self, key, fetch):
+        # 同步版本：fetch()返回(status, response_data)
+        if self.ttl <= 0:
+            return fetch()
+        with self._lock:
+            cached = self._lookup(key)
+            if cached is not None:
+                return cached
+            flight = self._flights.get(key)
+            owner = flight is None
+            if owner:
+                flight = _Flight(self._generations.get(key[0], 0))
+                self._flights[key] = flight
+        if not owner:
+            flight.event.wait(self.wait_timeout)
+            # 发起请求的线程出现异常或迟迟没有结果时自行请求
+            result = flight.result
+            return result if result is not None else fetch()
+        try:
+            flight.result = fetch()
+        finally:
+            with self._lock:
+                self._store(key, flight.generation, flight.result)
+                self._flights.pop(key, None)
+            flight.event.set()
+        return flight.result
+
+    async def async_get(self, key, fetch):
+        # 异步版本：fetch()返回协程，协程结果为(status, response_data)
+        if self.ttl <= 0:
+            return await fetch()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            cached = self._lookup(key)
+            if cached is not None:
+                return cached
+            flight = self._async_flights.get(key)
+            owner = flight is None or flight[1].get_loop() is not loop
+            if owner:
+                flight = (self._generations.get(key[0], 0), loop.create_future())
+                self._async_flights[key] = flight
+        if not owner:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(flight[1]), self.wait_timeout)
+            except asyncio.TimeoutError:
+                result = None
+            # 发起请求的协程出现异常或迟迟没有结果时自行请求
+            return result if result is not None else await fetch()
+        result = None
+        try:
+            result = await fetch()
+        finally:
+            with self._lock:
+                self._store(key, flight[0], result)
+                if self._async_flights.get(key) is flight:
+                    del self._async_flights[key]
+            flight[1].set_result(result)
+        return result
+
+    def invalidate_room(self, content_id):
+        # 房间内有人订座成功后，该房间的所有搜索结果立即失效
+        with self._lock:
+            self._generations[content_id] = self._generations.get(content_id, 0) + 1
+            for key in [key for key in self._entries if key[0] == content_id]:
+                del self._entries[key]
+
+
+search_seat_cache = SearchSeatCache(ttl=app.config['BOOKER_SEARCH_CACHE_TTL'],
+                                    wait_timeout=app.config['BOOKER_SEARCH_CACHE_WAIT_TIMEOUT'])
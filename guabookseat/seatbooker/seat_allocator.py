@@ -0,0 +1,134 @@
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+def is_seat_available(seat):
+    # state=0表示可选，state=2表示推荐
+    return seat['state'] == 0 or seat['state'] == 2
+
+
+# 座位索引：把一份searchSeats快照中的可选座位按座位号排序存成紧凑数组，用二分查找回答就近选座
+class SeatIndex:
+    def __init__(self, seat_data):
+        seats = []
+        for seat in seat_data["POIs"]:
+            if not is_seat_available(seat):
+                continue
+            try:
+                seats.append((int(seat['title']), seat['id'], seat['title'], seat['state']))
+            except (TypeError, ValueError):
+                continue
+        seats.sort(key=lambda x: x[0])
+        self.titles = array('i', [seat[0] for seat in seats])
+        self.seat_ids = [seat[1] for seat in seats]
+        self.seat_titles = [seat[2] for seat in seats]
+        self.states = array('b', [seat[3] for seat in seats])
+        # 奇数座位单独建一份索引，数组中存的是在self.titles中的位置
+        self.odd_positions = array('i', [i for i, title in enumerate(self.titles) if title % 2])
+        self.odd_titles = array('i', [self.titles[i] for i in self.odd_positions])
+        self.best_pair_seats = seat_data.get("bestPairSeats", {}).get("seats", [])
+
+    def __len__(self):
+        return len(self.titles)
+
+    def seat(self, position):
+        return self.seat_ids[position], self.seat_titles[position]
+
+    def find(self, title):
+        # 座位号为title的可选座位的位置，没有则返回None
+        position = bisect_left(self.titles, title)
+        if position < len(self.titles) and self.titles[position] == title:
+            return position
+        return None
+
+    def _nearest(self, titles, target, taken, positions=None):
+        # 从二分查找的位置向两侧扩展，跳过已分配的座位，距离相同时选座位号小的
+        left = bisect_left(titles, target) - 1
+        right = left + 1
+        while left >= 0 or right < len(titles):
+            if right >= len(titles) or (left >= 0 and target - titles[left] <= titles[right] - target):
+                candidate, left = left, left - 1
+            else:
+                candidate, right = right, right + 1
+            position = positions[candidate] if positions is not None else candidate
+            if self.seat_ids[position] not in taken:
+                return position
+        return None
+
+    def nearest(self, seat_id, taken=()):
+        # 目标座位可选则直接选中；否则选最近的奇数座位，除非最近的座位比它近10个以上
+        position = self._nearest(self.titles, seat_id, taken)
+        if position is None:
+            return "", ""
+        if self.titles[position] == seat_id or self.titles[position] % 2:
+            return self.seat(position)
+        odd_position = self._nearest(self.odd_titles, seat_id, taken, self.odd_positions)
+        if odd_position is not None and \
+                abs(self.titles[odd_position] - seat_id) - abs(self.titles[position] - seat_id) <= 10:
+            return self.seat(odd_position)
+        return self.seat(position)
+
+    def first(self, taken=()):
+        # 座位号最小的可选座位
+        for position in range(len(self.titles)):
+            if self.seat_ids[position] not in taken:
+                return self.seat(position)
+        return "", ""
+
+
+# 同一份快照的索引只建一次，供所有用户复用（持有快照引用，避免id被复用）
+_seat_indexes = OrderedDict()
+_seat_indexes_lock = threading.Lock()
+
+
+def get_seat_index(seat_data, max_size=32):
+    key = id(seat_data)
+    with _seat_indexes_lock:
+        cached = _seat_indexes.get(key)
+        if cached is not None and cached[0] is seat_data:
+            _seat_indexes.move_to_end(key)
+            return cached[1]
+    seat_index = SeatIndex(seat_data)
+    with _seat_indexes_lock:
+        _seat_indexes[key] = (seat_data, seat_index)
+        while len(_seat_indexes) > max_size:
+            _seat_indexes.popitem(last=False)
+    return seat_index
+
+
+def choose_seat(seat_data, seat_id, taken=()):
+    # 从searchSeats结果中选一个不在taken中的座位，返回(座位id, 座位号)，没有可选座位时返回("", "")
+    seat_index = get_seat_index(seat_data)
+    if seat_id == 0:
+        # 选系统推荐的座位
+        for seat in seat_index.best_pair_seats:
+            if seat['id'] not in taken:
+                return seat['id'], seat['title']
+        # 推荐座位已分配给其他用户时，选第一个可选的座位
+        return seat_index.first(taken)
+    # 选距离目标座位最近的一个座位，且最好是奇数
+    return seat_index.nearest(seat_id, taken)
+
+
+def allocate_seats(seat_data, seat_ids, taken=()):
+    # 用同一份POIs快照为同一房间的所有待订座用户分配互不冲突的座位，返回与seat_ids一一对应的(座位id, 座位号)
+    # taken中的座位（如已被直接订走的）不参与分配
+    seat_index = get_seat_index(seat_data)
+    allocation = [None] * len(seat_ids)
+    taken = set(taken)
+    # 先满足目标座位恰好可选的用户（同一目标座位只给排在前面的用户）
+    for i, seat_id in enumerate(seat_ids):
+        position = seat_index.find(seat_id) if seat_id != 0 else None
+        if position is not None and seat_index.seat_ids[position] not in taken:
+            allocation[i] = seat_index.seat(position)
+            taken.add(allocation[i][0])
+    # 其余用户按原有的就近、奇数和系统推荐偏好依次选座，已分配的座位不再参与
+    for i, seat_id in enumerate(seat_ids):
+        if allocation[i] is not None:
+            continue
+        allocation[i] = choose_seat(seat_data, seat_id, taken)
+        if allocation[i][0] != "":
+            taken.add(allocation[i][0])
+    return allocation
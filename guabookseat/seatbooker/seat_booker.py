@@ -1,10 +1,16 @@
 import datetime
 import json
 import time
-from enum import Enum
-from random import randint
-from guabookseat.models import UserCookie
-from guabookseat import db
+from guabookseat import app
+from guabookseat.clock import clock_skew
+from guabookseat.metrics import instrument_loop
+from guabookseat.seatbooker.availability_history import availability_history
+from guabookseat.seatbooker.retry_policy import default_retry_policy
+from guabookseat.seatbooker.seat_allocator import choose_seat
+from guabookseat.seatbooker.seat_map import seat_map
+from guabookseat.seatbooker.search_cache import search_seat_cache
+from guabookseat.seatbooker.session_registry import session_registry
+from guabookseat.seatbooker.status import SeatBookerStatus
 
 import requests
 
@@ -19,25 +25,19 @@ def get_start_time(conf_start_time):
             today_timestamp + 86400 + 3600 * conf_start_time)
 
 
-# SeatBooker状态枚举类
-class SeatBookerStatus(Enum):
-    SUCCESS = 1
-    NO_SEAT = 2
-    NOT_AFFORDABLE = 3
-    STATUS_CODE_ERROR = 4
-    TIME_OUT = 5
-    PARAM_ERROR = 6
-    UNKNOWN_ERROR = 7
-    ALREADY_BOOKED = 8
-    LOOP_FAILED = 9
-    LOGIN_FAILED = 10
-    PROXY_ERROR = 11
-    JSON_DECODE_ERROR = 12
-    NO_NEED = 13
-
-
-# SeatBooker类
-class SeatBooker:
+# 每次访问平台接口后调用listener(学号, 接口名, 耗时秒数, status, response_data)，用于压测和监控
+response_listeners = []
+
+
+# SeatBooker基类，只负责请求参数的构造和响应结果的解析，与具体的网络传输方式无关
+class BaseSeatBooker:
+    url_home = app.config['BOOKER_BASE_URL'].rstrip('/')
+    fake_header = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                      'Chrome/100.0.4896.60 Safari/537.36',
+        'Referer': 'https://jxnu.huitu.zhishulib.com/'
+    }
+
     def __init__(self, conf, logger=None) -> None:
         # 读取参数配置
         self.uid = None
@@ -55,15 +55,15 @@ class SeatBooker:
         self.target_seat_title = ""
         self.start_time_delta = 0
         self.duration_delta = 0
+        self.kept_candidate = None  # 推测式订座中保留的(时间窗口, (座位id, 座位号))
+        self.reset_time_windows()
+        # 重试策略，retry_deadline为time.monotonic()截止时间，None表示不限
+        self.retry_policy = default_retry_policy
+        self.retry_deadline = None
         # 日志
         self.logger = logger
-        # 建链相关
-        fake_header = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/100.0.4896.60 Safari/537.36',
-            'Referer': 'https://jxnu.huitu.zhishulib.com/'
-        }
-        url_home = 'https://jxnu.huitu.zhishulib.com'
+        # 接口地址
+        url_home = self.url_home
         self.urls = {
             'login': url_home + '/api/1/login',
             'search_seat': url_home + '/Seat/Index/searchSeats?LAB_JSON=1',
@@ -73,33 +73,11 @@ class SeatBooker:
             'checkin_booking': url_home + '/Seat/Index/checkIn?LAB_JSON=1',
             'checkout_booking': url_home + '/Seat/Index/checkOut?LAB_JSON=1',
         }
-        self.session = requests.session()
-        self.session.headers.update(fake_header)
-        # 设置cookie
-        user_cookie = UserCookie.query.filter_by(username=self.username).first()
-        if user_cookie:
-            if user_cookie.is_expired():
-                # 登录
-                stat = self.loop_login(max_failed_time=5)
-                if stat != SeatBookerStatus.SUCCESS:
-                    raise RuntimeError("cookie过期且登陆失败")
-                # 更新cookie
-                user_cookie.set_cookie(self.session.cookies.get_dict(), self.username, self.uid)
-                db.session.commit()
-            else:
-                # 使用保存的cookie
-                self.session.cookies.update(user_cookie.get_cookie())
-                self.uid = user_cookie.get_uid()
-        else:
-            # 登录
-            stat = self.loop_login(max_failed_time=5)
-            if stat != SeatBookerStatus.SUCCESS:
-                raise RuntimeError("无cookie且登陆失败")
-            # 保存cookie
-            user_cookie = UserCookie()
-            user_cookie.set_cookie(self.session.cookies.get_dict(), self.username, self.uid)
-            db.session.add(user_cookie)
-            db.session.commit()
+        self.url_names = {url: name for name, url in self.urls.items()}
+
+    def notify_response(self, url, elapsed, status, response_data):
+        for listener in response_listeners:
+            listener(self.username, self.url_names.get(url, url), elapsed, status, response_data)
 
     def is_time_affordable(self, start_time_delta, duration_delta):
         # 检查start_time误差，前后波动最多conf['start_time_delta_limit']小时
@@ -114,64 +92,46 @@ class SeatBooker:
             return False
         return True
 
-    def adjust_conf_randomly(self, random_range=0, factor=1.0, max_retry_time=100):
-        border = round((random_range / 10) * 3600 * factor)
-        retry_time = max_retry_time  # 尝试调整最多100次
-        while retry_time > 0:
-            # 随机生成一组调整
-            valid_start_time_delta = round(randint(-border, border) / 3600) * 3600
-            valid_duration_delta = round(randint(-2 * border, border) / 3600) * 3600
-            # 限制valid_start_time_delta范围
-            start_time_delta_lower_bound = get_start_time(7) - self.start_time  # 开始时间不早于7点
-            start_time_delta_upper_bound = get_start_time(19) - self.start_time  # 开始时间不晚于19点
-            valid_start_time_delta = min(valid_start_time_delta, start_time_delta_upper_bound)
-            valid_start_time_delta = max(valid_start_time_delta, start_time_delta_lower_bound)
-            # 限制valid_duration_delta范围
-            duration_delta_upper_bound = get_start_time(22) - (
-                    self.start_time + valid_start_time_delta) - self.duration  # 结束时间不超过22点
-            valid_duration_delta = min(valid_duration_delta, duration_delta_upper_bound)
-            # 检验结果是否可接受
-            if self.is_time_affordable(valid_start_time_delta, valid_duration_delta):
-                self.start_time_delta = valid_start_time_delta
-                self.duration_delta = valid_duration_delta
-                return
-            retry_time -= 1
+    def enumerate_time_windows(self):
+        # 预先计算所有可接受的整点时间窗口(start_time_delta, duration_delta)，按与用户偏好的接近程度排序
+        earliest_start_time = get_start_time(7)  # 开始时间不早于7点
+        latest_start_time = get_start_time(19)  # 开始时间不晚于19点
+        latest_end_time = get_start_time(22)  # 结束时间不超过22点
+        windows = []
+        for start_time_delta in range(-self.start_time_delta_limit, self.start_time_delta_limit + 1, 3600):
+            start_time = self.start_time + start_time_delta
+            if start_time < earliest_start_time or start_time > latest_start_time:
+                continue
+            for duration_delta in range(-self.duration_delta_limit, self.duration_delta_limit + 1, 3600):
+                if start_time + self.duration + duration_delta > latest_end_time:
+                    continue
+                if self.is_time_affordable(start_time_delta, duration_delta):
+                    windows.append((start_time_delta, duration_delta))
+        # 总偏差小的优先；总偏差相同时历史上空座比例高（按10%分档）的开始时间优先，其次开始时间偏差小的优先，
+        # 再其次时长长的优先；没有历史数据时不影响排序
+        free_ratios = {}
+        for start_time_delta in {w[0] for w in windows}:
+            ratio = availability_history.window_free_ratio(self.content_id, self.start_time + start_time_delta)
+            free_ratios[start_time_delta] = round(ratio, 1) if ratio is not None else 0
+        windows.sort(key=lambda w: (abs(w[0]) + abs(w[1]), -free_ratios[w[0]], abs(w[0]), -w[1], w[0]))
+        return windows
 
-    def get_remote_response(self, url='', method='get', data=None):
-        if method not in ("post", "get"):
-            self.logger.error(f"UID:{self.username} url:{url} method:{method} not in (post, get)")
+    def reset_time_windows(self):
+        self.time_windows = self.enumerate_time_windows()
+        # 初始的预定时间已在第一次搜索时尝试过
+        self.window_cursor = 1 if self.time_windows and self.time_windows[0] == (0, 0) else 0
 
-        # 尝试post/get
-        try:
-            if method == "post":
-                response = self.session.post(url=url, data=data, proxies=self.session.proxies)
-            else:
-                response = self.session.get(url=url, proxies=self.session.proxies, timeout=5)
-        except requests.exceptions.ReadTimeout:
-            return SeatBookerStatus.TIME_OUT, None
-        except requests.exceptions.SSLError:
-            return SeatBookerStatus.PROXY_ERROR, None
-        except Exception as e:
-            self.logger.error(f"UID:{self.username} url:{url} {method} error:{str(e)}")
-            return SeatBookerStatus.UNKNOWN_ERROR, None
-        # 检查status_code
-        if response.status_code != 200:
-            self.logger.warning(f"UID:{self.username} url:{url} status_code != 200!")
-            return SeatBookerStatus.STATUS_CODE_ERROR, None
-        # 尝试解码response为response_data
-        try:
-            response_data = response.json()
-        except requests.exceptions.JSONDecodeError:
-            self.logger.error(f"UID:{self.username} url:{url} requests.exceptions.JSONDecodeError")
-            return SeatBookerStatus.JSON_DECODE_ERROR, None
-        except Exception as e:
-            self.logger.error(f"UID:{self.username} url:{url} decode error:{str(e)}")
-            return SeatBookerStatus.UNKNOWN_ERROR, None
+    def next_time_windows(self, num=1):
+        # 按顺序取出接下来num个尚未尝试的时间窗口
+        windows = self.time_windows[self.window_cursor:self.window_cursor + num]
+        self.window_cursor += len(windows)
+        return windows
 
-        return SeatBookerStatus.SUCCESS, response_data
+    def use_time_window(self, window):
+        self.start_time_delta, self.duration_delta = window
 
-    def login(self):
-        data = {
+    def login_data(self):
+        return {
             "login_name": self.username,
             "password": self.password,
             "ui_type": "com.Raw",
@@ -183,31 +143,30 @@ class SeatBooker:
             "_ClientVersion": "js_xxx",
             "_InstallationId": "f28639d1-5c15-1fa0-89bd-9da5a8e015e0"
         }
-        # POST login
-        status, response_data = self.get_remote_response(url=self.urls['login'], method="post", data=json.dumps(data))
-        if status != SeatBookerStatus.SUCCESS:
-            return status
+
+    def handle_login_response(self, response_data):
         # 处理login结果
         if "mobile" not in response_data.keys():
             return SeatBookerStatus.LOGIN_FAILED
         self.uid = response_data["org_score_info"]["uid"]
         return SeatBookerStatus.SUCCESS
 
-    def search_seat(self):
-        data = {
-            "beginTime": self.start_time + self.start_time_delta,
-            "duration": self.duration + self.duration_delta,
+    def search_seat_data(self, window=None):
+        start_time_delta, duration_delta = window if window else (self.start_time_delta, self.duration_delta)
+        return {
+            "beginTime": self.start_time + start_time_delta,
+            "duration": self.duration + duration_delta,
             "num": 1,
             "space_category[category_id]": self.category_id,
             "space_category[content_id]": self.content_id
         }
-        # POST search_seat
-        status, response_data = self.get_remote_response(url=self.urls['search_seat'], method="post", data=data)
-        if status != SeatBookerStatus.SUCCESS:
-            return status
-        # 处理search_seat结果
+
+    def handle_search_seat_response(self, response_data, seat=None):
+        # 处理search_seat结果，seat为已分配的(座位id, 座位号)
         if "data" not in response_data.keys():
             return SeatBookerStatus.NO_SEAT
+        # 顺便增量刷新本地座位表
+        seat_map.update(self.content_id, response_data["data"])
         # 处理系统自动调整的时间
         if not response_data["content"]["children"][1]["ifAdjust"]:
             # 系统未自动调整时间
@@ -230,44 +189,108 @@ class SeatBooker:
             # 按照系统可用的时间更新预定时间
             self.start_time_delta = valid_start_time_delta
             self.duration_delta = valid_duration_delta
-        # 开始选座
-        if self.seat_id == 0:
-            # 选系统推荐的座位
-            self.target_seat = response_data["data"]["bestPairSeats"]["seats"][0]["id"]
-            self.target_seat_title = response_data["data"]["bestPairSeats"]["seats"][0]["title"]
-        else:
-            # 选距离目标座位最近的一个座位，且最好是奇数
-            min_abs = 1e10  # 初始值inf
-            for seat in response_data["data"]["POIs"]:
-                cur_seat_title = int(seat['title'])
-                # 筛选出可选的位置中，距离目标座位最近的一个
-                if seat['state'] == 0 or seat['state'] == 2:
-                    # state=0表示可选，state=2表示推荐
-                    cur_abs = abs(cur_seat_title - self.seat_id)
-                    if cur_abs == 0:
-                        self.target_seat = seat['id']
-                        self.target_seat_title = seat['title']
-                        break  # 与预期座位一致，直接结束查找
-                    if cur_abs < min_abs:
-                        if min_abs - cur_abs > 10 or cur_seat_title % 2:
-                            min_abs = cur_abs
-                            self.target_seat = seat['id']
-                            self.target_seat_title = seat['title']
+        # 开始选座，未指定座位时选历史上最容易订到的座位（没有历史数据时选系统推荐的座位），否则选距离目标座位最近的座位
+        if seat is None:
+            seat = self.choose_seat(response_data["data"], self.start_time + self.start_time_delta)
+        self.target_seat, self.target_seat_title = seat
+        if self.target_seat == "":
+            return SeatBookerStatus.NO_SEAT
         return SeatBookerStatus.SUCCESS
 
-    def book_seat(self):
-        data = {
-            "beginTime": self.start_time + self.start_time_delta,
-            "duration": self.duration + self.duration_delta,
-            "seats[0]": self.target_seat,
+    def choose_seat(self, seat_data, begin_time, taken=()):
+        if self.seat_id == 0:
+            seat = availability_history.best_seat(self.content_id, begin_time, seat_data, taken)
+            if seat is not None:
+                return seat
+        return choose_seat(seat_data, self.seat_id, taken)
+
+    def record_search(self, data, result):
+        # 把实际请求到的searchSeats结果（不含缓存命中）记入座位空闲历史
+        availability_history.record_snapshot(data["space_category[content_id]"], data["beginTime"],
+                                             data["duration"], result[1])
+        return result
+
+    def use_known_seat(self):
+        # 本地座位表中已有目标座位的id时直接选中，按原定时间订座，省去一次search_seat
+        if self.seat_id == 0:
+            return False
+        seat = seat_map.lookup(self.content_id, self.seat_id)
+        if seat is None:
+            return False
+        self.start_time_delta, self.duration_delta = 0, 0
+        self.target_seat, self.target_seat_title = seat, str(self.seat_id)
+        return True
+
+    def booking_candidates(self, windows, responses, seats_per_window=1):
+        # 由多个时间窗口的searchSeats结果生成按偏好排序的订座候选[(时间窗口, (座位id, 座位号)), ...]
+        # 时间窗口靠前的优先，同一窗口内按选座偏好依次取seats_per_window个座位
+        candidates, seen = [], set()
+        for window, response_data in zip(windows, responses):
+            if not response_data or "data" not in response_data.keys():
+                continue
+            seat_map.update(self.content_id, response_data["data"])
+            adjust = response_data["content"]["children"][1]
+            if adjust["ifAdjust"]:
+                # 系统自动调整了时间，按调整后的时间订座，太离谱就不接受
+                window = (adjust["adjustDate"] - self.start_time, adjust["adjustTime"] - self.duration)
+                if not self.is_time_affordable(*window):
+                    continue
+            taken = set()
+            for _ in range(seats_per_window):
+                seat = self.choose_seat(response_data["data"], self.start_time + window[0], taken)
+                if seat[0] == "":
+                    break
+                taken.add(seat[0])
+                if (window, seat[0]) not in seen:
+                    seen.add((window, seat[0]))
+                    candidates.append((window, seat))
+        return candidates
+
+    def use_candidate(self, candidate):
+        self.use_time_window(candidate[0])
+        self.target_seat, self.target_seat_title = candidate[1]
+        self.kept_candidate = candidate
+
+    def find_candidate_record(self, records, candidate):
+        # 在预约记录中找到候选对应的待签到预约
+        (start_time_delta, duration_delta), (_, seat_title) = candidate
+        for record in records or []:
+            if record.get("status") == "0" and int(record.get("time")) == self.start_time + start_time_delta and \
+                    int(record.get("duration")) == self.duration + duration_delta and \
+                    str(record.get("seatNum")) == str(seat_title):
+                return record
+        return None
+
+    def pick_latest_record(self, records):
+        # 推测式订座时最新的记录可能是刚取消的多余预约，优先返回保留的那个预约
+        if self.kept_candidate is not None:
+            record = self.find_candidate_record(records, self.kept_candidate)
+            if record is not None:
+                return record
+        return records[0]
+
+    def book_seat_data(self, candidate=None):
+        # candidate为(时间窗口, (座位id, 座位号))，默认使用当前选中的时间和座位
+        start_time_delta, duration_delta = candidate[0] if candidate else (self.start_time_delta, self.duration_delta)
+        return {
+            "beginTime": self.start_time + start_time_delta,
+            "duration": self.duration + duration_delta,
+            "seats[0]": candidate[1][0] if candidate else self.target_seat,
             "seatBookers[0]": self.uid
         }
-        # POST book_seat
-        status, response_data = self.get_remote_response(url=self.urls['book_seat'], method="post", data=data)
-        if status != SeatBookerStatus.SUCCESS:
-            return status
-        # 处理book_seat结果
+
+    def record_booking(self, candidate, success):
+        # 把订座结果记入座位空闲历史
+        data = self.book_seat_data(candidate)
+        seat_title = candidate[1][1] if candidate else self.target_seat_title
+        availability_history.record_outcome(self.content_id, data["beginTime"], data["duration"], seat_title, success)
+
+    def handle_book_seat_response(self, response_data, candidate=None):
+        # 处理book_seat结果，candidate为推测式订座中预订的候选
         if response_data["CODE"] == "ok":
+            # 房间座位状态已变化，缓存的搜索结果立即失效
+            search_seat_cache.invalidate_room(self.content_id)
+            self.record_booking(candidate, True)
             return SeatBookerStatus.SUCCESS
         else:
             self.logger.warning(f"UID:{self.username} BOOKING_FAILED:{response_data['DATA']['msg']}")
@@ -276,8 +299,117 @@ class SeatBooker:
                     return SeatBookerStatus.ALREADY_BOOKED
                 return SeatBookerStatus.PARAM_ERROR
             else:
+                # 座位被别人抢先预订
+                self.record_booking(candidate, False)
                 return SeatBookerStatus.UNKNOWN_ERROR
 
+
+# SeatBooker类，使用requests同步访问自习室平台
+class SeatBooker(BaseSeatBooker):
+    def __init__(self, conf, logger=None, use_saved_cookie=True) -> None:
+        super().__init__(conf, logger)
+        # 优先使用会话注册表中保存的cookie，复用该账号的长连接池
+        entry = session_registry.get(self.username) if use_saved_cookie else None
+        if entry is not None and not entry.is_expired():
+            self.session = session_registry.get_session(entry, self.fake_header)
+            self.uid = entry.uid
+            if session_registry.needs_refresh(entry):
+                # cookie临近过期，在后台提前重新登录
+                session_registry.schedule_refresh(self.username, lambda: SeatBooker(conf, logger,
+                                                                                    use_saved_cookie=False))
+            return
+        # 建链相关
+        self.session = requests.session()
+        self.session.headers.update(self.fake_header)
+        # 登录
+        stat = self.loop_login(max_failed_time=5)
+        if stat != SeatBookerStatus.SUCCESS:
+            raise RuntimeError("cookie过期且登陆失败" if entry is not None else "无cookie且登陆失败")
+        # 保存cookie（稍后批量写回数据库）
+        session_registry.put(self.username, self.session.cookies.get_dict(), self.uid, session=self.session)
+
+    def get_remote_response(self, url='', method='get', data=None):
+        start = time.perf_counter()
+        status, response_data = self._get_remote_response(url, method, data)
+        if response_listeners:
+            self.notify_response(url, time.perf_counter() - start, status, response_data)
+        return status, response_data
+
+    def _get_remote_response(self, url='', method='get', data=None):
+        if method not in ("post", "get"):
+            self.logger.error(f"UID:{self.username} url:{url} method:{method} not in (post, get)")
+
+        # 尝试post/get
+        sent_at = time.time()
+        try:
+            if method == "post":
+                response = self.session.post(url=url, data=data, proxies=self.session.proxies)
+            else:
+                response = self.session.get(url=url, proxies=self.session.proxies, timeout=5)
+        except requests.exceptions.ReadTimeout:
+            return SeatBookerStatus.TIME_OUT, None
+        except requests.exceptions.SSLError:
+            return SeatBookerStatus.PROXY_ERROR, None
+        except Exception as e:
+            self.logger.error(f"UID:{self.username} url:{url} {method} error:{str(e)}")
+            return SeatBookerStatus.UNKNOWN_ERROR, None
+        # 用响应头中的Date估计服务器时钟差
+        clock_skew.observe(response.headers.get('Date'), sent_at, time.time())
+        # 检查status_code
+        if response.status_code != 200:
+            self.logger.warning(f"UID:{self.username} url:{url} status_code != 200!")
+            return SeatBookerStatus.STATUS_CODE_ERROR, None
+        # 尝试解码response为response_data
+        try:
+            response_data = response.json()
+        except requests.exceptions.JSONDecodeError:
+            self.logger.error(f"UID:{self.username} url:{url} requests.exceptions.JSONDecodeError")
+            return SeatBookerStatus.JSON_DECODE_ERROR, None
+        except Exception as e:
+            self.logger.error(f"UID:{self.username} url:{url} decode error:{str(e)}")
+            return SeatBookerStatus.UNKNOWN_ERROR, None
+
+        return SeatBookerStatus.SUCCESS, response_data
+
+    def login(self):
+        # POST login
+        status, response_data = self.get_remote_response(url=self.urls['login'], method="post",
+                                                         data=json.dumps(self.login_data()))
+        if status != SeatBookerStatus.SUCCESS:
+            return status
+        return self.handle_login_response(response_data)
+
+    def fetch_search_seat(self, window=None):
+        # POST search_seat（相同房间和时间段的搜索结果在多个用户间共享）
+        data = self.search_seat_data(window)
+        return search_seat_cache.get(
+            search_seat_cache.make_key(data),
+            lambda: self.record_search(data, self.get_remote_response(url=self.urls['search_seat'], method="post",
+                                                                      data=data)))
+
+    def search_seat(self):
+        status, response_data = self.fetch_search_seat()
+        if status != SeatBookerStatus.SUCCESS:
+            return status
+        return self.handle_search_seat_response(response_data)
+
+    def book_seat(self):
+        # POST book_seat
+        status, response_data = self.get_remote_response(url=self.urls['book_seat'], method="post",
+                                                         data=self.book_seat_data())
+        if status != SeatBookerStatus.SUCCESS:
+            return status
+        return self.handle_book_seat_response(response_data)
+
+    def book_known_seat(self):
+        # 直接预订本地座位表中的目标座位，目标座位id未知时返回None
+        if not self.use_known_seat():
+            return None
+        stat = self.book_seat()
+        if stat == SeatBookerStatus.SUCCESS:
+            self.logger.info(f"UID:{self.username} BOOK KNOWN SEAT #{self.target_seat_title} SUCCESS!")
+        return stat
+
     def get_latest_record(self):
         # GET get_my_booking_list
         status, response_data = self.get_remote_response(url=self.urls['get_my_booking_list'], method="get")
@@ -373,17 +505,20 @@ class SeatBooker:
             self.logger.error(f"UID:{self.username} booking_id:{booking_id} {response_data['DATA']['msg']}!")
             return SeatBookerStatus.UNKNOWN_ERROR, target_record
 
+    @instrument_loop('login')
     def loop_login(self, max_failed_time):
-        # 若login失败可以循环重试，每2s一次，最多允许失败max_failed_time次
-        failed_time = 0
+        # 若login失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        retry = self.retry_policy.start(max_failed_time, self.retry_deadline, 'login')
         stat = self.login()
         while stat != SeatBookerStatus.SUCCESS:
-            failed_time += 1
-            # 失败max_failed_time次以上退出login流程
-            if failed_time > max_failed_time:
+            # 如果是LOGIN_FAILED，则退出登录流程
+            if stat == SeatBookerStatus.LOGIN_FAILED:
+                self.logger.error(f"UID:{self.username} LOGIN FAILED!")
+            # 失败max_failed_time次以上或超出时间预算则退出login流程
+            delay = retry.next_delay(stat)
+            if delay is None:
                 return SeatBookerStatus.LOOP_FAILED
-            # 2秒重试，加上最多5s的罚时（与失败次数正相关）
-            time.sleep(2 + ((failed_time / max_failed_time) ** 2) * 5)
+            time.sleep(delay)
             # 如果是PROXY_ERROR，则修改代理
             if stat == SeatBookerStatus.PROXY_ERROR:
                 proxy = {
@@ -391,85 +526,84 @@ class SeatBooker:
                     'https': 'http://127.0.0.1:7890',
                 }
                 self.session.proxies.update(proxy)
-            # 如果是LOGIN_FAILED，则退出登录流程
-            elif stat == SeatBookerStatus.LOGIN_FAILED:
-                self.logger.error(f"UID:{self.username} LOGIN FAILED!")
-                return SeatBookerStatus.LOOP_FAILED
             stat = self.login()
         self.logger.info(f"UID:{self.username} LOGIN SUCCESS!")
         return SeatBookerStatus.SUCCESS
 
+    @instrument_loop('search_seat')
     def loop_search_seat(self, max_failed_time):
-        # 若search_seat失败可以循环重试，每2s一次，最多允许失败max_failed_time次
-        failed_time = 0
+        # 若search_seat失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        # 无座或时间不可接受时不计入失败，立即按顺序尝试下一个时间窗口
+        retry = self.retry_policy.start(max_failed_time, self.retry_deadline, 'search_seat')
         stat = self.search_seat()
         while stat != SeatBookerStatus.SUCCESS:
-            failed_time += 1
-            # 失败max_failed_time次以上退出search_seat流程
-            if failed_time > max_failed_time:
-                self.logger.error(f"UID:{self.username} SEARCH_SEAT FAILED!")
-                return SeatBookerStatus.LOOP_FAILED
-            # 2秒重试，加上最多5s的罚时（与失败次数正相关）
-            time.sleep(2 + ((failed_time / max_failed_time) ** 2) * 5)
-            # 无位置时大幅调整预定时间和时长
-            if stat == SeatBookerStatus.NO_SEAT:
-                self.logger.debug(f"UID:{self.username} SEARCH_SEAT NO_SEAT!")
-                self.adjust_conf_randomly(random_range=failed_time, factor=2.5, max_retry_time=200)
-            # 系统调整的时间不可接受时小幅调整预定时间和时长
-            elif stat == SeatBookerStatus.NOT_AFFORDABLE:
-                self.logger.debug(f"UID:{self.username} SEARCH_SEAT NOT_AFFORDABLE!")
-                self.adjust_conf_randomly(random_range=failed_time, factor=1.5, max_retry_time=100)
+            if stat in (SeatBookerStatus.NO_SEAT, SeatBookerStatus.NOT_AFFORDABLE):
+                self.logger.debug(f"UID:{self.username} SEARCH_SEAT {stat.name}!")
+                windows = self.next_time_windows()
+                # 所有时间窗口都已尝试，退出search_seat流程，下一轮从头开始
+                if not windows:
+                    self.logger.error(f"UID:{self.username} SEARCH_SEAT NO TIME WINDOW LEFT!")
+                    self.reset_time_windows()
+                    return SeatBookerStatus.LOOP_FAILED
+                self.use_time_window(windows[0])
+            else:
+                # 失败max_failed_time次以上或超出时间预算则退出search_seat流程
+                delay = retry.next_delay(stat)
+                if delay is None:
+                    self.logger.error(f"UID:{self.username} SEARCH_SEAT FAILED!")
+                    return SeatBookerStatus.LOOP_FAILED
+                time.sleep(delay)
             stat = self.search_seat()
         self.logger.info(f"UID:{self.username} valid_seat:#{self.target_seat_title} seat_id:{self.target_seat}!")
         return SeatBookerStatus.SUCCESS
 
+    @instrument_loop('book_seat')
     def loop_book_seat(self, max_failed_time):
-        # 若book_seat失败可以循环重试，每2s一次，最多允许失败max_failed_time次
-        failed_time = 0
+        # 若book_seat失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        retry = self.retry_policy.start(max_failed_time, self.retry_deadline, 'book_seat')
         stat = self.book_seat()
         while stat != SeatBookerStatus.SUCCESS:
-            failed_time += 1
             # 若已有预约，直接结束程序
             if stat == SeatBookerStatus.ALREADY_BOOKED:
                 self.logger.error(f"UID:{self.username} ALREADY_BOOKED!")
                 return SeatBookerStatus.ALREADY_BOOKED
-            # 失败max_failed_time次以上退出程序
-            if failed_time > max_failed_time:
+            # 失败max_failed_time次以上或超出时间预算则退出程序
+            delay = retry.next_delay(stat)
+            if delay is None:
                 self.logger.error(f"UID:{self.username} BOOK_SEAT FAILED!")
                 return SeatBookerStatus.LOOP_FAILED
-            # 2秒重试，加上最多5s的罚时（与失败次数正相关）
-            time.sleep(2 + ((failed_time / max_failed_time) ** 2) * 5)
+            time.sleep(delay)
             stat = self.book_seat()
         self.logger.info(f"UID:{self.username} BOOK_SEAT SUCCESS!")
         return SeatBookerStatus.SUCCESS
 
+    @instrument_loop('get_latest_record')
     def loop_get_latest_record(self, max_failed_time):
-        # 若get_latest_record失败可以循环重试，每2s一次，最多允许失败max_failed_time次
-        failed_time = 0
+        # 若get_latest_record失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        retry = self.retry_policy.start(max_failed_time, name='get_latest_record')
         stat, latest_record = self.get_latest_record()
         while stat != SeatBookerStatus.SUCCESS:
-            failed_time += 1
             # 失败max_failed_time次以上退出get_latest_record流程
-            if failed_time > max_failed_time:
+            delay = retry.next_delay(stat)
+            if delay is None:
                 return SeatBookerStatus.LOOP_FAILED, None
-            # 2秒重试，加上最多5s的罚时（与失败次数正相关）
-            time.sleep(2 + ((failed_time / max_failed_time) ** 2) * 5)
+            time.sleep(delay)
             stat, latest_record = self.get_latest_record()
         return SeatBookerStatus.SUCCESS, latest_record
 
+    @instrument_loop('checkin_booking')
     def loop_checkin_booking(self, booking_id, max_failed_time):
-        # 若checkin_booking失败可以循环重试，每2s一次，最多允许失败max_failed_time次
-        failed_time = 0
+        # 若checkin_booking失败可以按重试策略循环重试，最多允许失败max_failed_time次
+        retry = self.retry_policy.start(max_failed_time, self.retry_deadline, 'checkin_booking')
         stat, target_record = self.checkin_booking(booking_id=booking_id)
         while stat != SeatBookerStatus.SUCCESS:
-            failed_time += 1
             # 无需签到
             if stat == SeatBookerStatus.NO_NEED:
                 return stat, target_record
-            # 失败max_failed_time次以上退出checkin_booking流程
-            if failed_time > max_failed_time:
+            # 失败max_failed_time次以上或超出时间预算则退出checkin_booking流程
+            delay = retry.next_delay(stat)
+            if delay is None:
                 return SeatBookerStatus.LOOP_FAILED, target_record
-            # 2秒重试，加上最多5s的罚时（与失败次数正相关）
-            time.sleep(2 + ((failed_time / max_failed_time) ** 2) * 5)
+            time.sleep(delay)
             stat, target_record = self.checkin_booking(booking_id=booking_id)
         return SeatBookerStatus.SUCCESS, target_record
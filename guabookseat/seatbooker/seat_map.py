@@ -0,0 +1,95 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from guabookseat import app, db
+from guabookseat.models import SeatMap
+from guabookseat.sqlite_tuning import retry_on_busy
+
+
+# 座位表：每个房间的座位号 -> 座位id，内存中一份，SeatMap表中持久化一份
+# 每次searchSeats的结果都会与内存中的座位表比较，只把新增或变化的座位写回数据库
+class SeatMapStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = None  # content_id -> {座位号: 座位id}，首次使用时从数据库加载
+        self._last_seen = {}  # content_id -> 最近一次比较过的快照，多个用户共享同一份快照时只比较一次
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='seat-map-writer')
+
+    @property
+    def loaded(self):
+        return self._rooms is not None
+
+    def load(self):
+        if self._rooms is not None:
+            return
+        rooms = {}
+        try:
+            for row in SeatMap.query.all():
+                rooms.setdefault(row.content_id, {})[row.title] = row.seat_id
+        except SQLAlchemyError as e:
+            # 表尚未创建（需执行flask initdb）时只使用内存中的座位表
+            app.logger.warning(f"SeatMapStore load failed:{str(e)}")
+            db.session.rollback()
+        with self._lock:
+            if self._rooms is None:
+                self._rooms = rooms
+
+    def lookup(self, content_id, title):
+        # 返回座位号为title的座位id，未知时返回None
+        self.load()
+        return self._rooms.get(int(content_id), {}).get(int(title))
+
+    def room(self, content_id):
+        self.load()
+        return dict(self._rooms.get(int(content_id), {}))
+
+    def update(self, content_id, seat_data):
+        # 用一份searchSeats快照增量刷新座位表
+        self.load()
+        content_id = int(content_id)
+        changes = {}
+        with self._lock:
+            if self._last_seen.get(content_id) is seat_data:
+                return 0
+            self._last_seen[content_id] = seat_data
+            seats = self._rooms.setdefault(content_id, {})
+            for seat in seat_data["POIs"]:
+                try:
+                    title = int(seat['title'])
+                except (TypeError, ValueError):
+                    continue
+                if seats.get(title) != seat['id']:
+                    seats[title] = seat['id']
+                    changes[title] = seat['id']
+        if changes:
+            self._executor.submit(self._persist, content_id, changes)
+        return len(changes)
+
+    def _persist(self, content_id, changes):
+        try:
+            self._write(content_id, changes)
+        except SQLAlchemyError as e:
+            app.logger.warning(f"SeatMapStore persist {len(changes)} seats of room {content_id} failed:{str(e)}")
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+    @retry_on_busy(rollback=db.session.rollback)
+    def _write(self, content_id, changes):
+        now = int(time.time())
+        rows = {row.title: row for row in SeatMap.query.filter(SeatMap.content_id == content_id,
+                                                               SeatMap.title.in_(list(changes))).all()}
+        for title, seat_id in changes.items():
+            row = rows.get(title)
+            if row is None:
+                row = SeatMap(content_id=content_id, title=title)
+                db.session.add(row)
+            row.seat_id = seat_id
+            row.updated_at = now
+        db.session.commit()
+
+
+seat_map = SeatMapStore()
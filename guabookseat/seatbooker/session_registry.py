@@ -0,0 +1,202 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from guabookseat import app, db
+from guabookseat.models import UserCookie
+from guabookseat.sqlite_tuning import retry_on_busy
+
+
+def load_user_cookie(username):
+    # 读取保存的cookie，返回(cookie, uid, 过期时间戳)，无cookie时返回None
+    user_cookie = UserCookie.query.filter_by(username=username).first()
+    if not user_cookie:
+        return None
+    return user_cookie.get_cookie(), user_cookie.get_uid(), user_cookie.expire_time
+
+
+@retry_on_busy(rollback=db.session.rollback)
+def save_user_cookies(cookies):
+    # 批量新增或更新保存的cookie，cookies为[(username, cookie, uid), ...]，只提交一次
+    for username, cookie, uid in cookies:
+        user_cookie = UserCookie.query.filter_by(username=username).first()
+        if not user_cookie:
+            user_cookie = UserCookie()
+            db.session.add(user_cookie)
+        user_cookie.set_cookie(cookie, username, uid)
+    db.session.commit()
+
+
+# 一个自习室账号的会话
+class SessionEntry:
+    def __init__(self, username, cookie, uid, expire_time):
+        self.username = username
+        self.cookie = cookie
+        self.uid = uid
+        self.expire_time = expire_time
+        self.version = 0  # cookie每更新一次加1
+        self.session = None  # 持有长连接池的requests.Session
+        self.lock = threading.Lock()
+
+    def is_expired(self):
+        return time.time() > self.expire_time
+
+    def expires_within(self, seconds):
+        return time.time() > self.expire_time - seconds
+
+
+# 进程内的会话注册表：按学号缓存已设置好cookie的会话，cookie写回数据库延后批量进行，超出容量时淘汰最久未使用的会话
+class SessionRegistry:
+    def __init__(self, capacity=256, refresh_ahead=6 * 3600, flush_interval=5.0):
+        self.capacity = capacity
+        self.refresh_ahead = refresh_ahead
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = {}  # username -> (cookie, uid)
+        self._dirty_event = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._refreshing = set()
+        self._refresh_executor = None
+
+    def _remember(self, entry):
+        # 需持有self._lock
+        self._entries[entry.username] = entry
+        self._entries.move_to_end(entry.username)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def peek(self, username):
+        # 只查内存，不访问数据库
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                self._entries.move_to_end(username)
+            return entry
+
+    def get(self, username):
+        # 先查内存，未命中时从UserCookie表加载一次
+        entry = self.peek(username)
+        if entry is not None:
+            return entry
+        saved_cookie = load_user_cookie(username)
+        if saved_cookie is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                entry = SessionEntry(username, saved_cookie[0], saved_cookie[1], saved_cookie[2])
+                self._remember(entry)
+            return entry
+
+    def put(self, username, cookie, uid, session=None):
+        # 登录成功后更新会话，cookie 3天后过期，稍后批量写回UserCookie表
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                entry = SessionEntry(username, cookie, uid, 0)
+            with entry.lock:
+                entry.cookie = cookie
+                entry.uid = uid
+                entry.expire_time = int(time.time()) + 3 * 24 * 3600
+                entry.version += 1
+                if session is not None:
+                    entry.session = session
+            self._remember(entry)
+            self._dirty[username] = (cookie, uid)
+        self._start_flusher()
+        self._dirty_event.set()
+        return entry
+
+    def get_session(self, entry, headers):
+        # 为每个SeatBooker返回一个新的requests.Session：复制该账号当前的cookie，代理等设置互不影响，
+        # 可以在多个线程中同时使用；连接池（HTTPAdapter，线程安全）与该账号的长连接会话共用
+        with entry.lock:
+            if entry.session is None:
+                entry.session = requests.session()
+            session = requests.session()
+            for prefix, adapter in entry.session.adapters.items():
+                session.mount(prefix, adapter)
+            session.headers.update(headers)
+            session.cookies.update(entry.cookie)
+            return session
+
+    def forget(self, username):
+        # 丢弃内存中的会话和尚未写回的cookie
+        with self._lock:
+            self._entries.pop(username, None)
+            self._dirty.pop(username, None)
+
+    def needs_refresh(self, entry):
+        # 距离过期不足refresh_ahead秒时需要提前刷新
+        return entry.expires_within(self.refresh_ahead)
+
+    def schedule_refresh(self, username, relogin):
+        # 在后台线程中调用relogin()提前重新登录，同一账号同时只刷新一次
+        with self._lock:
+            if username in self._refreshing:
+                return False
+            self._refreshing.add(username)
+            if self._refresh_executor is None:
+                self._refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='session-refresh')
+        self._refresh_executor.submit(self._refresh, username, relogin)
+        return True
+
+    def _refresh(self, username, relogin):
+        try:
+            relogin()
+        except Exception as e:
+            app.logger.warning(f"UID:{username} refresh session failed:{str(e)}")
+        finally:
+            db.session.remove()
+            with self._lock:
+                self._refreshing.discard(username)
+
+    def flush(self):
+        # 把待写回的cookie批量写入UserCookie表，失败时保留下次重试
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            try:
+                save_user_cookies([(username, cookie, uid) for username, (cookie, uid) in dirty.items()])
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"SessionRegistry flush {len(dirty)} cookies failed:{str(e)}")
+                with self._lock:
+                    for username, value in dirty.items():
+                        self._dirty.setdefault(username, value)
+                return 0
+            finally:
+                db.session.remove()
+            return len(dirty)
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_forever, name='session-registry-flusher',
+                                             daemon=True)
+            self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            self._dirty_event.wait()
+            # 等待一会儿，把同一时段的登录合并成一次提交
+            time.sleep(self.flush_interval)
+            self._dirty_event.clear()
+            self.flush()
+
+
+session_registry = SessionRegistry(capacity=app.config['BOOKER_SESSION_CAPACITY'],
+                                   refresh_ahead=app.config['BOOKER_SESSION_REFRESH_AHEAD'],
+                                   flush_interval=app.config['BOOKER_SESSION_FLUSH_INTERVAL'])
+atexit.register(session_registry.flush)
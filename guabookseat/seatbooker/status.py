@@ -0,0 +1,18 @@
+from enum import Enum
+
+
+# SeatBooker状态枚举类
+class SeatBookerStatus(Enum):
+    SUCCESS = 1
+    NO_SEAT = 2
+    NOT_AFFORDABLE = 3
+    STATUS_CODE_ERROR = 4
+    TIME_OUT = 5
+    PARAM_ERROR = 6
+    UNKNOWN_ERROR = 7
+    ALREADY_BOOKED = 8
+    LOOP_FAILED = 9
+    LOGIN_FAILED = 10
+    PROXY_ERROR = 11
+    JSON_DECODE_ERROR = 12
+    NO_NEED = 13
@@ -0,0 +1,63 @@
+import functools
+import random
+import sqlite3
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+
+# SQLite调优：WAL模式下读写互不阻塞，synchronous=NORMAL在WAL下只在检查点时fsync；
+# 连接池复用连接（pysqlite默认每次都新建连接），busy_timeout内等待写锁，仍然失败时由retry_on_busy重试整个事务
+def sqlite_engine_options(url, pool_size=10, max_overflow=20, busy_timeout=15):
+    # 返回create_engine的参数，非SQLite文件数据库时返回空字典
+    if not url.startswith('sqlite') or url.rstrip('/').endswith(':memory:') or url.rstrip('/') == 'sqlite:':
+        return {}
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_pre_ping': False,
+        # 连接由连接池保证同一时刻只被一个线程使用；timeout为等待写锁的秒数
+        'connect_args': {'check_same_thread': False, 'timeout': busy_timeout},
+    }
+
+
+def install_sqlite_pragmas(engine, journal_mode='WAL', synchronous='NORMAL'):
+    # engine每次新建SQLite连接时设置日志模式和同步级别
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+        finally:
+            cursor.close()
+
+
+def is_sqlite_busy(e):
+    return isinstance(e, OperationalError) and isinstance(e.orig, sqlite3.OperationalError) and \
+        ('database is locked' in str(e.orig) or 'database is busy' in str(e.orig))
+
+
+def retry_on_busy(func=None, attempts=5, base_delay=0.05, rollback=None):
+    # 遇到database is locked时先调用rollback()，再按指数退避（带随机抖动）重试整个函数
+    if func is None:
+        return functools.partial(retry_on_busy, attempts=attempts, base_delay=base_delay, rollback=rollback)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_sqlite_busy(e) or attempt == attempts - 1:
+                    raise
+                if rollback is not None:
+                    rollback()
+                time.sleep(base_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    return wrapper
@@ -0,0 +1,47 @@
+from guabookseat import app, db, scheduler
+from guabookseat.booking_wave import release_wave_coordinator
+from guabookseat.cookie_refresher import cookie_refresher
+from guabookseat.models import UserConfig
+from guabookseat.scheduled_jobs import run_auto_booking, run_seat_booker_func
+
+
+def migrate_legacy_jobs():
+    # 旧版本的任务在参数中保存了完整的订座信息（包括密码），改为只保存用户id，运行时再读取订座信息
+    migrated = 0
+    for job in scheduler.get_jobs():
+        if not job.args or not isinstance(job.args[0], dict):
+            continue
+        if job.id.startswith('daily_auto_booking_'):
+            scheduler.modify_job(id=job.id, func=run_auto_booking, args=[int(job.id.rpartition('_')[2])])
+            migrated += 1
+            continue
+        # 签到、签退、取消任务：[conf, func_name, receiver, booking_id]
+        if len(job.args) < 4:
+            continue
+        userconfig = UserConfig.query.filter_by(student_id=job.args[0].get('username')).first()
+        if userconfig is None:
+            app.logger.warning(f"JOB:{job.id} has no matching booking config, keep legacy args!")
+            continue
+        scheduler.modify_job(id=job.id, func=run_seat_booker_func, args=[userconfig.id, job.args[1], job.args[3]])
+        migrated += 1
+    db.session.remove()
+    if migrated:
+        app.logger.info(f"MIGRATED {migrated} legacy jobs to user id references!")
+
+
+def init_system_jobs():
+    migrate_legacy_jobs()
+    # 预约波次协调任务：每分钟提前wave_lead_time秒运行
+    if app.config['BOOKER_WAVE_MODE']:
+        lead_time = min(max(int(app.config['BOOKER_WAVE_LEAD_TIME']), 5), 55)
+        scheduler.add_job(id='release_wave_coordinator', func=release_wave_coordinator, trigger='cron',
+                          second=60 - lead_time, misfire_grace_time=lead_time - 2, replace_existing=True)
+    elif scheduler.get_job(id='release_wave_coordinator'):
+        scheduler.remove_job(id='release_wave_coordinator')
+    # cookie刷新任务：提前重新登录即将过期的账号，预约时刻不再需要登录
+    if app.config['COOKIE_REFRESH_ENABLED']:
+        scheduler.add_job(id='cookie_refresher', func=cookie_refresher, trigger='interval',
+                          minutes=max(int(app.config['COOKIE_REFRESH_INTERVAL']), 1), max_instances=1,
+                          coalesce=True, replace_existing=True)
+    elif scheduler.get_job(id='cookie_refresher'):
+        scheduler.remove_job(id='cookie_refresher')
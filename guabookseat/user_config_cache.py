@@ -0,0 +1,126 @@
+import threading
+import time
+
+from flask import g, has_app_context
+
+from guabookseat import app, db, scheduler
+from guabookseat.models import User, UserConfig
+
+
+# 用户订座信息的进程内缓存：定时任务只保存用户id，运行时从这里读取参数配置和邮箱
+# 本进程修改订座信息或邮箱后立即失效，其他进程的修改最多ttl秒后生效
+# 网页请求读取的用户、订座信息和自动预约任务状态也缓存在这里（最多web_ttl秒），同一请求内只读取一次
+class UserConfigCache:
+    def __init__(self, ttl=60, web_ttl=30):
+        self.ttl = ttl
+        self.web_ttl = web_ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # user_id -> (读取时刻, 参数配置, 邮箱)
+        self._web_entries = {}  # (类别, user_id) -> (过期时刻, 值)
+        self._generation = 0  # 每次失效加1，避免把失效前读到的旧数据写回缓存
+
+    def get(self, user_id):
+        # 返回(参数配置, 邮箱)，用户没有订座信息时参数配置为None；有备选订座信息时参数配置中带有profiles
+        user_id = int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            generation = self._generation
+        if entry is None or now - entry[0] >= self.ttl:
+            # 调度器线程的数据库会话会长期保留，需要用数据库中的最新值覆盖会话中已加载的对象
+            userconfigs = UserConfig.query_profiles(user_id).populate_existing().all()
+            user = User.query.populate_existing().filter_by(id=user_id).first()
+            entry = (now, UserConfig.profiles_config(userconfigs), user.mail_address if user else None)
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[user_id] = entry
+        return (dict(entry[1]) if entry[1] else None), entry[2]
+
+    def get_for_job(self, job):
+        # 每日自动预约任务的(参数配置, 邮箱)；参数不是用户id的任务（尚未迁移的旧任务，或旧版本进程写入共享任务库的任务）
+        # 记录警告后跳过，返回(None, None)
+        if not job.args:
+            return None, None
+        if not isinstance(job.args[0], int) or isinstance(job.args[0], bool):
+            app.logger.warning(f"JOB:{job.id} has legacy args instead of a user id, skip!")
+            return None, None
+        return self.get(job.args[0])
+
+    def _web_get(self, kind, user_id, loader):
+        # 先查本次请求已读取的值，再查进程内缓存，都没有时调用loader()，返回(值, 过期时刻)
+        user_id = int(user_id)
+        key = (kind, user_id)
+        request_cache = g.setdefault('user_config_cache', {}) if has_app_context() else {}
+        if key in request_cache:
+            return request_cache[key]
+        now = time.monotonic()
+        with self._lock:
+            entry = self._web_entries.get(key)
+            generation = self._generation
+        if entry is None or now >= entry[0]:
+            value, expire_at = loader(user_id)
+            entry = (min(now + self.web_ttl, expire_at) if expire_at else now + self.web_ttl, value)
+            if self.web_ttl > 0:
+                with self._lock:
+                    if generation == self._generation:
+                        self._web_entries[key] = entry
+        request_cache[key] = entry[1]
+        return entry[1]
+
+    @staticmethod
+    def _detached(instance):
+        # 从当前会话中移除，缓存的对象可以在其他请求线程中只读使用
+        if instance is not None:
+            db.session.expunge(instance)
+        return instance
+
+    def get_user(self, user_id):
+        # 登录用户（已脱离会话，修改时需重新查询）
+        return self._web_get('user', user_id,
+                             lambda uid: (self._detached(User.query.filter_by(id=uid).first()), None))
+
+    def get_user_config(self, user_id):
+        # 用户的主订座信息（已脱离会话，修改时需重新查询），没有时为None
+        configs = self.get_user_configs(user_id)
+        return configs[0] if configs else None
+
+    def get_user_configs(self, user_id):
+        # 用户按优先级排列的全部订座信息（已脱离会话，修改时需重新查询）
+        return self._web_get('configs', user_id,
+                             lambda uid: ([self._detached(userconfig)
+                                           for userconfig in UserConfig.query_profiles(uid).all()], None))
+
+    def get_auto_booking_info(self, user_id):
+        # 首页展示的自动预约任务状态，任务运行后下次运行时间会变化，缓存最晚在下次运行时过期
+        def load(uid):
+            job_id = 'daily_auto_booking_' + str(uid)
+            booking_job = scheduler.get_job(id=job_id)
+            next_run_time = booking_job.next_run_time if booking_job else None
+            info = {
+                'enable': booking_job is not None,
+                'paused': next_run_time is None,
+                'task_id': job_id,
+                'next_order_time': next_run_time.strftime('%Y年%m月%d日 %H:%M') if next_run_time else "无计划"
+            }
+            expire_at = time.monotonic() + max(0.0, next_run_time.timestamp() - time.time()) \
+                if next_run_time else None
+            return info, expire_at
+
+        return self._web_get('auto_booking_info', user_id, load)
+
+    def invalidate(self, user_id=None):
+        # user_id为None时清空全部缓存
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+                self._web_entries.clear()
+            else:
+                self._entries.pop(int(user_id), None)
+                for kind in ('user', 'configs', 'auto_booking_info'):
+                    self._web_entries.pop((kind, int(user_id)), None)
+        if has_app_context():
+            g.pop('user_config_cache', None)
+
+
+user_config_cache = UserConfigCache(ttl=app.config['SCHEDULER_CONFIG_CACHE_TTL'], web_ttl=app.config['WEB_CACHE_TTL'])
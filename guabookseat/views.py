@@ -1,34 +1,31 @@
+import hmac
 import threading
+import time
 
-from flask import render_template, request, url_for, redirect, flash
+from flask import render_template, request, url_for, redirect, flash, abort, Response
 from flask_login import login_user, login_required, logout_user, current_user
 
 from guabookseat import app, db, scheduler
+from guabookseat.booking_history import booking_history
 from guabookseat.constants import Constants
+from guabookseat.metrics import render_metrics
 from guabookseat.models import User, UserConfig
-from guabookseat.scheduled_jobs import call_seat_booker_func, auto_booking
+from guabookseat.scheduled_jobs import history_to_tuple, auto_booking, run_auto_booking
+from guabookseat.user_config_cache import user_config_cache
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():  # put application's code here
     auto_booking_info = None
     if current_user.is_authenticated:
-        # 获取当前job（可能为None）
-        job_id = 'daily_auto_booking_' + str(current_user.id)
-        booking_job = scheduler.get_job(id=job_id)
         # 当前自动预约信息
-        auto_booking_info = {
-            'enable': booking_job is not None,
-            'paused': booking_job.next_run_time is None if booking_job else True,
-            'task_id': job_id,
-            'next_order_time': booking_job.next_run_time.strftime(
-                '%Y年%m月%d日 %H:%M') if booking_job and booking_job.next_run_time else "无计划"
-        }
+        auto_booking_info = user_config_cache.get_auto_booking_info(current_user.id)
     if request.method == 'POST':
         if not current_user.is_authenticated:
             return redirect(url_for('index'))
 
-    return render_template('index.html', valid_rooms=Constants.valid_rooms, auto_booking_info=auto_booking_info)
+    return render_template('index.html', valid_rooms=Constants.valid_rooms, auto_booking_info=auto_booking_info,
+                           max_booking_profiles=Constants.max_booking_profiles)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -83,6 +80,7 @@ def logon():
         user.mail_address = mail_address if mail_address != "" else None
         db.session.add(user)
         db.session.commit()
+        user_config_cache.invalidate(user.id)
         flash('注册成功！')
         return redirect(url_for('index'))
 
@@ -101,43 +99,38 @@ def logout():
 @login_required
 def set_auto_booking():
     if request.method == 'POST':
-        # 更新邮箱
+        # 更新邮箱（任务运行时读取最新的邮箱，不需要修改任务）
         mail_address = request.form['mail_address'] if request.form['mail_address'] != "" else None
         mail_changed = mail_address != current_user.mail_address
         if mail_changed:
             user = User.query.get(current_user.id)
             user.mail_address = mail_address
             db.session.commit()
+            user_config_cache.invalidate(current_user.id)
         # 更新自动预约任务时间
         order_time = request.form['order_time'].split(':')
         job_id = 'daily_auto_booking_' + str(current_user.id)
         cur_job = scheduler.get_job(id=job_id)
-        cur_config_id = int(request.form['config_id'])
-        userconfig = UserConfig.query.get(cur_config_id)
         # 存在任务则修改
         if cur_job:
             cur_time = cur_job.next_run_time
             time_changed = int(order_time[0]) != cur_time.hour or int(
                 order_time[1]) != cur_time.minute if cur_time else True
             job_paused = cur_time is None
-            # 分情况修改任务
-            if mail_changed and time_changed:
-                scheduler.modify_job(id=job_id, trigger='cron', hour=order_time[0], minute=order_time[1],
-                                     args=[userconfig.get_config(), mail_address])
-            elif mail_changed:
-                scheduler.modify_job(id=job_id, args=[userconfig.get_config(), mail_address])
-            elif time_changed:
+            # 只有时间变化时才需要修改任务
+            if time_changed:
                 scheduler.modify_job(id=job_id, trigger='cron', hour=order_time[0], minute=order_time[1])
-            else:
-                pass
             # 若之前任务为暂停状态，继续暂停任务
             if job_paused:
                 scheduler.pause_job(id=job_id)
-        # 不存在任务则添加
+        # 不存在任务则添加，任务中只保存用户id
         else:
-            scheduler.add_job(id=job_id, func=auto_booking, trigger='cron', hour=order_time[0], minute=order_time[1],
-                              args=[userconfig.get_config(), mail_address])
+            scheduler.add_job(id=job_id, func=run_auto_booking, trigger='cron', hour=order_time[0],
+                              minute=order_time[1], args=[current_user.id])
             time_changed = True
+        # 首页展示的任务状态随之更新
+        if time_changed:
+            user_config_cache.invalidate(current_user.id)
         # 提示信息
         if mail_changed or time_changed:
             flash_str = "邮箱已更新！" if mail_changed else ""
@@ -151,39 +144,94 @@ def set_auto_booking():
 @app.route('/set-config', methods=['GET', 'POST'])
 @login_required
 def set_config():
+    # 第一条为主订座信息，其余为备选订座信息，备选订座信息共用主订座信息的学号和密码
+    userconfigs = UserConfig.query_profiles(current_user.id).all()
     if request.method == 'POST':
         # print(request.form)
         cur_config_id = int(request.form['config_id'])
+        config_data = request.form.to_dict()
+        if userconfigs and 'student_id' not in config_data:
+            config_data['student_id'] = userconfigs[0].student_id
+            config_data['student_pwd'] = userconfigs[0].student_pwd
         if cur_config_id == 0:
+            if len(userconfigs) >= Constants.max_booking_profiles:
+                flash(f'最多设置{Constants.max_booking_profiles}条订座信息！')
+                return redirect(url_for('index'))
             userconfig = UserConfig()
-            userconfig.set_config(config_data=request.form, cur_user_id=current_user.id)
+            userconfig.set_config(config_data=config_data, cur_user_id=current_user.id)
+            userconfig.priority = userconfigs[-1].priority + 1 if userconfigs else 0
             db.session.add(userconfig)
-            db.session.commit()
-            flash('添加订座信息成功！')
-            return redirect(url_for('index'))
+            flash_str = '添加备选订座信息成功！' if userconfigs else '添加订座信息成功！'
         else:
-            userconfig = UserConfig.query.get(cur_config_id)
-            userconfig.set_config(config_data=request.form, cur_user_id=current_user.id)
-            db.session.commit()
-            job_id = 'daily_auto_booking_' + str(current_user.id)
-            if scheduler.get_job(id=job_id):
-                scheduler.modify_job(id=job_id, args=[userconfig.get_config(), current_user.mail_address])
-            flash('修改订座信息成功！')
-            return redirect(url_for('index'))
+            userconfig = next((c for c in userconfigs if c.cid == cur_config_id), None)
+            if userconfig is None:
+                abort(404)
+            userconfig.set_config(config_data=config_data, cur_user_id=current_user.id)
+            flash_str = '修改订座信息成功！'
+        # 学号和密码同步到所有订座信息
+        for other in userconfigs:
+            other.student_id, other.student_pwd = userconfig.student_id, userconfig.student_pwd
+        db.session.commit()
+        # 任务运行时读取最新的订座信息，不需要修改任务
+        user_config_cache.invalidate(current_user.id)
+        flash(flash_str)
+        return redirect(url_for('index'))
 
-    return render_template('set-config.html', valid_rooms=Constants.valid_rooms,
+    # 默认修改主订座信息；cid为要修改的订座信息，new=1时添加备选订座信息
+    editing = userconfigs[0] if userconfigs else None
+    if request.args.get('new') and userconfigs:
+        editing = None
+    elif request.args.get('cid'):
+        editing = next((c for c in userconfigs if c.cid == request.args.get('cid', type=int)), None)
+        if editing is None:
+            abort(404)
+    fallback = bool(userconfigs) and (editing is None or editing.cid != userconfigs[0].cid)
+    return render_template('set-config.html', profile=editing, fallback=fallback, valid_rooms=Constants.valid_rooms,
                            valid_start_times=Constants.valid_start_times,
                            valid_durations=Constants.valid_durations,
                            valid_start_time_delta_limits=Constants.valid_start_time_delta_limits,
                            valid_duration_delta_limits=Constants.valid_duration_delta_limits)
 
 
+@app.route('/delete-config/<int:cid>')
+@login_required
+def delete_config(cid):
+    # 只能删除备选订座信息
+    userconfigs = UserConfig.query_profiles(current_user.id).all()
+    userconfig = next((c for c in userconfigs[1:] if c.cid == cid), None)
+    if userconfig is None:
+        abort(404)
+    db.session.delete(userconfig)
+    db.session.commit()
+    user_config_cache.invalidate(current_user.id)
+    flash('删除备选订座信息成功！')
+    return redirect(url_for('index'))
+
+
+@app.route('/raise-config/<int:cid>')
+@login_required
+def raise_config(cid):
+    # 与前一条订座信息交换顺序，移到第一条时成为主订座信息
+    userconfigs = UserConfig.query_profiles(current_user.id).all()
+    index = next((i for i, c in enumerate(userconfigs) if c.cid == cid), None)
+    if index is None:
+        abort(404)
+    if index > 0:
+        userconfigs[index - 1], userconfigs[index] = userconfigs[index], userconfigs[index - 1]
+        for priority, userconfig in enumerate(userconfigs):
+            userconfig.priority = priority
+        db.session.commit()
+        user_config_cache.invalidate(current_user.id)
+    return redirect(url_for('index'))
+
+
 @app.route('/pause-auto-booking')
 @login_required
 def pause_auto_booking():
     job_id = 'daily_auto_booking_' + str(current_user.id)
     if scheduler.get_job(id=job_id):
         scheduler.pause_job(id=job_id)
+        user_config_cache.invalidate(current_user.id)
     return redirect(url_for('index'))
 
 
@@ -193,26 +241,49 @@ def resume_auto_booking():
     job_id = 'daily_auto_booking_' + str(current_user.id)
     if scheduler.get_job(id=job_id):
         scheduler.resume_job(id=job_id)
+        user_config_cache.invalidate(current_user.id)
     return redirect(url_for('index'))
 
 
 @app.route('/show-booking-list')
 @login_required
 def show_booking_list():
-    histories = None
+    histories, updated_at, refreshing = None, None, False
     if current_user.is_authenticated:
-        # 获取当前histories（可能为None）
-        current_config = UserConfig.query.filter_by(id=current_user.id).first()
-        histories = call_seat_booker_func(conf=current_config.get_config(),
-                                          func_name='get_histories') if current_config else None
-    return render_template('show-booking-list.html', histories=histories)
+        current_config = user_config_cache.get_user_config(current_user.id)
+        if current_config:
+            # 先展示缓存的预约记录（可能为None），缓存过期或用户要求刷新时在后台重新获取
+            records, updated_ts = booking_history.get(current_config.student_id)
+            if request.args.get('refresh') or booking_history.is_stale(updated_ts):
+                booking_history.refresh(current_config.get_config())
+                if request.args.get('refresh'):
+                    return redirect(url_for('show_booking_list'))
+            refreshing = booking_history.is_refreshing(current_config.student_id)
+            histories = [history_to_tuple(record) for record in records] if records is not None else None
+            updated_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(updated_ts)) if updated_ts else None
+    return render_template('show-booking-list.html', histories=histories, updated_at=updated_at,
+                           refreshing=refreshing)
 
 
 @app.route('/manual-booking')
 @login_required
 def manual_booking():
-    userconfig = UserConfig.query.filter_by(id=current_user.id).first()
-    new_thread = threading.Thread(target=auto_booking, args=(userconfig.get_config(), current_user.mail_address))
+    conf = UserConfig.profiles_config(user_config_cache.get_user_configs(current_user.id))
+    new_thread = threading.Thread(target=auto_booking, args=(conf, current_user.mail_address))
     new_thread.start()
     flash("手动预约任务正在后台运行！")
     return redirect(url_for('index'))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(401)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        # 未设置token时只允许本机的采集程序访问
+        abort(403)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')